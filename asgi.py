@@ -0,0 +1,9 @@
+from a2wsgi import WSGIMiddleware
+
+from fhirserver import create_app, DEVELOPMENT
+
+flask_app = create_app(DEVELOPMENT)
+
+# serve it with an ASGI server, e.g. `uvicorn asgi:app`. The requests are processed by a pool of threads, because
+# the database access is synchronous
+app = WSGIMiddleware(flask_app, workers=flask_app.config['ASGI_WORKERS'])
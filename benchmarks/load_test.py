@@ -0,0 +1,86 @@
+"""
+Load test of a running server. It sends the same request from many concurrent clients and reports the throughput
+and the latency percentiles, to compare the serving modes at high concurrency, e.g.:
+
+    gunicorn -w 4 wsgi:app -b :5000                          # one request at a time per worker
+    gunicorn -w 4 --threads 8 wsgi:app -b :5001              # requests processed by the threads of the workers
+    ASGI_WORKERS=8 uvicorn --workers 4 asgi:app --port 5002  # ASGI, requests processed by the thread pools
+
+    python -m benchmarks.load_test http://localhost:5000/Patient?_count=20 --concurrency 200 --requests 5000
+    python -m benchmarks.load_test http://localhost:5001/Patient?_count=20 --concurrency 200 --requests 5000
+    python -m benchmarks.load_test http://localhost:5002/Patient?_count=20 --concurrency 200 --requests 5000
+
+The client uses only asyncio, with a connection per request, so that it doesn't depend on the server keep-alive
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(host, port, target, headers):
+    """
+    Send a GET request
+    :return: the status code of the response
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        request = 'GET {} HTTP/1.1\r\nHost: {}:{}\r\n{}Connection: close\r\n\r\n'.format(
+            target, host, port, ''.join('{}: {}\r\n'.format(name, value) for name, value in headers.items()))
+        writer.write(request.encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+def percentile(values, fraction):
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+async def run(url, concurrency, number, headers):
+    parts = urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    port = parts.port or 80
+    latencies = []
+    errors = 0
+    remaining = iter(range(number))
+
+    async def client():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                status = await fetch(parts.hostname, port, target, headers)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print('{}: {} requests, {} concurrent clients'.format(url, number, concurrency))
+    print('throughput: {:8.1f} req/s'.format(number / elapsed))
+    print('latency:    p50 {:7.1f} ms  p99 {:7.1f} ms  max {:7.1f} ms'.format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+    print('errors:     {}'.format(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('url')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.concurrency, args.requests, {'Accept': 'application/fhir+json'}))
+
+
+if __name__ == '__main__':
+    main()
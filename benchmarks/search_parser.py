@@ -0,0 +1,45 @@
+"""
+Microbenchmark of the parsing of the search parameters of a request. It compares the RequestParser built on
+every request, as done before the search parsers were compiled at startup, with the compiled SearchParser.
+
+Usage: python -m benchmarks.search_parser [number of iterations]
+"""
+import sys
+import timeit
+
+from flask_restful import reqparse
+from werkzeug.exceptions import HTTPException
+
+from fhirserver import create_app, TESTING
+from fhirserver.exceptions import InvalidQueryParameterException
+from fhirserver.resources.patient import PatientListResource
+from fhirserver.resources.router import COMMON_SEARCH_PARAMETERS, BaseListResource
+
+QUERY = '/Patient?birthdate=ge1965-01-01&family:contains=Reed&_count=20'
+
+
+def parse_with_request_parser():
+    # the arguments are rebuilt on every request, as the parser was
+    parser = reqparse.RequestParser()
+    for argument in COMMON_SEARCH_PARAMETERS + PatientListResource().get_search_parameters():
+        parser.add_argument(argument)
+    try:
+        args = parser.parse_args()
+    except HTTPException as e:
+        raise InvalidQueryParameterException(e.code, e.data)
+    return {name: value for name, value in args.items() if value is not None}
+
+
+def main(number):
+    app = create_app(TESTING)
+    with app.test_request_context(QUERY):
+        old = timeit.timeit(parse_with_request_parser, number=number)
+        new = timeit.timeit(lambda: BaseListResource._parse_search_parameters('Patient'), number=number)
+    print('{}: {} iterations'.format(QUERY, number))
+    print('RequestParser per request: {:8.1f} us/request'.format(old / number * 1e6))
+    print('compiled SearchParser:     {:8.1f} us/request'.format(new / number * 1e6))
+    print('speedup: {:.1f}x'.format(old / new))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -1,6 +1,19 @@
+import os
+import tempfile
 from os import environ
 
 
+def env_flag(name, default):
+    """
+    :return: the boolean value of the environment variable :arg:`name`, that is true only if it's `1`, `true`,
+        `yes` or `on`, or :arg:`default` if it's not set
+    """
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 class DevelopConfig:
     """Set Flask configuration vars from .env file."""
 
@@ -13,8 +26,101 @@ class DevelopConfig:
     SQLALCHEMY_DATABASE_URI = environ.get('SQLALCHEMY_DATABASE_URI', 'sqlite:////tmp/test.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = environ.get('SQLALCHEMY_TRACK_MODIFICATIONS', False)
 
+    # Connection pool, see `fhirserver.pool`. The pool should have a connection for each thread of a worker,
+    # e.g. ASGI_WORKERS
+    DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(environ.get('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', 3600))
+    DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', False)
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+        'cache_size': -64000,
+        'temp_store': 'MEMORY',
+    }
+
+    # Read replicas, see `fhirserver.replicas`: a comma separated list of URIs and the seconds a client reads from
+    # the primary after a write
+    DB_REPLICA_URIS = [uri for uri in environ.get('DB_REPLICA_URIS', '').split(',') if uri]
+    DB_REPLICA_STICKINESS = int(environ.get('DB_REPLICA_STICKINESS', 5))
+
     OPERATORS_MODULE = 'fhirserver.db_drivers'
 
+    # Search
+    DEFAULT_PAGE_SIZE = int(environ.get('DEFAULT_PAGE_SIZE', 50))
+    MAX_PAGE_SIZE = int(environ.get('MAX_PAGE_SIZE', 1000))
+    STREAM_SEARCH_RESULTS = env_flag('STREAM_SEARCH_RESULTS', False)
+
+    # Batch and transaction Bundles: the maximum number of entries of a Bundle
+    BUNDLE_MAX_ENTRIES = int(environ.get('BUNDLE_MAX_ENTRIES', 1000))
+
+    # ASGI serving, see `asgi.py`: the number of threads of a worker that process the requests
+    ASGI_WORKERS = int(environ.get('ASGI_WORKERS', 32))
+
+    # Prometheus metrics, see `fhirserver.metrics`: whether they are collected, whether they are exposed at /metrics
+    # and the bearer token that the requests to /metrics must have, if it's not empty
+    METRICS_ENABLED = env_flag('METRICS_ENABLED', True)
+    METRICS_ENDPOINT = env_flag('METRICS_ENDPOINT', True)
+    METRICS_TOKEN = environ.get('METRICS_TOKEN', '')
+
+    # Profiling, see `fhirserver.profiling`: the header that asks to profile a request, the fraction of the requests
+    # profiled at random and the milliseconds after which a query is logged as slow. Empty or 0 disable them.
+    # The parameters of the slow queries, that are patient data, are logged only if SLOW_QUERY_LOG_PARAMETERS is set
+    PROFILING_HEADER = environ.get('PROFILING_HEADER', 'X-Profile')
+    PROFILING_SAMPLE_RATE = float(environ.get('PROFILING_SAMPLE_RATE', 0))
+    SLOW_QUERY_THRESHOLD_MS = float(environ.get('SLOW_QUERY_THRESHOLD_MS', 500))
+    SLOW_QUERY_LOG_PARAMETERS = env_flag('SLOW_QUERY_LOG_PARAMETERS', False)
+
+    # Resource cache
+    RESOURCE_CACHE = environ.get('RESOURCE_CACHE', 'lru')
+    RESOURCE_CACHE_SIZE = int(environ.get('RESOURCE_CACHE_SIZE', 10000))
+    RESOURCE_CACHE_TTL = int(environ.get('RESOURCE_CACHE_TTL', 300))
+    RESOURCE_CACHE_URL = environ.get('RESOURCE_CACHE_URL', 'redis://localhost:6379/0')
+
+    # Bulk data
+    BULK_WORKERS = int(environ.get('BULK_WORKERS', 2))
+    BULK_RETRY_AFTER = int(environ.get('BULK_RETRY_AFTER', 10))
+    # the seconds a finished job, and the files of an export, are kept
+    BULK_JOB_EXPIRY = int(environ.get('BULK_JOB_EXPIRY', 86400))
+    # the seconds after which a running job that its process doesn't renew is failed, e.g. if the process died
+    BULK_JOB_LEASE = int(environ.get('BULK_JOB_LEASE', 300))
+    BULK_EXPORT_DIR = environ.get('BULK_EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'fhir-export'))
+    BULK_EXPORT_CHUNK_SIZE = int(environ.get('BULK_EXPORT_CHUNK_SIZE', 100000))
+    BULK_EXPORT_GZIP = env_flag('BULK_EXPORT_GZIP', False)
+    BULK_IMPORT_DIR = environ.get('BULK_IMPORT_DIR', os.path.join(tempfile.gettempdir(), 'fhir-import'))
+    BULK_IMPORT_STATE_DIR = environ.get('BULK_IMPORT_STATE_DIR',
+                                        os.path.join(tempfile.gettempdir(), 'fhir-import-jobs'))
+    BULK_IMPORT_CHUNK_SIZE = int(environ.get('BULK_IMPORT_CHUNK_SIZE', 1000))
+
+
+class ProductionConfig(DevelopConfig):
+    """The settings of DevelopConfig, with safe defaults for production. The database must be configured"""
+
+    # General
+    TESTING = False
+    FLASK_DEBUG = False
+    SECRET_KEY = environ.get('SECRET_KEY')
+
+    # Database
+    SQLALCHEMY_DATABASE_URI = environ.get('SQLALCHEMY_DATABASE_URI')
+
+    # Connection pool
+    DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', 20))
+    DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = int(environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', True)
+
+    # Metrics: /metrics is exposed only if it's asked for, possibly with a METRICS_TOKEN
+    METRICS_ENDPOINT = env_flag('METRICS_ENDPOINT', False)
+
+    # Profiling: the clients can't ask for it, and the slow queries are logged only if a threshold is configured
+    PROFILING_HEADER = environ.get('PROFILING_HEADER', '')
+    SLOW_QUERY_THRESHOLD_MS = float(environ.get('SLOW_QUERY_THRESHOLD_MS', 0))
+
 
 class TestConfig:
     # General
@@ -26,4 +132,61 @@ class TestConfig:
     SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/test.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 5
+    DB_POOL_RECYCLE = -1
+    DB_POOL_PRE_PING = False
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+    }
+
+    # Read replicas
+    DB_REPLICA_URIS = []
+    DB_REPLICA_STICKINESS = 5
+
     OPERATORS_MODULE = 'fhirserver.db_drivers'
+
+    # Search
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 1000
+    STREAM_SEARCH_RESULTS = False
+
+    # Batch and transaction Bundles
+    BUNDLE_MAX_ENTRIES = 1000
+
+    # ASGI serving
+    ASGI_WORKERS = 4
+
+    # Metrics
+    METRICS_ENABLED = True
+    METRICS_ENDPOINT = True
+    METRICS_TOKEN = ''
+
+    # Profiling
+    PROFILING_HEADER = 'X-Profile'
+    PROFILING_SAMPLE_RATE = 0
+    SLOW_QUERY_THRESHOLD_MS = 0
+    SLOW_QUERY_LOG_PARAMETERS = False
+
+    # Resource cache
+    RESOURCE_CACHE = 'lru'
+    RESOURCE_CACHE_SIZE = 100
+    RESOURCE_CACHE_TTL = 60
+    RESOURCE_CACHE_URL = None
+
+    # Bulk data
+    BULK_WORKERS = 1
+    BULK_RETRY_AFTER = 1
+    BULK_JOB_EXPIRY = 60
+    BULK_JOB_LEASE = 60
+    BULK_EXPORT_DIR = os.path.join(tempfile.gettempdir(), 'fhir-test-export')
+    BULK_EXPORT_CHUNK_SIZE = 100000
+    BULK_EXPORT_GZIP = False
+    BULK_IMPORT_DIR = os.path.join(tempfile.gettempdir(), 'fhir-test-import')
+    BULK_IMPORT_STATE_DIR = os.path.join(tempfile.gettempdir(), 'fhir-test-import-jobs')
+    BULK_IMPORT_CHUNK_SIZE = 1000
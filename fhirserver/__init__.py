@@ -1,15 +1,26 @@
+import json
+
+import click
 from flask import Flask, make_response
 from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
 
-from config import DevelopConfig, TestConfig
-from fhirclient.models.operationoutcome import OperationOutcome, OperationOutcomeIssue
+from config import DevelopConfig, TestConfig, ProductionConfig
 from fhirserver.consts import ISSUE_SEVERITY, ISSUE_TYPE
 from fhirserver.exceptions import FHIRServerException
+from fhirserver.jobs import JobManager
+from fhirserver.cache import create_cache
+from fhirserver.search import create_missing_sort_indexes, backfill_shadow_columns
+from fhirserver.fulltext import create_missing_fulltext_indexes
+from fhirserver.pool import engine_options, set_sqlite_pragmas
+from fhirserver import metrics
+from fhirserver.profiling import ProfiledQuery
 
-db = SQLAlchemy()
+db = SQLAlchemy(query_class=ProfiledQuery)
 
-from fhirserver.resources.router import InvalidHeaderException, BaseListResource, BaseResource
+from fhirserver.replicas import ReplicaRouter, replica_binds
+from fhirserver.resources.router import InvalidHeaderException, BaseListResource, BaseResource, SystemResource, \
+    _get_resource
 
 DEVELOPMENT = 'DEV'
 TESTING = 'TEST'
@@ -18,7 +29,11 @@ PRODUCTION = 'PROD'
 
 def create_app(config):
     assert config in (DEVELOPMENT, TESTING, PRODUCTION)
+    from fhirserver.resources import RESOURCES
     from fhirserver.resources.patient import PatientResource, PatientListResource
+    from fhirserver.dao.terminology import TerminologyDAO
+    from fhirserver.resources.bulk import ExportResource, ExportStatusResource, ExportFileResource, \
+        ImportResource, ImportStatusResource, ImportErrorsResource
 
     app = Flask('FHIR Server')
 
@@ -26,11 +41,23 @@ def create_app(config):
         conf = DevelopConfig
     elif config == TESTING:
         conf = TestConfig
+    elif config == PRODUCTION:
+        conf = ProductionConfig
+        if conf.SQLALCHEMY_DATABASE_URI is None:
+            raise RuntimeError('SQLALCHEMY_DATABASE_URI must be set in production')
 
     app.config.from_object(conf)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {},
+                                          **replica_binds(app.config['DB_REPLICA_URIS']))
 
     api = Api(app)
     db.init_app(app)
+    app.extensions['jobs'] = JobManager(app, app.config['BULK_WORKERS'], app.config['BULK_JOB_EXPIRY'],
+                                        app.config['BULK_JOB_LEASE'])
+    app.extensions['resource_cache'] = create_cache(app.config)
+    app.extensions['replicas'] = ReplicaRouter(app)
+    metrics.init_app(app)
 
     with app.app_context():
         @app.teardown_appcontext
@@ -39,26 +66,74 @@ def create_app(config):
 
         @api.representation('application/fhir+json')
         def output_json(data, code, headers=None):
-            resp = make_response(data, code)
+            with metrics.phase('render'):
+                resp = make_response(data, code)
             resp.headers.extend(headers or {})
             return resp
 
         @app.errorhandler(FHIRServerException)
         def error_handler(exc):
-            op_outcome = OperationOutcome()
-            issues = []
-            for error in exc.errors:
-                issue = OperationOutcomeIssue()
-                issue.severity = error.severity
-                if error.path is not None:
-                    issue.expression = [error.path]
-                issue.code = error.code
-                issues.append(issue)
-            op_outcome.issue = issues
-            return op_outcome.as_json(), exc.http_code
+            return exc.to_operation_outcome().as_json(), exc.http_code
 
+        set_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
         db.create_all()
 
+        # the search parameters are parsed by parsers compiled once per resource type
+        app.extensions['search_parsers'] = {
+            resource_type: BaseListResource.compile_search_parser(_get_resource('{}ListResource'.format(resource_type)))
+            for resource_type in RESOURCES
+        }
+
+        @app.cli.command('create-sort-indexes')
+        def create_sort_indexes():
+            """
+            Create the composite indexes of the declared sorts that are missing in the database
+            """
+            for index_name in create_missing_sort_indexes(db.engine, db.metadata):
+                click.echo('Created index {}'.format(index_name))
+
+        @app.cli.command('create-fulltext-indexes')
+        def create_fulltext_indexes():
+            """
+            Create the full-text indexes of the tables created before them, and index the rows of the tables
+            """
+            for index_name in create_missing_fulltext_indexes(db.engine, db.metadata):
+                click.echo('Created full-text index {}'.format(index_name))
+
+        @app.cli.command('backfill-search-columns')
+        @click.option('--batch-size', default=1000, help='The number of rows updated per transaction')
+        def backfill_search_columns(batch_size):
+            """
+            Fill the normalized and phonetic search columns of the rows written before the columns were added
+            """
+            for column, count in backfill_shadow_columns(db.engine, db.metadata, batch_size).items():
+                click.echo('Backfilled {} rows of {}'.format(count, column))
+
+        @app.cli.command('load-terminology')
+        @click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+        def load_terminology(paths):
+            """
+            Load the CodeSystems and ValueSets of json files, each one with a resource or a Bundle of resources, in
+            the terminology cache of the token searches
+            """
+            resources = []
+            for path in paths:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get('resourceType') == 'Bundle':
+                    resources.extend(entry['resource'] for entry in data.get('entry', []))
+                else:
+                    resources.append(data)
+            for url, count in TerminologyDAO.load(resources).items():
+                click.echo('Loaded {} codes of {}'.format(count, url))
+
+        api.add_resource(SystemResource, '/')
+        api.add_resource(ExportResource, '/$export', '/<string:resource_type>/$export')
+        api.add_resource(ExportStatusResource, '/$export-status/<string:job_id>')
+        api.add_resource(ExportFileResource, '/$export-file/<string:job_id>/<string:file_name>')
+        api.add_resource(ImportResource, '/$import')
+        api.add_resource(ImportStatusResource, '/$import-status/<string:job_id>')
+        api.add_resource(ImportErrorsResource, '/$import-errors/<string:job_id>')
         api.add_resource(BaseListResource, '/<string:resource_type>', '/<string:resource_type>/')
         api.add_resource(BaseResource, '/<string:resource_type>/<string:resource_id>',
                          '/<string:resource_type>/<string:resource_id>/')
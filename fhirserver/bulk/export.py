@@ -0,0 +1,56 @@
+"""
+The job of the FHIR Bulk Data $export operation. The resources are streamed from the database and written in
+NDJSON files, optionally gzip compressed and split in chunks of a fixed number of resources
+"""
+import gzip
+import json
+import os
+
+
+def open_ndjson(path, compress):
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+def export_resources(job, resources, output_dir, chunk_size, compress, batch_size=1000):
+    """
+    Export the resources in NDJSON files named `<resource type>.<chunk number>.ndjson[.gz]`
+    :param job: the :class:`fhirserver.jobs.Job` running the export
+    :param resources: a list of tuples with the resource type and the list resource which exports it
+    :param output_dir: the directory where the files are written. It's created with the job, and it's not created
+        again if the job is removed while it's running
+    :param chunk_size: the maximum number of resources in a file
+    :param compress: whether to gzip the files
+    :param batch_size: the number of rows fetched at a time from the database
+    :return: the list of the exported files, each one a dict with `type`, `file` and `count`
+    """
+    extension = 'ndjson.gz' if compress else 'ndjson'
+
+    output = []
+    total = 0
+    for resource_type, resource in resources:
+        out_file = None
+        try:
+            for item in resource.export(batch_size):
+                if out_file is None or output[-1]['count'] == chunk_size:
+                    if out_file is not None:
+                        out_file.close()
+                    job.check_cancelled()
+                    file_name = '{}.{:03d}.{}'.format(resource_type, len(output), extension)
+                    out_file = open_ndjson(os.path.join(output_dir, file_name), compress)
+                    output.append({'type': resource_type, 'file': file_name, 'count': 0})
+
+                out_file.write(json.dumps(item, separators=(',', ':')))
+                out_file.write('\n')
+                output[-1]['count'] += 1
+                total += 1
+                if total % batch_size == 0:
+                    job.progress = 'Exported {} resources'.format(total)
+                    job.check_cancelled()
+        finally:
+            if out_file is not None:
+                out_file.close()
+
+    job.progress = 'Exported {} resources'.format(total)
+    return output
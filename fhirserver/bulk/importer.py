@@ -0,0 +1,191 @@
+"""
+The job of the NDJSON $import operation. The input files are parsed as a stream, one line at a time, and the
+valid resources are inserted in bulk and committed in chunks. After every commit a checkpoint with the position
+reached in the input is saved, so that an interrupted import can be resumed without inserting the same
+resources twice, unless the process dies between the commit and the save of the checkpoint.
+
+The checkpoint records the owner of the running job too, and each chunk is committed under the lock of the
+checkpoint only if the job still owns it, so that two processes never import the same chunk
+"""
+import gzip
+import json
+import os
+import time
+
+from fhirserver import db, ISSUE_TYPE, ISSUE_SEVERITY
+from fhirserver.exceptions import FHIRServerException, Error
+from fhirserver.jobs import JobCancelled, locked
+
+
+class ImportState(object):
+    """
+    The checkpoint of an import job, persisted in a json file
+    """
+
+    FIELDS = ('job_id', 'request_url', 'transaction_time', 'inputs', 'input_index', 'offset', 'line', 'errors',
+              'owner', 'heartbeat', 'error')
+
+    def __init__(self, path, job_id, request_url, transaction_time, inputs, input_index=0, offset=0, line=0,
+                 errors=0, owner=None, heartbeat=None, error=None):
+        """
+        :param path: the path of the json file
+        :param inputs: a list of dict with the `type` and `url` of the input, the local `path` of the file and the
+            `count` of the resources imported from it
+        :param input_index: the index of the input being imported
+        :param offset: the position in the input file of the first line not committed yet
+        :param line: the number of lines of the input file already committed
+        :param errors: the number of lines that were not imported
+        :param owner: the :func:`fhirserver.jobs.process_owner` of the running job, None if it's not running
+        :param heartbeat: the time, in seconds since the epoch, when the owner last saved the state
+        :param error: the error of the last run of the job, if it failed
+        """
+        self.path = path
+        self.job_id = job_id
+        self.request_url = request_url
+        self.transaction_time = transaction_time
+        self.inputs = inputs
+        self.input_index = input_index
+        self.offset = offset
+        self.line = line
+        self.errors = errors
+        self.owner = owner
+        self.heartbeat = heartbeat
+        self.error = error
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as state_file:
+            return cls(path, **json.load(state_file))
+
+    def save(self):
+        # the file is replaced atomically, so that a crash never leaves a broken checkpoint
+        self.heartbeat = time.time()
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w', encoding='utf-8') as state_file:
+            json.dump({field: getattr(self, field) for field in self.FIELDS}, state_file)
+        os.replace(tmp_path, self.path)
+
+    def locked(self):
+        """
+        :return: the context manager of the lock of the state, held to start the job and to save its checkpoints
+        """
+        return locked(self.path)
+
+    def owned(self):
+        """
+        Check, with the lock held, that the job still owns the saved state
+        :return: False if the job has been removed, or resumed by another owner
+        """
+        try:
+            return ImportState.load(self.path).owner == self.owner
+        except (OSError, ValueError):
+            return False
+
+    def release(self, error=None):
+        """
+        Save that the job is no longer running, with its :arg:`error` if it failed
+        """
+        if not os.path.exists(self.path):
+            return
+        with self.locked():
+            if self.owned():
+                self.owner = None
+                self.error = error
+                self.save()
+
+    @property
+    def errors_path(self):
+        return '{}.errors.ndjson'.format(os.path.splitext(self.path)[0])
+
+    @property
+    def imported(self):
+        return sum(input_file['count'] for input_file in self.inputs)
+
+    @property
+    def progress(self):
+        return 'Imported {} resources, {} errors'.format(self.imported, self.errors)
+
+
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _error_record(input_file, line_number, exception):
+    if not isinstance(exception, FHIRServerException):
+        # the line is not valid json
+        exception = FHIRServerException(str(exception), 400, [
+            Error(ISSUE_TYPE.STRUCTURE, None, ISSUE_SEVERITY.ERROR)
+        ])
+    return {
+        'input': input_file['url'],
+        'line': line_number,
+        'outcome': exception.to_operation_outcome().as_json()
+    }
+
+
+def import_resources(job, state, resources, chunk_size):
+    """
+    Import the resources of the input files, starting from the checkpoint in :arg:`state`
+    :param job: the :class:`fhirserver.jobs.Job` running the import
+    :param state: the :class:`ImportState` of the job
+    :param resources: a dict with the list resources which handle the input resource types
+    :param chunk_size: the number of resources inserted and committed at a time
+    """
+    while state.input_index < len(state.inputs):
+        input_file = state.inputs[state.input_index]
+        resource = resources[input_file['type']]
+
+        with open_input(input_file['path']) as in_file:
+            in_file.seek(state.offset)
+            line_number = state.line
+            items = []
+            error_records = []
+
+            def commit_chunk():
+                with state.locked():
+                    if not state.owned():
+                        raise JobCancelled
+                    if items:
+                        try:
+                            resource.bulk_post(items)
+                            db.session.commit()
+                        except Exception:
+                            db.session.rollback()
+                            raise
+                    input_file['count'] += len(items)
+                    if error_records:
+                        with open(state.errors_path, 'a', encoding='utf-8') as errors_file:
+                            for record in error_records:
+                                errors_file.write(json.dumps(record, separators=(',', ':')))
+                                errors_file.write('\n')
+                    state.errors += len(error_records)
+                    state.offset = in_file.tell()
+                    state.line = line_number
+                    state.save()
+                job.progress = state.progress
+                del items[:]
+                del error_records[:]
+
+            for raw_line in in_file:
+                line_number += 1
+                if raw_line.strip():
+                    try:
+                        items.append(resource.parse(json.loads(raw_line)))
+                    except (ValueError, FHIRServerException) as e:
+                        error_records.append(_error_record(input_file, line_number, e))
+
+                if len(items) + len(error_records) >= chunk_size:
+                    commit_chunk()
+                    job.check_cancelled()
+            commit_chunk()
+
+        with state.locked():
+            if not state.owned():
+                raise JobCancelled
+            state.input_index += 1
+            state.offset = 0
+            state.line = 0
+            state.save()
+    return state
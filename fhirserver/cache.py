@@ -0,0 +1,251 @@
+"""
+Read-through cache of the serialized resources. The cache stores the json bytes of a resource with key
+`<resource type>/<id>`, so that hot resources are read without querying the database and serializing them
+again. The bytes are preceded by a line with the `versionId` and `lastUpdated` of the resource, that are needed
+to answer conditional reads without parsing the json. The DAO invalidates the entries when it writes a resource.
+
+An invalidated entry is replaced by a tombstone for TOMBSTONE_TTL seconds, and the resources read from the
+database are only added to the cache if their key has no value, so that a read that races a write doesn't cache
+the version it read before the write. The resources read from a replica are not cached, since it can lag behind
+the primary
+"""
+import importlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+# the value of the invalidated entries, see :func:`invalidate`
+TOMBSTONE = b''
+# the seconds a tombstone is kept, longer than a read of a resource from the database
+TOMBSTONE_TTL = 10
+
+
+class BaseCache(object):
+    """
+    Interface of the cache backends. The subclasses implement :meth:`_get`, :meth:`_set`, :meth:`_add` and
+    :meth:`_delete`, while the hit and miss counters are kept here
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        if value == TOMBSTONE:
+            value = None
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: the seconds the value is kept, if not the ttl of the cache
+        """
+        self._set(key, value, ttl)
+
+    def add(self, key, value):
+        """
+        Set a key only if it has no value, nor a tombstone
+        """
+        self._add(key, value)
+
+    def delete(self, key):
+        self._delete(key)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def _add(self, key, value):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache that keeps at most :arg:`max_size` entries, evicting the least recently used ones. The entries
+    expire after :arg:`ttl` seconds
+    """
+
+    def __init__(self, max_size, ttl):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _put(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _set(self, key, value, ttl):
+        with self._lock:
+            self._put(key, value, ttl)
+
+    def _add(self, key, value):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._put(key, value, None)
+
+    def _delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        stats = super(LRUCache, self).stats()
+        stats.update({
+            'size': len(self._entries),
+            'evictions': self.evictions
+        })
+        return stats
+
+
+class SharedCache(BaseCache):
+    """
+    Cache shared by several processes, stored in a server with a Redis-like client, i.e. a client with
+    `get(key)`, `set(key, value, ex=ttl, nx=False)` and `delete(key)`
+    """
+
+    def __init__(self, client, ttl, prefix='fhir:'):
+        super(SharedCache, self).__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, ttl):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is required to use a shared resource cache')
+        return cls(redis.Redis.from_url(url), ttl)
+
+    def _get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def _set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=self.ttl if ttl is None else ttl)
+
+    def _add(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl, nx=True)
+
+    def _delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def create_cache(config):
+    """
+    Create the resource cache configured by RESOURCE_CACHE, that can be `lru`, `shared` or the dotted path of a
+    :class:`BaseCache` subclass that accepts the app configuration. If it's None or empty, there is no cache
+    """
+    backend = config['RESOURCE_CACHE']
+    if not backend:
+        return None
+    if backend == 'lru':
+        return LRUCache(config['RESOURCE_CACHE_SIZE'], config['RESOURCE_CACHE_TTL'])
+    if backend == 'shared':
+        return SharedCache.from_url(config['RESOURCE_CACHE_URL'], config['RESOURCE_CACHE_TTL'])
+    module_name, class_name = backend.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)(config)
+
+
+CachedResource = namedtuple('CachedResource', ('body', 'version_id', 'last_updated'))
+
+
+def _get_cache():
+    return current_app.extensions.get('resource_cache')
+
+
+def _key(resource_type, resource_id):
+    return '{}/{}'.format(resource_type, resource_id)
+
+
+def _pack(resource):
+    header = json.dumps([resource.version_id, resource.last_updated], separators=(',', ':'))
+    return header.encode('utf-8') + b'\n' + resource.body
+
+
+def _unpack(value):
+    header, body = value.split(b'\n', 1)
+    version_id, last_updated = json.loads(header.decode('utf-8'))
+    return CachedResource(body, version_id, last_updated)
+
+
+def lookup(resource_type, resource_id):
+    """
+    :return: the :class:`CachedResource` of a resource or None if it's not in the cache
+    """
+    cache = _get_cache()
+    if cache is None:
+        return None
+    value = cache.get(_key(resource_type, resource_id))
+    return _unpack(value) if value is not None else None
+
+
+def serialize(data):
+    """
+    :return: the :class:`CachedResource` of the json of a resource
+    """
+    meta = data.get('meta', {})
+    return CachedResource(json.dumps(data, separators=(',', ':')).encode('utf-8'),
+                          meta.get('versionId'), meta.get('lastUpdated'))
+
+
+def store(resource_type, resource_id, data):
+    """
+    Serialize the json of a resource read from the primary and add it to the cache, unless it was invalidated
+    since it was read
+    :return: the :class:`CachedResource` of the resource
+    """
+    resource = serialize(data)
+    cache = _get_cache()
+    if cache is not None:
+        cache.add(_key(resource_type, resource_id), _pack(resource))
+    return resource
+
+
+def invalidate(resource_type, *resources_ids):
+    """
+    Replace the entries of the resources with tombstones, so that the reads that started before the write don't
+    add them again
+    """
+    cache = _get_cache()
+    if cache is not None:
+        for resource_id in resources_ids:
+            cache.set(_key(resource_type, resource_id), TOMBSTONE, TOMBSTONE_TTL)
@@ -0,0 +1,113 @@
+"""
+Helpers for conditional requests. A resource is validated by its `meta.versionId`, sent as a weak ETag, and by
+its `meta.lastUpdated`, sent as Last-Modified. When the validators sent by the client in If-None-Match or
+If-Modified-Since still match, the server answers 304 Not Modified with an empty body
+"""
+from datetime import datetime, timezone
+
+from flask import request, Response
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+
+from fhirserver import cache
+from fhirserver.exceptions import NotFoundException
+from fhirserver.replicas import reads_from_replica
+
+
+def format_instant(value):
+    """
+    Format a naive UTC datetime as a FHIR instant
+    """
+    return '{}Z'.format(value.isoformat(timespec='milliseconds'))
+
+
+def parse_instant(value):
+    """
+    Parse a FHIR instant in a naive UTC datetime, as the ones stored in the database
+    """
+    instant = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if instant.tzinfo is not None:
+        instant = instant.astimezone(timezone.utc).replace(tzinfo=None)
+    return instant
+
+
+def collection_version(total, versions, last_updated):
+    """
+    The version of a collection of resources, used as weak ETag of a search. It changes when a resource is added
+    to or removed from the collection, or updated, also when a resource leaves the collection while another one
+    with the same version enters it, since that one is the last updated
+    :param total: the number of resources
+    :param versions: the sum of their `versionId`
+    :param last_updated: the greatest of their `lastUpdated`, a naive UTC datetime
+    """
+    instant = last_updated.strftime('%Y%m%d%H%M%S%f') if last_updated is not None else '0'
+    return '{}-{}-{}'.format(total, versions or 0, instant)
+
+
+def is_conditional():
+    return 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+
+
+def validators(version, last_updated):
+    """
+    :param version: the version of the resource or of the collection, used as weak ETag
+    :param last_updated: a naive UTC datetime or a FHIR instant
+    :return: a dict with the ETag and Last-Modified headers
+    """
+    if isinstance(last_updated, str):
+        last_updated = parse_instant(last_updated)
+    headers = {}
+    if version is not None:
+        headers['ETag'] = quote_etag(version, weak=True)
+    if last_updated is not None:
+        headers['Last-Modified'] = http_date(last_updated)
+    return headers
+
+
+def not_modified(version, last_updated):
+    """
+    Check the conditional headers of the request
+    :return: a 304 response if the client has the current version, otherwise None
+    """
+    if isinstance(last_updated, str):
+        last_updated = parse_instant(last_updated)
+    if version is None and last_updated is None:
+        return None
+    if is_resource_modified(request.environ, etag=version, last_modified=last_updated):
+        return None
+    return Response(status=304, headers=validators(version, last_updated))
+
+
+def conditional_read(resource_type, resource_id, load, load_version):
+    """
+    Read a resource through the resource cache, answering 304 if the client has the current version. When the
+    resource is not cached, the version is checked with :arg:`load_version` first, so that the resource is loaded
+    and serialized only if it has to be sent
+    :param load: a function that returns the json of the resource or None if it doesn't exist
+    :param load_version: a function that returns a tuple with the version id and the last update time of the
+        resource or None if it doesn't exist
+    :return: the response with the json of the resource or a 304 response
+    """
+    resource = cache.lookup(resource_type, resource_id)
+    if resource is None and is_conditional():
+        version = load_version()
+        if version is None:
+            raise NotFoundException
+        response = not_modified(*version)
+        if response is not None:
+            return response
+
+    if resource is None:
+        data = load()
+        if data is None:
+            raise NotFoundException
+        # a replica can lag behind the primary, so the resources read from it are not cached
+        if reads_from_replica():
+            resource = cache.serialize(data)
+        else:
+            resource = cache.store(resource_type, resource_id, data)
+
+    response = not_modified(resource.version_id, resource.last_updated)
+    if response is not None:
+        return response
+    return Response(resource.body, 200, validators(resource.version_id, resource.last_updated),
+                    mimetype='application/fhir+json')
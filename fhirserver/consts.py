@@ -20,3 +20,18 @@ class ISSUE_TYPE:
     DUPLICATE = 'duplicate'
     MULTIPLE_MATCHES = 'multiple-matches'
     NOT_FOUND = 'not-found'
+    TOO_COSTLY = 'too-costly'
+
+    EXCEPTION = 'exception'
+
+
+class SEARCH_SUMMARY:
+    TRUE = 'true'
+    COUNT = 'count'
+    FALSE = 'false'
+
+
+class SEARCH_TOTAL:
+    NONE = 'none'
+    ESTIMATE = 'estimate'
+    ACCURATE = 'accurate'
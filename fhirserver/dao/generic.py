@@ -0,0 +1,510 @@
+"""
+Generic storage of the resources. Every resource is stored whole, as json, in the `resources` table, so that no
+element is lost and a new resource type doesn't need its own model. The values of the search parameters are
+extracted from the resources when they are written, following the extraction rules of the
+:class:`ResourceDefinition` of the resource type, and stored in an index table for each type of parameter. The
+searches filter the resources only through the index tables
+"""
+import html
+import importlib
+import re
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from dateutil.parser import isoparse
+from sqlalchemy import Column, String, Text, DateTime, Integer, Float, Index, ForeignKeyConstraint, JSON, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import validates
+
+from fhirclient.models.fhirabstractbase import FHIRValidationError
+from fhirserver import db, cache
+from fhirserver.consts import SEARCH_TOTAL
+from fhirserver.conditional import format_instant
+from fhirserver.dao.patient import SUBSETTED_TAG
+from fhirserver.exceptions import InvalidBodyException, InvalidElementException
+from fhirserver.fulltext import FullTextIndex
+from fhirserver.pagination import search_page
+from fhirserver.replicas import read_session, mark_write
+from fhirserver.parser_types import FHIRSearchTypes, _date_range
+from fhirserver.search import SearchRegistry, ColumnParameter, IndexParameter, TokenIndexParameter, \
+    TextIndexParameter, QuantityIndexParameter, normalized_column, shadow_values
+from fhirserver.ucum import unit_key
+
+
+class ResourceModel(db.Model):
+    __tablename__ = 'resources'
+    resource_type = Column(String(64), primary_key=True)
+    id = Column(String(64), primary_key=True)
+    version_id = Column(Integer(), nullable=False, default=1)
+    last_updated = Column(DateTime(), nullable=False)
+    # JSONB on PostgreSQL, a json text handled by the JSON1 functions on SQLite
+    data = Column(JSON().with_variant(JSONB(), 'postgresql'), nullable=False)
+
+    __table_args__ = (
+        Index('ix_resources_last_updated', resource_type, last_updated),
+    )
+
+
+def _index_table_args(table_name, *value_columns):
+    """
+    :param value_columns: the columns or expressions of the values searched through a B-tree index, if any
+    """
+    args = (
+        ForeignKeyConstraint(('resource_type', 'resource_id'), ('resources.resource_type', 'resources.id'),
+                             ondelete='CASCADE'),
+        Index('ix_{}_resource'.format(table_name), 'resource_type', 'resource_id'),
+    )
+    if value_columns:
+        args += (Index('ix_{}_value'.format(table_name), 'resource_type', 'name', *value_columns),)
+    return args
+
+
+class StringIndexModel(db.Model):
+    __tablename__ = 'search_strings'
+    id = Column(Integer(), primary_key=True)
+    resource_type = Column(String(64), nullable=False)
+    resource_id = Column(String(64), nullable=False)
+    name = Column(String(64), nullable=False)
+    value = Column(String(200), nullable=False)
+    # the default string search ignores case, accents and spacing, so the normalized values are indexed
+    normalized = normalized_column('value', 200, index=False)
+
+    __table_args__ = _index_table_args(__tablename__, normalized)
+
+    @validates('value')
+    def _update_shadow_columns(self, key, value):
+        for name, encoded in shadow_values(self.__table__, key, value).items():
+            setattr(self, name, encoded)
+        return value
+
+
+class TokenIndexModel(db.Model):
+    __tablename__ = 'search_tokens'
+    id = Column(Integer(), primary_key=True)
+    resource_type = Column(String(64), nullable=False)
+    resource_id = Column(String(64), nullable=False)
+    name = Column(String(64), nullable=False)
+    system = Column(String(200), nullable=True)
+    code = Column(String(200), nullable=False)
+
+    # the codes are searched in IN lists, each one with its system or with any system
+    __table_args__ = _index_table_args(__tablename__, code, system)
+
+
+class TextIndexModel(db.Model):
+    __tablename__ = 'search_texts'
+    id = Column(Integer(), primary_key=True)
+    resource_type = Column(String(64), nullable=False)
+    resource_id = Column(String(64), nullable=False)
+    name = Column(String(64), nullable=False)
+    value = Column(Text(), nullable=False)
+
+    # the texts are searched only by words, with the full-text index
+    __table_args__ = _index_table_args(__tablename__)
+
+
+class DateIndexModel(db.Model):
+    __tablename__ = 'search_dates'
+    id = Column(Integer(), primary_key=True)
+    resource_type = Column(String(64), nullable=False)
+    resource_id = Column(String(64), nullable=False)
+    name = Column(String(64), nullable=False)
+    # the range of the date, as naive UTC datetimes: its start and its end, not included
+    value = Column(DateTime(), nullable=False)
+    high = Column(DateTime(), nullable=False)
+
+    # the prefixes of the search compare either bound, so each one starts an index
+    __table_args__ = _index_table_args(__tablename__, value, high) + (
+        Index('ix_search_dates_high', resource_type, name, high),
+    )
+
+
+class NumberIndexModel(db.Model):
+    __tablename__ = 'search_numbers'
+    id = Column(Integer(), primary_key=True)
+    resource_type = Column(String(64), nullable=False)
+    resource_id = Column(String(64), nullable=False)
+    name = Column(String(64), nullable=False)
+    # the bounds of the value, included, that are equal for a number and infinite for the open side of a Range
+    value = Column(Float(), nullable=False)
+    high = Column(Float(), nullable=False)
+
+    # the prefixes of the search compare either bound, so each one starts an index
+    __table_args__ = _index_table_args(__tablename__, value, high) + (
+        Index('ix_search_numbers_high', resource_type, name, high),
+    )
+
+
+class QuantityIndexModel(db.Model):
+    __tablename__ = 'search_quantities'
+    id = Column(Integer(), primary_key=True)
+    resource_type = Column(String(64), nullable=False)
+    resource_id = Column(String(64), nullable=False)
+    name = Column(String(64), nullable=False)
+    system = Column(String(200), nullable=True)
+    code = Column(String(200), nullable=True)
+    value = Column(Float(), nullable=False)
+    # the key of the unit and the value converted to it, see :func:`fhirserver.ucum.unit_key`
+    unit = Column(String(255), nullable=True)
+    canonical_value = Column(Float(), nullable=True)
+
+    # the quantities are searched with a unit in the canonical unit, and without a unit by their value
+    __table_args__ = _index_table_args(__tablename__, unit, canonical_value) + (
+        Index('ix_search_quantities_number', resource_type, name, value),
+    )
+
+
+# the full-text indexes of the string values, for `:contains`, and of the texts, for `_content`, `_text` and `:text`
+STRINGS_FULLTEXT = FullTextIndex(StringIndexModel.__table__, ('value',))
+TEXTS_FULLTEXT = FullTextIndex(TextIndexModel.__table__, ('value',))
+
+# the names of the index rows of the whole text of a resource, of its narrative and of the tags of its meta
+CONTENT = '_content'
+NARRATIVE = '_text'
+TAG = '_tag'
+
+
+def extract(resource, path):
+    """
+    Extract the values of the elements of a resource selected by a FHIRPath-like expression: a path of element
+    names separated by dots, e.g. `name.given`, or the union of several paths separated by `|`. The arrays are
+    flattened, so that the result is the list of all the values found
+    :param resource: the json of the resource
+    :param path: the expression
+    :return: the list of the values
+    """
+    values = []
+    for alternative in path.split('|'):
+        nodes = [resource]
+        for element in alternative.strip().split('.'):
+            children = []
+            for node in nodes:
+                if isinstance(node, dict) and element in node:
+                    value = node[element]
+                    children.extend(value if isinstance(value, list) else [value])
+            nodes = children
+        values.extend(nodes)
+    return values
+
+
+# the elements of the complex types (HumanName, Address...) searched by a string parameter
+STRING_ELEMENTS = ('text', 'family', 'given', 'prefix', 'suffix', 'line', 'city', 'district', 'state',
+                   'postalCode', 'country')
+
+
+def _strings(node):
+    if isinstance(node, str):
+        return [node]
+    if isinstance(node, dict):
+        return [value for element in STRING_ELEMENTS for value in _strings_list(node.get(element))]
+    return []
+
+
+def _strings_list(value):
+    values = value if isinstance(value, list) else [value]
+    return [string for item in values for string in _strings(item)]
+
+
+def _tokens(node):
+    """
+    :return: a list of tuples with the system and the code of the tokens of a code, Coding, CodeableConcept,
+        Identifier, ContactPoint or boolean
+    """
+    if isinstance(node, bool):
+        return [(None, 'true' if node else 'false')]
+    if isinstance(node, str):
+        return [(None, node)]
+    if isinstance(node, dict):
+        if 'coding' in node:
+            return [token for coding in node['coding'] for token in _tokens(coding)]
+        if 'code' in node:
+            return [(node.get('system'), node['code'])]
+        if 'value' in node:
+            return [(node.get('system'), str(node['value']))]
+    return []
+
+
+def _token_texts(node):
+    """
+    :return: the texts of a Coding or CodeableConcept, searched by the `:text` modifier
+    """
+    if not isinstance(node, dict):
+        return []
+    texts = [node['text']] if 'text' in node else []
+    if 'display' in node:
+        texts.append(node['display'])
+    return texts + [text for coding in node.get('coding', []) for text in _token_texts(coding)]
+
+
+def _content(node):
+    """
+    :return: all the strings of the elements of a resource, except its id, meta and narrative
+    """
+    if isinstance(node, str):
+        return [node]
+    if isinstance(node, dict):
+        return [string for key, value in node.items() if key not in ('resourceType', 'id', 'meta', 'text')
+                for string in _content(value)]
+    if isinstance(node, list):
+        return [string for item in node for string in _content(item)]
+    return []
+
+
+def _narrative(resource):
+    """
+    :return: the text of the narrative of a resource, without the xhtml markup
+    """
+    div = resource.get('text', {}).get('div')
+    if not div:
+        return None
+    return ' '.join(html.unescape(re.sub(r'<[^>]*>', ' ', div)).split())
+
+
+def _numbers(node):
+    """
+    :return: the bounds of a decimal, integer or Range
+    """
+    if isinstance(node, (int, float)) and not isinstance(node, bool):
+        return [{'value': float(node), 'high': float(node)}]
+    if isinstance(node, dict) and ('low' in node or 'high' in node):
+        return [{'value': float(node.get('low', {}).get('value', float('-inf'))),
+                 'high': float(node.get('high', {}).get('value', float('inf')))}]
+    return []
+
+
+def _quantities(node):
+    """
+    :return: the value and the unit of a Quantity, with the value converted to the canonical unit
+    """
+    if not isinstance(node, dict) or not isinstance(node.get('value'), (int, float)):
+        return []
+    columns = {'system': node.get('system'), 'code': node.get('code'), 'value': float(node['value']), 'unit': None,
+               'canonical_value': None}
+    key = unit_key(node.get('system'), node.get('code'))
+    if key is not None:
+        unit, factor = key
+        columns.update(unit=unit, canonical_value=float(Decimal(str(node['value'])) * factor))
+    return [columns]
+
+
+def _dates(node):
+    """
+    :return: the range of a date, dateTime, instant or Period, as naive UTC datetimes. The range of a date is
+        implied by its precision, e.g. the whole month for 2020-01, while a Period starts with the range of its
+        start and ends with the range of its end, and it's open on the side of a missing bound
+    """
+    if isinstance(node, str):
+        start, end = _date_range(node, isoparse(node))
+        return [{'value': start, 'high': end}]
+    if isinstance(node, dict) and ('start' in node or 'end' in node):
+        start = _date_range(node['start'], isoparse(node['start']))[0] if 'start' in node else datetime.min
+        end = _date_range(node['end'], isoparse(node['end']))[1] if 'end' in node else datetime.max
+        return [{'value': start, 'high': end}]
+    return []
+
+
+class ResourceDefinition(object):
+    """
+    The definition of a resource type stored by the generic resource store
+    """
+
+    # the index table and the extraction function of each type of search parameter
+    INDEXES = {
+        FHIRSearchTypes.STRING: (StringIndexModel, IndexParameter, _strings),
+        FHIRSearchTypes.TOKEN: (TokenIndexModel, TokenIndexParameter, _tokens),
+        FHIRSearchTypes.DATE: (DateIndexModel, IndexParameter, _dates),
+        FHIRSearchTypes.NUMBER: (NumberIndexModel, IndexParameter, _numbers),
+        FHIRSearchTypes.QUANTITY: (QuantityIndexModel, QuantityIndexParameter, _quantities),
+    }
+
+    def __init__(self, resource_type, search_parameters, summary_elements=None):
+        """
+        :param resource_type: the name of the resource type, that must have a fhirclient model
+        :param search_parameters: a dict that maps the name of each search parameter to a tuple with its
+            :class:`FHIRSearchTypes` and the expression of the elements it indexes, see :func:`extract`
+        :param summary_elements: the elements of the resource that are part of its summary. If they are not
+            given, `_summary=true` returns the whole resources
+        """
+        for typ, _ in search_parameters.values():
+            if typ not in self.INDEXES:
+                raise ValueError('Unsupported search parameter type {}'.format(typ))
+        self.resource_type = resource_type
+        self.search_parameters = search_parameters
+        self.summary_elements = summary_elements
+        module = importlib.import_module('fhirclient.models.{}'.format(resource_type.lower()))
+        self.model = getattr(module, resource_type)
+
+    def index_rows(self, resource):
+        """
+        Extract the values of the search parameters of a resource
+        :param resource: a :class:`ResourceModel`
+        :return: the list of the rows of the index tables
+        """
+        rows = []
+
+        def add_text(name, text):
+            rows.append(TextIndexModel(resource_type=self.resource_type, resource_id=resource.id, name=name,
+                                       value=text))
+
+        for name, (typ, path) in self.search_parameters.items():
+            index, _, values = self.INDEXES[typ]
+            for node in extract(resource.data, path):
+                for value in values(node):
+                    if typ == FHIRSearchTypes.TOKEN:
+                        columns = {'system': value[0], 'code': value[1]}
+                    elif isinstance(value, dict):
+                        columns = value
+                    else:
+                        columns = {'value': value}
+                    rows.append(index(resource_type=self.resource_type, resource_id=resource.id, name=name,
+                                      **columns))
+                if typ == FHIRSearchTypes.TOKEN:
+                    for text in _token_texts(node):
+                        add_text(name, text)
+        for system, code in _tokens({'coding': resource.data.get('meta', {}).get('tag', [])}):
+            rows.append(TokenIndexModel(resource_type=self.resource_type, resource_id=resource.id, name=TAG,
+                                        system=system, code=code))
+        # the whole text of the resource is a single row, so that a resource matches if it has all the words
+        content = ' '.join(_content(resource.data))
+        if content:
+            add_text(CONTENT, content)
+        narrative = _narrative(resource.data)
+        if narrative:
+            add_text(NARRATIVE, narrative)
+        return rows
+
+    def registry(self):
+        """
+        :return: the :class:`SearchRegistry` of the search parameters of the resource type
+        """
+        parameters = {
+            'content': TextIndexParameter(TextIndexModel, self.resource_type, CONTENT, ResourceModel.id),
+            'id': ColumnParameter(ResourceModel.id),
+            'lastUpdated': ColumnParameter(ResourceModel.last_updated),
+            'tag': TokenIndexParameter(TokenIndexModel, self.resource_type, TAG, ResourceModel.id),
+            'text': TextIndexParameter(TextIndexModel, self.resource_type, NARRATIVE, ResourceModel.id),
+        }
+        for name, (typ, _) in self.search_parameters.items():
+            index, parameter, _ = self.INDEXES[typ]
+            if typ == FHIRSearchTypes.TOKEN:
+                texts = TextIndexParameter(TextIndexModel, self.resource_type, name, ResourceModel.id)
+                parameters[name] = parameter(index, self.resource_type, name, ResourceModel.id, texts)
+            else:
+                parameters[name] = parameter(index, self.resource_type, name, ResourceModel.id)
+        return SearchRegistry(parameters)
+
+
+def subset(data, elements):
+    """
+    Reduce the json of a resource to the given elements, plus the mandatory `id` and `meta`, marking it with the
+    SUBSETTED tag. The name of a choice element, e.g. `value`, selects all its types, e.g. `valueQuantity`
+    """
+    def selected(key):
+        return any(key == element or (key.startswith(element) and key[len(element):len(element) + 1].isupper())
+                   for element in elements)
+
+    result = {key: value for key, value in data.items() if key in ('resourceType', 'id') or selected(key)}
+    result['meta'] = dict(data.get('meta', {}), tag=[SUBSETTED_TAG])
+    return result
+
+
+class GenericDAO(object):
+    """
+    The DAO of a resource type stored by the generic resource store
+    """
+
+    def __init__(self, definition):
+        """
+        :param definition: the :class:`ResourceDefinition` of the resource type
+        """
+        self.definition = definition
+        self.resource_type = definition.resource_type
+        self.search_parameters = definition.registry()
+
+    def _query(self, *columns):
+        return read_session().query(*columns).filter(ResourceModel.resource_type == self.resource_type)
+
+    def get(self, resource_id):
+        resource = self._query(ResourceModel.data).filter(ResourceModel.id == resource_id).first()
+        return resource.data if resource is not None else None
+
+    def get_version(self, resource_id):
+        """
+        :return: a tuple with the versionId and the lastUpdated datetime or None if the resource doesn't exist
+        """
+        version = self._query(ResourceModel.version_id, ResourceModel.last_updated) \
+            .filter(ResourceModel.id == resource_id).first()
+        if version is not None:
+            return str(version.version_id), version.last_updated
+        return None
+
+    def search_query(self, query_args, *columns):
+        return self._query(*columns).filter(*self.search_parameters.conditions(query_args))
+
+    def count(self, query_args):
+        return self.search_query(query_args, func.count()).scalar()
+
+    def search(self, query_args, count, cursor=None, sort=None, total=SEARCH_TOTAL.ACCURATE, elements=None):
+        """
+        Search the resources matching the query parameters and return a page of at most :arg:`count` results,
+        as :meth:`fhirserver.dao.patient.PatientDAO.search`. Only the `_id` and `_lastUpdated` can be used to
+        sort the results, since the other parameters can have several values
+        :return: a :class:`fhirserver.pagination.Page` of resources json
+        """
+        def search_query(keys):
+            return self.search_query(query_args, ResourceModel.id, ResourceModel.last_updated, ResourceModel.data)
+
+        return search_page(ResourceModel, self.search_parameters, query_args, search_query,
+                           lambda row: row.data if elements is None else subset(row.data, elements),
+                           count, cursor, sort, total)
+
+    def iter_all(self, batch_size):
+        query = self._query(ResourceModel.data).order_by(ResourceModel.id)
+        return (row.data for row in query.yield_per(batch_size))
+
+    def parse(self, data):
+        """
+        Validate the json of a resource and convert it in a model ready to be stored, with a new id and meta
+        :return: a :class:`ResourceModel`
+        """
+        if not isinstance(data, dict) or data.get('resourceType', self.resource_type) != self.resource_type:
+            raise InvalidElementException("The resource is not a {}".format(self.resource_type), 'resourceType')
+        try:
+            data = self.definition.model(data).as_json()
+        except FHIRValidationError as e:
+            raise InvalidBodyException(e)
+
+        resource = ResourceModel(resource_type=self.resource_type, id=uuid.uuid4().hex, version_id=1,
+                                 last_updated=datetime.utcnow())
+        data['id'] = resource.id
+        data['meta'] = dict(data.get('meta', {}), versionId=str(resource.version_id),
+                            lastUpdated=format_instant(resource.last_updated))
+        resource.data = data
+        return resource
+
+    def create(self, resource):
+        """
+        :param resource: a :class:`ResourceModel` returned by :meth:`parse`
+        """
+        db.session.add(resource)
+        # the models are not related, so the resource is flushed before the index rows that reference it
+        db.session.flush()
+        db.session.add_all(self.definition.index_rows(resource))
+        db.session.commit()
+        mark_write()
+        cache.invalidate(self.resource_type, resource.id)
+        return resource.data
+
+    def bulk_create(self, resources):
+        """
+        Insert several resources, and their index rows, with bulk inserts. The transaction is not committed, see
+        :meth:`fhirserver.dao.patient.PatientDAO.bulk_create`
+        :param resources: a list of :class:`ResourceModel` returned by :meth:`parse`
+        :return: the list of the ids of the new resources
+        """
+        db.session.bulk_save_objects(resources)
+        db.session.bulk_save_objects([row for resource in resources for row in self.definition.index_rows(resource)])
+        resources_ids = [resource.id for resource in resources]
+        cache.invalidate(self.resource_type, *resources_ids)
+        return resources_ids
@@ -1,87 +1,329 @@
 import uuid
 from datetime import datetime
 
-from sqlalchemy import Column, String, Date, Boolean, DateTime
+from sqlalchemy import Column, String, Date, Boolean, DateTime, Integer, func
+from sqlalchemy.orm import load_only, validates
 
+from fhirclient.models.fhirabstractbase import FHIRValidationError
 from fhirclient.models.patient import Patient
-from fhirserver import db
+from fhirserver import db, ISSUE_TYPE, cache
+from fhirserver.consts import SEARCH_TOTAL
+from fhirserver.fulltext import FullTextIndex
+from fhirserver.search import SearchRegistry, ColumnParameter, AnyColumnParameter, FullTextParameter, SCORE, \
+    PhoneticParameter, sort_indexes, normalized_column, shadow_column, shadow_values
+from fhirserver.conditional import format_instant
+from fhirserver.exceptions import InvalidBodyException, InvalidElementException
+from fhirserver.pagination import search_page
+from fhirserver.phonetic import SOUNDEX_LENGTH, soundex, first_name_soundex
+from fhirserver.replicas import read_session, mark_write
+
+
+GENDERS = {'m': 'male', 'f': 'female', 'u': 'unknown', 'o': 'other'}
+
+
+# the tag of the resources returned without some of their elements, e.g. because of `_elements` or `_summary`
+SUBSETTED_TAG = {'system': 'http://terminology.hl7.org/CodeSystem/v3-ObservationValue', 'code': 'SUBSETTED'}
+
+
+def _name(row):
+    return [{
+        'given': row.given_name.split(' '),
+        'family': row.family_name
+    }]
+
+
+# the FHIR elements stored in the patients table: the names of their columns and the function that maps the
+# values of the columns to the json of the element, or None if the element has no value
+ELEMENTS = {
+    'identifier': (('identifier',), lambda row: [{'value': row.identifier}] if row.identifier is not None else None),
+    'name': (('given_name', 'family_name'), _name),
+    'gender': (('gender',), lambda row: GENDERS[row.gender]),
+    'birthDate': (('birthdate',), lambda row: row.birthdate.isoformat() if row.birthdate is not None else None),
+    'address': (('address',), lambda row: [{'text': row.address}] if row.address is not None else None),
+}
+
+
+def patient_to_json(row, elements=None):
+    """
+    Map the column values of a patient straight to its FHIR json representation, without building and
+    validating a fhirclient Patient. Since the data come from our own database they are trusted. The output is
+    the same of `Patient.as_json()`, so elements without a value are omitted
+    :param row: a :class:`PatientModel` or a row with the columns of the patients table
+    :param elements: the names of the elements to include, or None for the whole resource. The `id` and `meta`
+        are always included, and the subset is marked with the SUBSETTED tag. Only the columns of the included
+        elements are read from :arg:`row`
+    :return: a dict with the FHIR Patient
+    """
+    data = {
+        'resourceType': 'Patient',
+        'id': row.id,
+        'meta': {
+            'versionId': str(row.version_id),
+            'lastUpdated': format_instant(row.last_updated)
+        }
+    }
+    if elements is not None:
+        data['meta']['tag'] = [SUBSETTED_TAG]
+    for element, (_, to_json) in ELEMENTS.items():
+        if elements is None or element in elements:
+            value = to_json(row)
+            if value is not None:
+                data[element] = value
+    return data
+
+
+def stored_columns():
+    """
+    :return: the names of the columns of the patients table that store the resource, i.e. all except the shadow
+        columns of the searches
+    """
+    return [column.name for column in PatientModel.__table__.columns if not column.info.get('shadow')]
+
+
+def element_columns(elements):
+    """
+    :param elements: the names of the elements of a subset of a Patient, or None for the whole resource
+    :return: the names of the columns needed to serialize the elements with :func:`patient_to_json`
+    """
+    if elements is None:
+        return stored_columns()
+    names = ['id', 'version_id', 'last_updated']
+    for element in elements:
+        # the elements that are not stored can't be returned, so they are ignored
+        names.extend(ELEMENTS.get(element, ((),))[0])
+    return names
 
 
 class PatientModel(db.Model):
     __tablename__ = 'patients'
     id = Column(String(32), primary_key=True)
     identifier = Column(String(32), nullable=True)
-    active = Column(Boolean(), default=True)
+    active = Column(Boolean(), default=True, index=True)
     given_name = Column(String(50), nullable=None)
     family_name = Column(String(120), nullable=None)
-    gender = Column(String(1), nullable=None)
-    address = Column(String(100), nullable=True)
+    gender = Column(String(1), nullable=None, index=True)
+    address = Column(String(100), nullable=True, index=True)
     birthdate = Column(Date())
+    version_id = Column(Integer(), nullable=False, default=1)
+    last_updated = Column(DateTime(), nullable=False)
+
+    # the default string search ignores case, accents and spacing, so it's served by the indexes of the normalized
+    # values. The other searched columns are indexed by the sort indexes of `PatientDAO.SORTS`
+    given_name_normalized = normalized_column('given_name', 50)
+    family_name_normalized = normalized_column('family_name', 120)
+    address_normalized = normalized_column('address', 100)
+    # the keys of the phonetic search, of the whole family name and of the first given name
+    given_name_phonetic = shadow_column('given_name', first_name_soundex, String(SOUNDEX_LENGTH))
+    family_name_phonetic = shadow_column('family_name', soundex, String(SOUNDEX_LENGTH))
 
     def __init__(self, id=None, identifier=None, given_name=None, family_name=None,
-                 gender=None, birthdate=None, address=None):
+                 gender=None, birthdate=None, address=None, version_id=None, last_updated=None):
         self.id = uuid.uuid4().hex if id is None else id
+        self.identifier = identifier
         self.active = True
         self.given_name = given_name
         self.family_name = family_name
         self.gender = gender
         self.address = address
         # gets only the date from birthdate if it's a datetime
-        self.birthdate = birthdate.date() if birthdate is not None else None
+        self.birthdate = birthdate.date() if isinstance(birthdate, datetime) else birthdate
+        self.version_id = 1 if version_id is None else version_id
+        # the server time, in UTC, when the resource was stored
+        self.last_updated = datetime.utcnow() if last_updated is None else last_updated
+
+    @validates('given_name', 'family_name', 'address')
+    def _update_shadow_columns(self, key, value):
+        for name, encoded in shadow_values(self.__table__, key, value).items():
+            setattr(self, name, encoded)
+        return value
 
     @classmethod
     def from_fhir_res(cls, patient):
-        given_name = ' '.join(given.value for given in patient.name[0].given)
-        family_name = patient.name[0].family.value
-        gender = {'male': 'm', 'female': 'f', 'unknown': 'u', 'other': 'o'}[patient.gender.value.lower()]
-        birthdate = datetime.fromisoformat(patient.birthDate.isostring)
-        address = patient.address[0].text.value if patient.address is not None else None
-        return PatientModel(given_name=given_name, family_name=family_name, gender=gender, birthdate=birthdate,
-                            address=address)
+        # name and gender are mandatory in our model
+        for element in ('name', 'gender'):
+            if getattr(patient, element) is None:
+                raise InvalidElementException("Missing {}".format(element), element, ISSUE_TYPE.REQUIRED)
+        # only the first name is stored, so it must have both the given and the family names
+        for element in ('given', 'family'):
+            if not getattr(patient.name[0], element):
+                raise InvalidElementException("Missing name.{}".format(element), 'name[0].{}'.format(element),
+                                              ISSUE_TYPE.REQUIRED)
+        codes = {value: key for key, value in GENDERS.items()}
+        if patient.gender.lower() not in codes:
+            raise InvalidElementException("Unknown gender {}".format(patient.gender), 'gender', ISSUE_TYPE.VALUE)
+        given_name = ' '.join(patient.name[0].given)
+        family_name = patient.name[0].family
+        gender = codes[patient.gender.lower()]
+        birthdate = patient.birthDate.date if patient.birthDate is not None else None
+        address = patient.address[0].text if patient.address is not None else None
+        identifier = patient.identifier[0].value if patient.identifier is not None else None
+        return PatientModel(identifier=identifier, given_name=given_name, family_name=family_name, gender=gender,
+                            birthdate=birthdate, address=address)
+
+    def to_json(self):
+        return patient_to_json(self)
 
     def to_fhir_res(self):
-        data = {
-            'id': self.id,
-            'identifier': [{
-                'value': self.identifier
-            }],
-            'name': [{
-                'given': self.given_name.split(' '),
-                'family': self.family_name
-            }],
-            'gender': {'m': 'male', 'f': 'female', 'u': 'unknown', 'o': 'other'}[self.gender],
-            'birthDate': self.birthdate.isoformat() if self.birthdate is not None else None,
-            'address': [{
-                'text': self.address
-            }]
-        }
-        return Patient(data)
+        return Patient(self.to_json())
 
     def __repr__(self):
         return f'<Patient {self.give_name} {self.family_name}>'
 
 
+# the full-text index of the texts of the patients, for `:contains` and `_content`
+PATIENTS_FULLTEXT = FullTextIndex(PatientModel.__table__, ('given_name', 'family_name', 'address', 'identifier'))
+
+
 class PatientDAO(object):
+    # when enabled, the rows are read as plain tuples and serialized directly with :func:`patient_to_json`,
+    # skipping the construction of ORM and fhirclient objects
+    DIRECT_SERIALIZATION = True
+
+    # the columns that store the values of the search parameters, by destination name of the parsed parameter
+    SEARCH_PARAMETERS = SearchRegistry({
+        'content': FullTextParameter(PATIENTS_FULLTEXT),
+        'id': ColumnParameter(PatientModel.id),
+        'lastUpdated': ColumnParameter(PatientModel.last_updated),
+        'active': ColumnParameter(PatientModel.active, codes={'true': True, 'false': False}),
+        'address': ColumnParameter(PatientModel.address, normalized=PatientModel.address_normalized),
+        'birthdate': ColumnParameter(PatientModel.birthdate),
+        'family': ColumnParameter(PatientModel.family_name, normalized=PatientModel.family_name_normalized),
+        'gender': ColumnParameter(PatientModel.gender, 'http://hl7.org/fhir/administrative-gender',
+                                  {value: key for key, value in GENDERS.items()}),
+        'given': ColumnParameter(PatientModel.given_name, normalized=PatientModel.given_name_normalized),
+        'identifier': ColumnParameter(PatientModel.identifier),
+        'name': AnyColumnParameter(
+            ColumnParameter(PatientModel.family_name, normalized=PatientModel.family_name_normalized),
+            ColumnParameter(PatientModel.given_name, normalized=PatientModel.given_name_normalized)),
+        'phonetic': PhoneticParameter(soundex, PatientModel.family_name_phonetic, PatientModel.given_name_phonetic),
+    })
+
+    # the sorts that get a composite index, see :func:`fhirserver.search.sort_indexes`
+    SORTS = ('family', 'family,given', 'family,-birthdate', 'given', 'birthdate', 'lastUpdated', '-lastUpdated',
+             'identifier')
+
+    @classmethod
+    def _query(cls, columns=None):
+        """
+        :param columns: the names of the columns to load, or None to load all of them
+        """
+        if columns is None:
+            columns = stored_columns()
+        session = read_session()
+        if cls.DIRECT_SERIALIZATION:
+            return session.query(*[PatientModel.__table__.c[name] for name in columns])
+        return session.query(PatientModel).options(load_only(*columns))
+
+    @classmethod
+    def _serialize(cls, patient, elements=None):
+        # a subset is not a valid Patient, e.g. it can miss the mandatory elements, so it's always serialized
+        # directly
+        if cls.DIRECT_SERIALIZATION or elements is not None:
+            return patient_to_json(patient, elements)
+        return patient.to_fhir_res().as_json()
 
     @classmethod
     def get(cls, patient_id):
-        patient = PatientModel.query.get(patient_id)
+        patient = cls._query().filter(PatientModel.id == patient_id).first()
         if patient is not None:
-            return patient.to_fhir_res()
+            return cls._serialize(patient)
         return None
 
     @classmethod
-    def search(cls, **query_args):
-        filters = []
-        for name, qp in query_args.items():
-            if qp is not None:
-                condition = qp.get_query_condition(getattr(PatientModel, name))
-                filters.append(condition)
-        return [patient.to_fhir_res() for patient in PatientModel.query.filter(*filters).all()]
+    def get_version(cls, patient_id):
+        """
+        Read only the version of the patient, to check a conditional read without loading the whole resource
+        :return: a tuple with the versionId and the lastUpdated datetime or None if the patient doesn't exist
+        """
+        version = read_session().query(PatientModel.version_id, PatientModel.last_updated) \
+            .filter(PatientModel.id == patient_id).first()
+        if version is not None:
+            return str(version.version_id), version.last_updated
+        return None
 
     @classmethod
-    def create(cls, item):
-        patient = PatientModel.from_fhir_res(item)
+    def search_query(cls, query_args, columns=None):
+        """
+        :param query_args: a dict with the parsed search parameters
+        :param columns: the names of the columns to load, or None to load all of them
+        :return: the query of the patients matching the search parameters
+        """
+        return cls._query(columns).filter(*cls.SEARCH_PARAMETERS.conditions(query_args))
+
+    @classmethod
+    def count(cls, query_args):
+        """
+        Count the patients matching the query parameters, with a `SELECT COUNT(*)` that doesn't load any row
+        """
+        return cls.search_query(query_args).with_entities(func.count()).scalar()
+
+    @classmethod
+    def search(cls, query_args, count, cursor=None, sort=None, total=SEARCH_TOTAL.ACCURATE, elements=None):
+        """
+        Search the patients matching the query parameters and return a page of at most :arg:`count` results, see
+        :func:`fhirserver.pagination.search_page` for the other parameters
+        :param elements: the names of the elements to return, or None for the whole resources. Only the columns
+            of the elements and of the sort keys are selected
+        :return: a :class:`fhirserver.pagination.Page` of Patient json
+        """
+        def search_query(keys):
+            columns = None
+            if elements is not None:
+                columns = element_columns(elements)
+                columns.extend(attribute.key for attribute, _ in keys if attribute.key not in columns + [SCORE])
+            return cls.search_query(query_args, columns)
+
+        return search_page(PatientModel, cls.SEARCH_PARAMETERS, query_args, search_query,
+                           lambda patient: cls._serialize(patient, elements), count, cursor, sort, total)
+
+    @classmethod
+    def iter_all(cls, batch_size):
+        """
+        Iterate over all the patients, fetching them from the database in batches
+        :return: a generator of Patient json
+        """
+        query = cls._query().order_by(PatientModel.id)
+        return (cls._serialize(patient) for patient in query.yield_per(batch_size))
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Validate the json of a Patient and convert it in a model ready to be stored
+        :param data: the json of the Patient
+        :return: a :class:`PatientModel`
+        """
+        if not isinstance(data, dict) or data.get('resourceType', 'Patient') != 'Patient':
+            raise InvalidElementException("The resource is not a Patient", 'resourceType')
+        try:
+            patient = Patient(data)
+        except FHIRValidationError as e:
+            raise InvalidBodyException(e)
+        return PatientModel.from_fhir_res(patient)
+
+    @classmethod
+    def create(cls, patient):
+        """
+        :param patient: a :class:`PatientModel` returned by :meth:`parse`
+        """
         db.session.add(patient)
         db.session.commit()
-        return patient.to_fhir_res()
+        mark_write()
+        cache.invalidate('Patient', patient.id)
+        return cls._serialize(patient)
+
+    @classmethod
+    def bulk_create(cls, patients):
+        """
+        Insert several patients with a single bulk insert. The transaction is not committed, so that the caller can
+        insert several resource types in the same transaction, and then pin the client to the primary with
+        :func:`fhirserver.replicas.mark_write`
+        :param patients: a list of :class:`PatientModel` returned by :meth:`parse`
+        :return: the list of the ids of the new patients
+        """
+        db.session.bulk_save_objects(patients)
+        patients_ids = [patient.id for patient in patients]
+        cache.invalidate('Patient', *patients_ids)
+        return patients_ids
+
+
+PatientDAO.SORT_INDEXES = sort_indexes(PatientDAO.SEARCH_PARAMETERS, PatientDAO.SORTS, PatientModel.id)
@@ -0,0 +1,186 @@
+"""
+Local cache of the terminology used by the token searches. The ValueSets are expanded and the hierarchies of the
+CodeSystems are closed when they are loaded, so that the `:in` and `:not-in` modifiers are served by the codes of
+a ValueSet and the `:below` and `:above` modifiers by the ancestors and descendants of a code, both read with an
+index lookup, without expanding anything at search time. The versions of the ValueSets and CodeSystems are not
+distinguished: a canonical url with a version (`url|version`) refers to the last one loaded
+"""
+from sqlalchemy import Column, String, Index, select
+
+from fhirserver import db
+from fhirserver.exceptions import InvalidElementException
+from fhirserver.replicas import read_session
+
+
+class ValueSetCodeModel(db.Model):
+    """
+    A code of the expansion of a ValueSet
+    """
+    __tablename__ = 'valueset_codes'
+    valueset = Column(String(255), primary_key=True)
+    system = Column(String(255), primary_key=True)
+    code = Column(String(200), primary_key=True)
+
+
+class CodeClosureModel(db.Model):
+    """
+    A pair of codes of a CodeSystem where :attr:`ancestor` subsumes :attr:`descendant`. Every code subsumes itself
+    """
+    __tablename__ = 'code_closure'
+    system = Column(String(255), primary_key=True)
+    ancestor = Column(String(200), primary_key=True)
+    descendant = Column(String(200), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_code_closure_descendant', system, descendant),
+    )
+
+
+def _canonical(url):
+    # the version of a canonical url is ignored
+    return url.split('|', 1)[0] if url is not None else None
+
+
+def _closure(concepts, ancestors=()):
+    """
+    :return: the (ancestor, descendant) pairs of the concepts of a CodeSystem and of their nested concepts
+    """
+    pairs = []
+    for concept in concepts:
+        code = concept['code']
+        pairs.extend((ancestor, code) for ancestor in ancestors + (code,))
+        pairs.extend(_closure(concept.get('concept', []), ancestors + (code,)))
+    return pairs
+
+
+def _contains(contains):
+    """
+    :return: the (system, code) of the codes of the expansion of a ValueSet, nested included
+    """
+    codes = []
+    for entry in contains:
+        if 'code' in entry:
+            codes.append((entry['system'], entry['code']))
+        codes.extend(_contains(entry.get('contains', [])))
+    return codes
+
+
+class TerminologyDAO(object):
+
+    @classmethod
+    def _system_codes(cls, system, code=None):
+        """
+        :return: the codes of a loaded CodeSystem, or the descendants of :arg:`code`, itself included
+        """
+        query = db.session.query(CodeClosureModel.descendant).filter(CodeClosureModel.system == system)
+        if code is None:
+            query = query.filter(CodeClosureModel.ancestor == CodeClosureModel.descendant)
+        else:
+            query = query.filter(CodeClosureModel.ancestor == code)
+        return [row.descendant for row in query]
+
+    @classmethod
+    def _compose(cls, include):
+        """
+        :return: the (system, code) of the codes selected by an `include` or `exclude` of the compose of a ValueSet
+        """
+        system = include.get('system')
+        if 'valueSet' in include:
+            raise InvalidElementException('The ValueSets that include other ValueSets must have an expansion',
+                                          'compose.include.valueSet')
+        if 'concept' in include:
+            return {(system, concept['code']) for concept in include['concept']}
+        codes = set()
+        filters = include.get('filter', [])
+        for filter_ in filters:
+            if filter_.get('property') != 'concept' or filter_.get('op') not in ('is-a', 'descendent-of'):
+                raise InvalidElementException('Only the is-a and descendent-of filters on the concepts are supported',
+                                              'compose.include.filter')
+            descendants = cls._system_codes(system, filter_['value'])
+            if filter_['op'] == 'descendent-of':
+                descendants = [code for code in descendants if code != filter_['value']]
+            codes.update((system, code) for code in descendants)
+        if not filters:
+            codes.update((system, code) for code in cls._system_codes(system))
+        return codes
+
+    @classmethod
+    def _expand(cls, value_set):
+        if 'expansion' in value_set:
+            return set(_contains(value_set['expansion'].get('contains', [])))
+        compose = value_set.get('compose', {})
+        codes = set()
+        for include in compose.get('include', []):
+            codes |= cls._compose(include)
+        for exclude in compose.get('exclude', []):
+            codes -= cls._compose(exclude)
+        return codes
+
+    @classmethod
+    def load(cls, resources):
+        """
+        Store the codes of CodeSystems and ValueSets, replacing the ones already loaded with the same url. The
+        CodeSystems are loaded first, so that the ValueSets can select their codes. A ValueSet is expanded from
+        its `expansion`, if it has one, otherwise from the codes and the `is-a` filters of its `compose`
+        :param resources: a list of CodeSystem and ValueSet json
+        :return: a dict with the number of codes loaded by canonical url
+        """
+        loaded = {}
+        for resource in sorted(resources, key=lambda resource: resource.get('resourceType') != 'CodeSystem'):
+            url = _canonical(resource.get('url'))
+            if url is None:
+                raise InvalidElementException('The {} has no url'.format(resource.get('resourceType')), 'url')
+            if resource.get('resourceType') == 'CodeSystem':
+                CodeClosureModel.query.filter(CodeClosureModel.system == url).delete()
+                pairs = set(_closure(resource.get('concept', [])))
+                db.session.bulk_save_objects([CodeClosureModel(system=url, ancestor=ancestor, descendant=descendant)
+                                              for ancestor, descendant in pairs])
+                loaded[url] = len({descendant for _, descendant in pairs})
+            elif resource.get('resourceType') == 'ValueSet':
+                ValueSetCodeModel.query.filter(ValueSetCodeModel.valueset == url).delete()
+                codes = cls._expand(resource)
+                db.session.bulk_save_objects([ValueSetCodeModel(valueset=url, system=system, code=code)
+                                              for system, code in codes])
+                loaded[url] = len(codes)
+            else:
+                raise InvalidElementException('Only CodeSystem and ValueSet resources can be loaded', 'resourceType')
+            db.session.flush()
+        db.session.commit()
+        return loaded
+
+    @classmethod
+    def has_value_set(cls, url):
+        session = read_session()
+        return session.query(session.query(ValueSetCodeModel).filter(
+            ValueSetCodeModel.valueset == _canonical(url)).exists()).scalar()
+
+    @classmethod
+    def value_set_codes(cls, url):
+        """
+        :return: the select of the (system, code) of the expansion of a ValueSet, to be used in a subquery
+        """
+        return select([ValueSetCodeModel.system, ValueSetCodeModel.code]) \
+            .where(ValueSetCodeModel.valueset == _canonical(url))
+
+    @classmethod
+    def expand(cls, url):
+        """
+        :return: the list of the (system, code) of the expansion of a ValueSet
+        """
+        return [(row.system, row.code) for row in read_session().execute(cls.value_set_codes(url))]
+
+    @classmethod
+    def subsumed(cls, system, code, below=True):
+        """
+        :param system: the system of the code, or None for any loaded CodeSystem with the code
+        :param below: True for the descendants of the code, False for its ancestors
+        :return: the list of the (system, code) of the codes subsumed by :arg:`code`, or that subsume it, itself
+            included even if it isn't in a loaded CodeSystem
+        """
+        given, other = (CodeClosureModel.ancestor, CodeClosureModel.descendant) if below else \
+            (CodeClosureModel.descendant, CodeClosureModel.ancestor)
+        query = read_session().query(CodeClosureModel.system, other.label('code')).filter(given == code)
+        if system is not None:
+            query = query.filter(CodeClosureModel.system == system)
+        codes = [(row.system, row.code) for row in query]
+        return codes if codes else [(system, code)]
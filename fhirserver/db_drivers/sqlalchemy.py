@@ -1,21 +1,45 @@
 """
 This module has several functions that returns the correct expression to filter a query for SQLAlchemy
 """
+import json
+import sys
+
 from sqlalchemy.orm.attributes import QueryableAttribute
-from sqlalchemy import func
+from sqlalchemy import func, or_, and_, false, text, bindparam
 from sqlalchemy.sql import sqltypes
-from sqlalchemy import between
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, time, date
+
+from fhirserver import fulltext
 
 
 def equal(item: QueryableAttribute, expected):
     """
-    Return a SQLAlchemy case-insensitive equality constrain
+    Return a SQLAlchemy case-insensitive equality constrain. Both sides are lowered in the database, so that the
+    constrain can use an index on `lower(item)`
     :param item:
     :param expected:
     :return:
     """
-    return item.ilike(expected)
+    return func.lower(item) == func.lower(expected)
+
+
+def starts_with(item: QueryableAttribute, prefix: str):
+    """
+    Return a SQLAlchemy constrain that matches the values starting with :arg:`prefix`, i.e. `item LIKE 'prefix%'`.
+    It is written as the range `item >= 'prefix' AND item < 'prefiy'`, as the databases rewrite the LIKE when they
+    can, so that it's a range scan of a B-tree index on every database, whatever the LIKE optimizations it supports.
+    The range is exact only if the column compares the strings by code point, i.e. with a binary collation
+    :param item: The attribute to check
+    :param prefix: The prefix
+    :return: a BinaryExpresion to pass to a SQLAlchemy filter_by
+    """
+    # the strings that start with the prefix are before the prefix with its last character incremented
+    upper = prefix
+    while upper and upper[-1] == chr(sys.maxunicode):
+        upper = upper[:-1]
+    if not upper:
+        return item >= prefix
+    return and_(item >= prefix, item < upper[:-1] + chr(ord(upper[-1]) + 1))
 
 
 def exact(item: QueryableAttribute, expected):
@@ -38,15 +62,66 @@ def not_equal(item: QueryableAttribute, expected):
     return item != expected
 
 
-def contains(item: QueryableAttribute, expected: bool):
+def not_equal_or_missing(item: QueryableAttribute, expected, domain=None):
+    """
+    Return a SQLAlchemy constrain that represents a :not modifier FHIR operation, that matches also the
+    resources without a value
+    :param item: The attribute to check
+    :param expected: The value that the :arg:attribute should not be equal to
+    :param domain: all the values that the attribute can have, if they are known. The constrain is then
+        written as an IN of the other values, that can use an index
+    :return: a BinaryExpresion to pass to a SQLAlchemy filter_by
+    """
+    if domain is not None:
+        condition = item.in_([value for value in domain if value != expected])
+    else:
+        condition = item != expected
+    if item.property.columns[0].nullable:
+        condition = or_(condition, item == None)
+    return condition
+
+
+def in_values(item: QueryableAttribute, values):
+    """
+    Return a SQLAlchemy constrain that matches any of :arg:`values`, i.e. the values in OR of a search parameter
+    :param item: The attribute to check
+    :param values: The list of the values
+    :return: a BinaryExpresion to pass to a SQLAlchemy filter_by
+    """
+    if len(values) == 1:
+        return exact(item, values[0])
+    return item.in_(values)
+
+
+def not_in_or_missing(item: QueryableAttribute, values, domain=None):
     """
-    Return a SQLAlchemy constrain that represents a :contains modifier FHIR operation. It is implemented
-    as a LIKE %expected% SQL operation
-    :param item: 
-    :param expected: 
-    :return: 
+    Return a SQLAlchemy constrain that matches none of :arg:`values`, as :func:`not_equal_or_missing`
+    :param item: The attribute to check
+    :param values: The list of the values
+    :param domain: all the values that the attribute can have, if they are known
+    :return: a BinaryExpresion to pass to a SQLAlchemy filter_by
+    """
+    if len(values) == 1:
+        return not_equal_or_missing(item, values[0], domain)
+    if domain is not None:
+        condition = item.in_([value for value in domain if value not in values])
+    else:
+        condition = item.notin_(values)
+    if item.property.columns[0].nullable:
+        condition = or_(condition, item == None)
+    return condition
+
+
+def contains(item: QueryableAttribute, expected: str):
+    """
+    Return a SQLAlchemy constrain that represents a :contains modifier FHIR operation, i.e. a case-insensitive
+    substring match. It's served by the full-text index of the table of :arg:`item`, if it has one, see
+    :mod:`fhirserver.fulltext`, otherwise it is implemented as a LIKE %expected% SQL operation
+    :param item: The attribute to check
+    :param expected: The substring
+    :return: a BinaryExpresion to pass to a SQLAlchemy filter_by
     """
-    return item.like('%{}%'.format(expected))
+    return fulltext.contains(item, expected)
 
 
 def missing(item: QueryableAttribute, expected):
@@ -65,56 +140,261 @@ def missing(item: QueryableAttribute, expected):
         return item != None
 
 
-def date_eq(item: QueryableAttribute, expected: datetime):
-    return func.DATE(item) == func.DATE(expected)
+def _is_date(item: QueryableAttribute):
+    return isinstance(item.property.columns[0].type, sqltypes.Date)
 
 
-def date_ne(item: QueryableAttribute, expected: datetime):
-    return func.DATE(item) != func.DATE(expected)
+def _starts_before(item: QueryableAttribute, instant: datetime):
+    """
+    Return a constrain on the raw column that matches the values whose range starts before :arg:`instant`. The
+    value of a Date column is the range of the whole day, while the value of a DateTime column is an instant
+    """
+    if _is_date(item):
+        # a day starts before the instant if it's before the first day that starts at the instant or later
+        first_day = instant.date() if instant.time() == time.min else instant.date() + timedelta(days=1)
+        return item < first_day
+    return item < instant
 
 
-def date_lt(item: QueryableAttribute, expected: datetime):
-    if isinstance(item.property.columns[0].type, sqltypes.Date):
-        # that's because FHIR spec states that if the date is e.g 1985-10-12 and the queried value is
-        # 1985-10-12T10:00:00 than 1985-10-12 shall be included
-        return date_le(item, expected)
-    else:
-        return func.DATETIME(item) < func.DATETIME(expected)
+def _ends_after(item: QueryableAttribute, instant: datetime):
+    """
+    Return a constrain on the raw column that matches the values whose range ends after :arg:`instant`
+    """
+    if _is_date(item):
+        return item >= instant.date()
+    return item >= instant
 
 
-def date_gt(item: QueryableAttribute, expected: datetime):
-    if isinstance(item.property.columns[0].type, sqltypes.Date):
-        # that's because FHIR spec states that, if the date is e.g 1985-10-12 and the queried value is
-        # 1985-10-12T10:00:00 than 1985-10-12 shall be included
-        return date_ge(item, expected)
-    else:
-        return func.DATETIME(item) > func.DATETIME(expected)
+def date_eq(item: QueryableAttribute, start: datetime, end: datetime):
+    """
+    Return a constrain that matches the values overlapping the range [start, end) of the searched date. The
+    constrain compares the raw column, i.e. it's a half-open range `item >= lo AND item < hi`, so that it can use
+    an index on the column
+    :param item: The attribute to check
+    :param start: the start of the range of the searched date, as a naive UTC datetime
+    :param end: the end of the range, not included
+    """
+    return and_(_ends_after(item, start), _starts_before(item, end))
 
 
-def date_le(item: QueryableAttribute, expected: datetime):
-    if isinstance(item.property.columns[0].type, sqltypes.Date):
-        return func.DATE(item) <= func.DATE(expected)
-    else:
-        return func.DATETIME(item) <= func.DATETIME(expected)
+def date_ne(item: QueryableAttribute, start: datetime, end: datetime):
+    return or_(~_ends_after(item, start), ~_starts_before(item, end))
 
 
-def date_ge(item: QueryableAttribute, expected: datetime):
-    if isinstance(item.property.columns[0].type, sqltypes.Date):
-        return func.DATE(item) >= func.DATE(expected)
-    else:
-        return func.DATETIME(item) >= func.DATETIME(expected)
+def date_lt(item: QueryableAttribute, start: datetime, end: datetime):
+    return _starts_before(item, start)
+
+
+def date_gt(item: QueryableAttribute, start: datetime, end: datetime):
+    return _ends_after(item, end)
+
 
+def date_le(item: QueryableAttribute, start: datetime, end: datetime):
+    return _starts_before(item, end)
 
-def date_ap(item: QueryableAttribute, expected: datetime):
+
+def date_ge(item: QueryableAttribute, start: datetime, end: datetime):
+    return _ends_after(item, start)
+
+
+def date_ap(item: QueryableAttribute, start: datetime, end: datetime):
     """
-    Date is approximately equal. Approximately means at discretion of the implementation. Here for dates we set
-    approximation between one day before and one day after the required value
+    Date is approximately equal. Approximately means at discretion of the implementation. Here for dates we
+    widen the range of the searched date by one day before and one day after
     :param item:
-    :param expected:
+    :param start:
+    :param end:
     :return:
     """
     delta = timedelta(days=1)
-    if isinstance(item.property.columns[0].type, sqltypes.Date):
-        return between(func.DATE(item), func.DATE(expected - delta), func.DATE(expected + delta))
-    else:
-        return between(func.DATETIME(item), func.DATETIME(expected - delta), func.DATETIME(expected + delta))
+    return date_eq(item, start - delta, end + delta)
+
+
+def period_eq(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    """
+    Return a constrain that matches the values overlapping the range [start, end) of the searched date, where the
+    values are ranges too, e.g. the months of dates with month precision or Periods, from :arg:`low` to
+    :arg:`high`, not included
+    :param low: The attribute of the start of the values
+    :param high: The attribute of the end of the values
+    :param start: the start of the range of the searched date, as a naive UTC datetime
+    :param end: the end of the range, not included
+    """
+    return and_(high > start, low < end)
+
+
+def period_ne(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return or_(high <= start, low >= end)
+
+
+def period_lt(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return low < start
+
+
+def period_gt(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return high > end
+
+
+def period_le(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return low < end
+
+
+def period_ge(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return high > start
+
+
+def period_sa(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return low >= end
+
+
+def period_eb(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    return high <= start
+
+
+def period_ap(low: QueryableAttribute, high: QueryableAttribute, start: datetime, end: datetime):
+    """
+    As :func:`date_ap`, the range of the searched date is widened by one day before and one day after
+    """
+    delta = timedelta(days=1)
+    return period_eq(low, high, start - delta, end + delta)
+
+
+def number_eq(low: QueryableAttribute, high: QueryableAttribute, start: float, end: float):
+    """
+    Return a constrain that matches the values overlapping the range [start, end) implied by the precision of the
+    searched number. The values are ranges too, from :arg:`low` to :arg:`high`, included, and a value that is a
+    single number has both the bounds equal to it. The single numbers are matched by a bounded range of the index
+    of :arg:`low`, while the overlap of the ranges is bounded on one side only, so it's a separate branch
+    :param low: The attribute of the lower bound of the values
+    :param high: The attribute of the upper bound of the values, or again :arg:`low` if the values are all numbers
+    :param start: the start of the range of the searched number
+    :param end: the end of the range, not included
+    """
+    point = and_(low >= start, low < end)
+    if low is high:
+        return point
+    return or_(and_(low == high, point), and_(low != high, high >= start, low < end))
+
+
+def number_ne(low: QueryableAttribute, high: QueryableAttribute, start: float, end: float):
+    return or_(high < start, low >= end)
+
+
+def number_lt(low: QueryableAttribute, high: QueryableAttribute, value: float):
+    return low < value
+
+
+def number_gt(low: QueryableAttribute, high: QueryableAttribute, value: float):
+    return high > value
+
+
+def number_le(low: QueryableAttribute, high: QueryableAttribute, value: float):
+    return low <= value
+
+
+def number_ge(low: QueryableAttribute, high: QueryableAttribute, value: float):
+    return high >= value
+
+
+def number_sa(low: QueryableAttribute, high: QueryableAttribute, start: float, end: float):
+    return low >= end
+
+
+def number_eb(low: QueryableAttribute, high: QueryableAttribute, start: float, end: float):
+    return high < start
+
+
+def number_ap(low: QueryableAttribute, high: QueryableAttribute, start: float, end: float):
+    """
+    Number is approximately equal. Here the range of the searched number is widened to 10% of the number, if
+    it's wider than its precision
+    """
+    value = (start + end) / 2
+    delta = max(abs(value) / 10, (end - start) / 2)
+    return number_eq(low, high, value - delta, value + delta)
+
+
+def sort_order(item: QueryableAttribute, descending: bool):
+    """
+    Return the ORDER BY clause of a sort key. The NULL values are the smallest ones, as in an index, so they
+    come first in ascending order and last in descending order, on every database
+    """
+    if descending:
+        return item.desc().nullslast()
+    return item.asc().nullsfirst()
+
+
+def _sort_column(item):
+    """
+    Return the column or the expression of a sort key, that is a model attribute or, e.g. for the relevance of
+    a text search, an expression
+    """
+    return item.property.columns[0] if isinstance(item, QueryableAttribute) else item
+
+
+def keyset_value(item: QueryableAttribute, value):
+    """
+    Convert a value of a sort key read from a cursor, where dates are iso strings, in the column type
+    """
+    if value is None:
+        return None
+    column_type = _sort_column(item).type
+    if isinstance(column_type, sqltypes.DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column_type, sqltypes.Date):
+        return date.fromisoformat(value)
+    return value
+
+
+def _after(item: QueryableAttribute, descending: bool, value):
+    if descending:
+        return or_(item < value, item == None) if value is not None else false()
+    return item > value if value is not None else item != None
+
+
+def _equal_or_null(item: QueryableAttribute, value):
+    return item == value if value is not None else item == None
+
+
+def keyset_after(keys, values):
+    """
+    Return a constrain that matches the rows that come after the row with :arg:`values`, in the order given
+    by :arg:`keys`, i.e. `(k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...`, with the comparisons reversed for the
+    descending keys
+    :param keys: a list of tuples with the attribute of each sort key and True if the order is descending. The
+        last key must be unique
+    :param values: the values of the sort keys of the last row of the previous page
+    """
+    conditions = []
+    for index, (item, descending) in enumerate(keys):
+        equals = [_equal_or_null(previous, value) for (previous, _), value in zip(keys[:index], values)]
+        conditions.append(and_(*equals, _after(item, descending, values[index])))
+    condition = or_(*conditions)
+
+    # a redundant range on the first key, so that the database can seek the index to the start of the page
+    item, descending = keys[0]
+    if values[0] is not None:
+        if not descending:
+            condition = and_(item >= values[0], condition)
+        elif not getattr(_sort_column(item), 'nullable', True):
+            condition = and_(item <= values[0], condition)
+    return condition
+
+
+def estimate_count(query):
+    """
+    Return an estimate of the number of rows of :arg:`query`. On PostgreSQL it's the number of rows estimated by
+    the planner, from the statistics of the tables, so the rows are not counted. The other databases don't expose
+    a row estimate, so the rows are counted
+    """
+    bind = query.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return query.count()
+    # the statement is compiled with named parameters, that are bound to the text of the EXPLAIN with their types
+    compiled = query.statement.compile(dialect=type(bind.dialect)(paramstyle='named'))
+    explain = text('EXPLAIN (FORMAT JSON) {}'.format(compiled)).bindparams(
+        *[bindparam(name, value, type_=compiled.binds[name].type) for name, value in compiled.params.items()])
+    plan = query.session.execute(explain).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -1,4 +1,5 @@
 from fhirclient.models.fhirabstractbase import FHIRValidationError
+from fhirclient.models.operationoutcome import OperationOutcome, OperationOutcomeIssue
 
 from fhirserver import ISSUE_TYPE, ISSUE_SEVERITY
 
@@ -19,6 +20,19 @@ class FHIRServerException(Exception):
         self.http_code = http_code
         self.errors = errors
 
+    def to_operation_outcome(self):
+        op_outcome = OperationOutcome()
+        issues = []
+        for error in self.errors:
+            issue = OperationOutcomeIssue()
+            issue.severity = error.severity
+            if error.path is not None:
+                issue.expression = [error.path]
+            issue.code = error.code
+            issues.append(issue)
+        op_outcome.issue = issues
+        return op_outcome
+
 
 class InvalidHeaderException(FHIRServerException):
     def __init__(self, http_code, data):
@@ -69,3 +83,46 @@ class NotFoundException(FHIRServerException):
             Error(ISSUE_TYPE.NOT_FOUND, None, ISSUE_SEVERITY.ERROR)
         ]
         super(NotFoundException, self).__init__(message, 404, errors)
+
+
+class InvalidElementException(FHIRServerException):
+    """
+    A FHIRServerException for a single element of the request body that is not valid or not supported
+    """
+    def __init__(self, message, path, code=ISSUE_TYPE.INVALID, http_code=400):
+        errors = [
+            Error(code, path, ISSUE_SEVERITY.FATAL)
+        ]
+        super(InvalidElementException, self).__init__(message, http_code, errors)
+
+
+class InvalidBundleEntryException(FHIRServerException):
+    """
+    A FHIRServerException for an entry of a batch or transaction Bundle. The paths of the errors of the wrapped
+    exception, which are relative to the element :arg:`element` of the entry, are made relative to the Bundle
+    """
+    def __init__(self, index, exception, element=None):
+        prefix = 'entry[{}]'.format(index) if element is None else 'entry[{}].{}'.format(index, element)
+        errors = []
+        for error in exception.errors:
+            error_path = prefix if error.path is None else '{}.{}'.format(prefix, error.path)
+            errors.append(Error(error.code, error_path, error.severity))
+        super(InvalidBundleEntryException, self).__init__(str(exception), exception.http_code, errors)
+
+
+class InvalidBundleException(FHIRServerException):
+    """
+    A FHIRServerException that collects the errors of the entries of a transaction Bundle
+    """
+    def __init__(self, exceptions, http_code=400):
+        errors = [error for exception in exceptions for error in exception.errors]
+        message = "Errors occurred processing the Bundle entries"
+        super(InvalidBundleException, self).__init__(message, http_code, errors)
+
+
+class OperationFailedException(FHIRServerException):
+    def __init__(self, message):
+        errors = [
+            Error(ISSUE_TYPE.EXCEPTION, None, ISSUE_SEVERITY.FATAL)
+        ]
+        super(OperationFailedException, self).__init__(message, 500, errors)
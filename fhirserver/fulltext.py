@@ -0,0 +1,244 @@
+"""
+Full-text indexes of the text columns, that serve the `:contains` modifier, the `:text` modifier and the `_content`
+and `_text` parameters without scanning the tables. A :class:`FullTextIndex` is declared on a table and created
+with it, by dialect:
+
+- SQLite: an FTS5 table with the trigram tokenizer, that indexes every substring of at least 3 characters. It's an
+  external content table, i.e. it stores only the index, kept up to date on write by triggers on the table. The
+  words shorter than 3 characters can't be searched in the index, so they are matched by LIKE
+- PostgreSQL: a GIN trigram index (pg_trgm) on the lowered values of each column, that serves `LIKE '%...%'`, and a
+  GIN index on the `tsvector` of all the columns, for the searches by words
+- the other databases: no index, the values are matched by LIKE
+
+The conditions are SQL constructs compiled for the dialect of the query. The relevance of the matches, for
+`_sort=_score`, is the BM25 rank on SQLite and `ts_rank` on PostgreSQL: the greater the score, the more relevant the
+match. All the searches are case-insensitive. A search by words matches the values that contain all the words: on
+SQLite as substrings, on PostgreSQL as whole words
+"""
+from sqlalchemy import DDL, Float, Boolean, event, func, and_, or_, select, literal, literal_column, table, column
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
+
+# the kinds of text search: a substring of the values, or all the words of a text
+CONTAINS = 'contains'
+WORDS = 'words'
+
+# the trigram tokenizer of SQLite can't find shorter strings
+TRIGRAM_LENGTH = 3
+
+
+class FullTextIndex(object):
+    """
+    A full-text index on text columns of a table. It's created and dropped with the table, and it's found by the
+    queries in the `info` of the table
+    """
+
+    def __init__(self, table_, columns):
+        """
+        :param table_: the table
+        :param columns: the names of the indexed columns
+        """
+        self.table = table_
+        self.columns = tuple(columns)
+        self.name = '{}_fts'.format(table_.name)
+        table_.info['fulltext'] = self
+        event.listen(table_, 'after_create', self.create)
+        event.listen(table_, 'before_drop', self.drop)
+
+    def document(self):
+        """
+        :return: the expression of all the indexed text of a row, for the index of the words on PostgreSQL
+        """
+        values = [func.coalesce(self.table.c[name], '') for name in self.columns]
+        document = values[0]
+        for value in values[1:]:
+            document = document.op('||')(' ').op('||')(value)
+        return func.to_tsvector('simple', document)
+
+    def _sqlite_statements(self):
+        columns = ', '.join(self.columns)
+        new = ', '.join('new.{}'.format(name) for name in self.columns)
+        old = ', '.join('old.{}'.format(name) for name in self.columns)
+        delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.rowid, {2});".format(self.name, columns, old)
+        insert = 'INSERT INTO {}(rowid, {}) VALUES (new.rowid, {});'.format(self.name, columns, new)
+        return [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, content='{}', tokenize='trigram')".format(
+                self.name, columns, self.table.name),
+            'CREATE TRIGGER IF NOT EXISTS {0}_insert AFTER INSERT ON {1} BEGIN {2} END'.format(
+                self.name, self.table.name, insert),
+            'CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON {1} BEGIN {2} END'.format(
+                self.name, self.table.name, delete),
+            'CREATE TRIGGER IF NOT EXISTS {0}_update AFTER UPDATE ON {1} BEGIN {2} {3} END'.format(
+                self.name, self.table.name, delete, insert),
+            # the rows that the table has already are indexed
+            "INSERT INTO {0}({0}) VALUES ('rebuild')".format(self.name),
+        ]
+
+    def _postgresql_statements(self, bind):
+        statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm']
+        for name in self.columns:
+            statements.append('CREATE INDEX IF NOT EXISTS ix_{}_{} ON {} USING gin (lower({}) gin_trgm_ops)'.format(
+                self.name, name, self.table.name, name))
+        document = self.document().compile(dialect=bind.dialect, compile_kwargs={'literal_binds': True})
+        statements.append('CREATE INDEX IF NOT EXISTS ix_{} ON {} USING gin ({})'.format(
+            self.name, self.table.name, document))
+        return statements
+
+    def create(self, target, bind, **kw):
+        """
+        Create the index, if it doesn't exist. The rows already in the table are indexed
+        """
+        if bind.dialect.name == 'sqlite':
+            statements = self._sqlite_statements()
+        elif bind.dialect.name == 'postgresql':
+            statements = self._postgresql_statements(bind)
+        else:
+            return
+        for statement in statements:
+            bind.execute(DDL(statement.replace('%', '%%')))
+
+    def drop(self, target, bind, **kw):
+        # the indexes and the triggers on the table are dropped with it, while the FTS5 table is a table
+        if bind.dialect.name == 'sqlite':
+            bind.execute(DDL('DROP TABLE IF EXISTS {}'.format(self.name)))
+
+
+def create_missing_fulltext_indexes(engine, metadata):
+    """
+    Create the full-text indexes of the tables that already exist, since `create_all` creates only the indexes
+    of new tables
+    :return: the names of the indexes of the tables
+    """
+    created = []
+    for table_ in metadata.sorted_tables:
+        index = table_.info.get('fulltext')
+        if index is not None and engine.has_table(table_.name):
+            with engine.begin() as connection:
+                index.create(table_, connection)
+            created.append(index.name)
+    return created
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _like(columns, value):
+    """
+    :return: the condition that any of :arg:`columns` contains :arg:`value`, ignoring the case
+    """
+    pattern = '%{}%'.format(_escape_like(value.lower()))
+    return or_(*[func.lower(item).like(pattern, escape='\\') for item in columns])
+
+
+def _terms(text, kind):
+    return [text] if kind == CONTAINS else text.split()
+
+
+def _fts_query(index, names, terms):
+    """
+    :return: the FTS5 query that matches the rows with all the :arg:`terms` in the columns :arg:`names`
+    """
+    phrases = ' AND '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    if set(names) == set(index.columns):
+        return phrases
+    return '{{{}}} : ({})'.format(' '.join(names), phrases)
+
+
+class TextMatch(ColumnElement):
+    """
+    The condition that the columns :arg:`names` of the table of :arg:`index` contain :arg:`text`, as a substring
+    or as words according to :arg:`kind`
+    """
+    type = Boolean()
+    # a condition by itself, that is not compared to true on the databases without a boolean type
+    _is_implicitly_boolean = True
+
+    def __init__(self, index, names, text, kind):
+        self.index = index
+        self.names = tuple(names)
+        self.text = text
+        self.kind = kind
+
+    def columns(self):
+        return [self.index.table.c[name] for name in self.names]
+
+
+class TextScore(ColumnElement):
+    """
+    The relevance of the match of the words of :arg:`text` in the row of the table of :arg:`index`
+    """
+    type = Float()
+
+    def __init__(self, index, text):
+        self.index = index
+        self.text = text
+
+
+@compiles(TextMatch)
+def _compile_match(element, compiler, **kw):
+    terms = _terms(element.text, element.kind)
+    return compiler.process(and_(*[_like(element.columns(), term) for term in terms]), **kw)
+
+
+@compiles(TextMatch, 'sqlite')
+def _compile_match_sqlite(element, compiler, **kw):
+    terms = _terms(element.text, element.kind)
+    indexed = [term for term in terms if len(term) >= TRIGRAM_LENGTH]
+    conditions = [_like(element.columns(), term) for term in terms if len(term) < TRIGRAM_LENGTH]
+    if indexed:
+        index = element.index
+        fts = table(index.name, column('rowid'))
+        rows = select([fts.c.rowid]).where(
+            literal_column(index.name).op('MATCH')(_fts_query(index, element.names, indexed)))
+        rowid = literal_column('{}.rowid'.format(index.table.name))
+        conditions.insert(0, rowid.in_(rows))
+    return compiler.process(and_(*conditions), **kw)
+
+
+@compiles(TextMatch, 'postgresql')
+def _compile_match_postgresql(element, compiler, **kw):
+    if element.kind == CONTAINS:
+        condition = _like(element.columns(), element.text)
+    else:
+        condition = element.index.document().op('@@')(func.plainto_tsquery('simple', element.text))
+    return compiler.process(condition, **kw)
+
+
+@compiles(TextScore)
+def _compile_score(element, compiler, **kw):
+    return compiler.process(literal(0.0, Float()), **kw)
+
+
+@compiles(TextScore, 'sqlite')
+def _compile_score_sqlite(element, compiler, **kw):
+    indexed = [term for term in _terms(element.text, WORDS) if len(term) >= TRIGRAM_LENGTH]
+    if not indexed:
+        return _compile_score(element, compiler, **kw)
+    index = element.index
+    fts = table(index.name, column('rowid'), column('rank'))
+    # the BM25 rank of FTS5 is lower for the better matches
+    score = select([-fts.c.rank]).where(and_(
+        literal_column(index.name).op('MATCH')(_fts_query(index, index.columns, indexed)),
+        fts.c.rowid == literal_column('{}.rowid'.format(index.table.name))
+    )).as_scalar()
+    return compiler.process(score, **kw)
+
+
+@compiles(TextScore, 'postgresql')
+def _compile_score_postgresql(element, compiler, **kw):
+    score = func.ts_rank(element.index.document(), func.plainto_tsquery('simple', element.text))
+    return compiler.process(score, **kw)
+
+
+def contains(item, value):
+    """
+    :param item: the attribute of a text column
+    :return: the condition that the column contains :arg:`value`, served by the full-text index of the table of
+        the column if it has one
+    """
+    item_column = item.property.columns[0]
+    index = item_column.table.info.get('fulltext')
+    if index is None or item_column.name not in index.columns:
+        return _like([item], value)
+    return TextMatch(index, [item_column.name], value, CONTAINS)
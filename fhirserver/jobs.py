@@ -0,0 +1,363 @@
+"""
+A minimal manager of asynchronous jobs, used by the operations that follow the FHIR async request pattern
+(kick-off request, status polling and result retrieval). The jobs are run by a pool of threads, each one inside
+an application context, and their state is kept in memory until they expire, some time after they are finished.
+
+The state of a job can also be saved in a json file, so that the other processes of the server, e.g. the workers
+of gunicorn, can report it and remove the job. The file is the lease of the job too: its owner process renews it
+while the job runs, so a job whose owner died, or stopped renewing it, is reported as failed
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class JOB_STATUS:
+    ACCEPTED = 'accepted'
+    IN_PROGRESS = 'in-progress'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def process_owner():
+    """
+    :return: the owner of the jobs started by this process, its host name and pid
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def owner_alive(owner, heartbeat, lease):
+    """
+    Check the lease of a running job
+    :param owner: the :func:`process_owner` of the job
+    :param heartbeat: the time, in seconds since the epoch, when the owner renewed the lease
+    :param lease: the number of seconds after which a lease that is not renewed expires
+    :return: False if the lease expired or the owner is a process of this host that is no longer running
+    """
+    if owner is None or heartbeat is None or time.time() - heartbeat > lease:
+        return False
+    host, pid = owner.rsplit(':', 1)
+    if host == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return True
+
+
+@contextmanager
+def locked(path):
+    """
+    Lock a file for the other processes and threads, with an exclusive lock of the file `<path>.lock`
+    """
+    with open('{}.lock'.format(path), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class Job(object):
+    """
+    The state of an asynchronous job. The job function updates the :attr:`progress` and, when it ends, the
+    :attr:`result`
+    """
+
+    # the attributes saved in the state file
+    FIELDS = ('id', 'kind', 'request_url', 'status', 'progress', 'result', 'error', 'transaction_time', 'owner',
+              'heartbeat', 'finished_time')
+
+    def __init__(self, kind, request_url, job_id=None, state_path=None):
+        """
+        :param state_path: the json file where the state of the job is saved, if it's shared with the other
+            processes. It must be in a directory of the job, that is deleted when the job is removed
+        """
+        self.id = uuid.uuid4().hex if job_id is None else job_id
+        self.kind = kind
+        self.request_url = request_url
+        self.state_path = state_path
+        self.status = JOB_STATUS.ACCEPTED
+        self._progress = None
+        self.result = None
+        self.error = None
+        self.transaction_time = datetime.utcnow()
+        self.owner = process_owner()
+        self.heartbeat = None
+        # the time when the job finished, monotonic for the expiry and since the epoch for the other processes
+        self.finished_at = None
+        self.finished_time = None
+        # called when the job is removed, once it's finished, e.g. to delete the files it has written
+        self.cleanup = None if state_path is None else \
+            lambda: shutil.rmtree(os.path.dirname(state_path), ignore_errors=True)
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._done_callbacks = []
+
+    @property
+    def done(self):
+        return self.status in (JOB_STATUS.COMPLETED, JOB_STATUS.FAILED, JOB_STATUS.CANCELLED)
+
+    @property
+    def progress(self):
+        return self._progress
+
+    @progress.setter
+    def progress(self, progress):
+        self._progress = progress
+        self.save()
+
+    @property
+    def removed(self):
+        """
+        Whether the job has been removed by another process, that deleted its state file
+        """
+        return self.state_path is not None and not os.path.exists(self.state_path)
+
+    def save(self, create=False):
+        """
+        Save the state of the job in :attr:`state_path`, if it's set, renewing its lease
+        :param create: whether to create the state file. Otherwise the state is not saved if the job was removed
+        :return: False if the job was removed
+        """
+        if self.state_path is None:
+            return True
+        self.heartbeat = time.time()
+        state = {field: getattr(self, field) for field in self.FIELDS}
+        state['transaction_time'] = self.transaction_time.isoformat()
+        # the file is replaced atomically under the lock, so that it's never broken nor created again once removed
+        try:
+            with locked(self.state_path):
+                if not create and not os.path.exists(self.state_path):
+                    return False
+                tmp_path = '{}.tmp'.format(self.state_path)
+                with open(tmp_path, 'w', encoding='utf-8') as state_file:
+                    json.dump(state, state_file)
+                os.replace(tmp_path, self.state_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the state of a job saved by :meth:`save`
+        """
+        with open(path, encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        job = cls(state['kind'], state['request_url'], state['id'], path)
+        for field in cls.FIELDS:
+            setattr(job, '_progress' if field == 'progress' else field, state[field])
+        job.transaction_time = datetime.fromisoformat(state['transaction_time'])
+        return job
+
+    def delete_state(self):
+        """
+        Delete the state file, so that the job is removed for all the processes
+        """
+        try:
+            with locked(self.state_path):
+                os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def finish(self, status):
+        """
+        Set the final status of the job and call the callbacks waiting for it
+        """
+        with self._lock:
+            self.status = status
+            self.finished_at = time.monotonic()
+            self.finished_time = time.time()
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        self.save()
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception:
+            logger.exception('Callback of job %s failed', self.id)
+
+    def when_done(self, callback):
+        """
+        Call :arg:`callback` when the job is finished, or now if it's already finished. The worker of the job
+        calls it, so that it runs after the job has stopped writing its output
+        """
+        with self._lock:
+            if not self.done:
+                self._done_callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def cancel(self):
+        self._cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            self.finish(JOB_STATUS.CANCELLED)
+
+    def check_cancelled(self):
+        """
+        Called by the job function at safe points to stop the job if it has been cancelled, or removed by another
+        process, and to renew its lease
+        """
+        if self._cancel_event.is_set() or not self.save():
+            raise JobCancelled
+
+
+def _shutdown(executor, jobs):
+    for job in list(jobs.values()):
+        job.cancel()
+    executor.shutdown(wait=False)
+
+
+class JobManager(object):
+
+    def __init__(self, app, max_workers, expiry, lease):
+        """
+        :param max_workers: the number of jobs run at the same time
+        :param expiry: the number of seconds a finished job is kept
+        :param lease: the number of seconds after which a running job whose state file is not renewed is failed
+        """
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fhir-job')
+        self.jobs = {}
+        self.expiry = expiry
+        self.lease = lease
+        self.lock = threading.Lock()
+        # the jobs are cancelled and the workers stopped when the manager is discarded, or at exit
+        self._finalizer = weakref.finalize(self, _shutdown, self.executor, self.jobs)
+
+    def _run(self, job, function, args):
+        with self.app.app_context():
+            job.status = JOB_STATUS.IN_PROGRESS
+            try:
+                job.check_cancelled()
+                job.result = function(job, *args)
+            except JobCancelled:
+                job.finish(JOB_STATUS.CANCELLED)
+            except Exception as e:
+                self.app.logger.exception('Job %s failed', job.id)
+                job.error = str(e)
+                job.finish(JOB_STATUS.FAILED)
+            else:
+                job.finish(JOB_STATUS.COMPLETED)
+        if job.removed:
+            self.remove(job.id)
+
+    @staticmethod
+    def _discard(job):
+        """
+        Delete the state and, once the job is finished, the files of a removed job
+        """
+        if job.state_path is not None:
+            job.delete_state()
+        if job.cleanup is not None:
+            job.when_done(job.cleanup)
+
+    def _evict(self):
+        """
+        Remove the jobs that expired
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job.finished_at is not None and now - job.finished_at > self.expiry]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            self._discard(job)
+
+    def _load(self, state_path):
+        """
+        Load a job of another process from its state file. A running job whose lease expired is failed, and a
+        finished job that expired is removed
+        :return: the job, or None if it's not known
+        """
+        try:
+            job = Job.load(state_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        if job.done:
+            if time.time() - job.finished_time > self.expiry:
+                self._discard(job)
+                return None
+        elif not owner_alive(job.owner, job.heartbeat, self.lease):
+            job.status = JOB_STATUS.FAILED
+            job.error = 'The job was interrupted'
+        return job
+
+    def submit(self, job, function, *args):
+        """
+        Run `function(job, *args)` in background
+        """
+        self._evict()
+        if job.state_path is not None:
+            os.makedirs(os.path.dirname(job.state_path), exist_ok=True)
+            job.save(create=True)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self._run, job, function, args)
+        return job
+
+    def get(self, job_id, kind, state_path=None):
+        """
+        :param state_path: the state file of the job, to read it if it was started by another process
+        :return: the job, or None if it's not known
+        """
+        self._evict()
+        job = self.jobs.get(job_id)
+        if job is None and state_path is not None:
+            job = self._load(state_path)
+        elif job is not None and job.removed:
+            self.remove(job_id)
+            return None
+        if job is None or job.kind != kind:
+            return None
+        return job
+
+    def remove(self, job_id, state_path=None):
+        """
+        Remove a job, cancelling it if it's not finished. Its cleanup runs when it's finished. A job of another
+        process is stopped by its owner, when it finds that its state file was deleted
+        :param state_path: the state file of the job, to remove it if it was started by another process
+        :return: the job, or None if it's not known
+        """
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is None and state_path is not None:
+            job = self._load(state_path)
+        elif job is not None:
+            job.cancel()
+        if job is not None:
+            self._discard(job)
+        return job
+
+    def shutdown(self, wait=True):
+        """
+        Cancel the jobs and stop the workers
+        """
+        self._finalizer.detach()
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,310 @@
+"""
+Metrics of the server in the Prometheus text format, exposed at `/metrics`, if METRICS_ENDPOINT is set, to the
+requests with the bearer token METRICS_TOKEN, if it's set. The latency of every FHIR interaction is observed in
+histograms labeled by resource type, interaction and search parameter, if the query has only one, or `multiple`.
+The labels are the resource types and the search parameters of the registry, so that the requests can't add
+series, while the combinations of the parameters are reported by the profiles. The time of an interaction is also
+split in phases:
+
+- `parse`: the parsing of the search parameters
+- `query`: the execution of the SQL statements
+- `fetch`: the fetching of the rows of the results
+- `serialize`: the conversion of the rows in FHIR json
+- `render`: the serialization of the response body
+
+The timings of a request are collected in an :class:`Interaction`, stored in the WSGI environ of the request, and
+observed at the end of the request or, for the streamed responses, when the response is closed. The same timings
+are reported for the requests profiled by `fhirserver.profiling`. When metrics are disabled, the requests that
+aren't profiled have no :class:`Interaction` and the hooks do nothing
+"""
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, request, Response, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from fhirserver import profiling
+
+# the key of the :class:`Interaction` of a request in the WSGI environ
+ENVIRON_KEY = 'fhirserver.interaction'
+
+# the label of the interactions whose query has more than one search parameter
+MULTIPLE_SEARCH_PARAMS = 'multiple'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, float('inf'))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """
+    A Prometheus histogram, with a series for each combination of the values of its labels
+    """
+
+    def __init__(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # the counts of the buckets, the sum and the count of the observations by label values
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        """
+        :return: the lines of the histogram in the text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((labelvalues, [list(counts), total, count])
+                            for labelvalues, (counts, total, count) in self._series.items())
+        for labelvalues, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ('le',), labelvalues + (_format_value(bound),))
+                lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Gauge(object):
+    """
+    A Prometheus gauge whose values are read when the metrics are collected
+    :param collect: a function that returns a dict with the values by tuple of label values
+    """
+
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._collect = collect
+
+    def collect(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} gauge'.format(self.name)]
+        for labelvalues, value in sorted(self._collect().items()):
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, labelvalues),
+                                          _format_value(value)))
+        return lines
+
+
+REQUEST_DURATION = Histogram('fhir_request_duration_seconds', 'Latency of the FHIR interactions',
+                             ('resource_type', 'interaction', 'search_params', 'status'))
+PHASE_DURATION = Histogram('fhir_request_phase_seconds', 'Time spent in each phase of the FHIR interactions',
+                           ('resource_type', 'interaction', 'search_params', 'phase'))
+
+
+class Interaction(object):
+    """
+    The timings of the FHIR interaction of a request
+    :param observed: if True, the timings are observed in the histograms of the metrics
+    :param profiled: if True, the timings are reported as the profile of the request
+    """
+    __slots__ = ('resource_type', 'interaction', 'search_params', 'start', 'phases', 'queries', 'observed',
+                 'profiled')
+
+    def __init__(self, resource_type, interaction, observed=True, profiled=False):
+        self.resource_type = resource_type
+        self.interaction = interaction
+        self.search_params = ''
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self.observed = observed
+        self.profiled = profiled
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def finish(self, status):
+        if self.observed:
+            search_params = MULTIPLE_SEARCH_PARAMS if ',' in self.search_params else self.search_params
+            labels = (self.resource_type, self.interaction, search_params)
+            REQUEST_DURATION.observe(self.elapsed(), *labels, str(status))
+            for phase, seconds in self.phases.items():
+                PHASE_DURATION.observe(seconds, *labels, phase)
+        if self.profiled:
+            profiling.log_profile(self, status)
+
+
+def start_interaction(resource_type, interaction):
+    """
+    Start measuring the FHIR interaction of the current request, if metrics are enabled or the request is profiled
+    """
+    config = current_app.config
+    profiled = profiling.is_profiled(config)
+    if config['METRICS_ENABLED'] or profiled:
+        request.environ[ENVIRON_KEY] = Interaction(resource_type, interaction, config['METRICS_ENABLED'], profiled)
+
+
+def current_interaction():
+    """
+    :return: the :class:`Interaction` of the current request or None if it's not measured
+    """
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return None
+    return ctx.request.environ.get(ENVIRON_KEY)
+
+
+def set_search_params(names):
+    """
+    Set the names of the search parameters of the current interaction. They label its metrics if there's only one
+    """
+    interaction = current_interaction()
+    if interaction is not None:
+        interaction.search_params = ','.join(sorted(names))
+
+
+@contextmanager
+def phase(name):
+    """
+    Add the time spent in the block to the phase :arg:`name` of the current interaction
+    """
+    interaction = current_interaction()
+    if interaction is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        interaction.add(name, time.perf_counter() - start)
+
+
+def timed_iter(iterable, name):
+    """
+    Iterate over :arg:`iterable`, adding the time spent waiting for each item to the phase :arg:`name` of the
+    current interaction
+    """
+    interaction = current_interaction()
+    if interaction is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            interaction.add(name, time.perf_counter() - start)
+            return
+        interaction.add(name, time.perf_counter() - start)
+        yield item
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    interaction = current_interaction()
+    if interaction is not None:
+        interaction.queries += 1
+        conn.info.setdefault('fhirserver.query_start', []).append((interaction, time.perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('fhirserver.query_start')
+    if starts:
+        interaction, start = starts.pop()
+        interaction.add('query', time.perf_counter() - start)
+
+
+def _finish_interaction(response):
+    interaction = current_interaction()
+    if interaction is not None:
+        status = response.status_code
+        if interaction.profiled:
+            response.headers['Server-Timing'] = profiling.server_timing(interaction)
+        if response.is_streamed:
+            # the body is written after the request, so the interaction ends when the response is closed
+            response.call_on_close(lambda: interaction.finish(status))
+        else:
+            interaction.finish(status)
+    return response
+
+
+def collect_app_metrics(app):
+    """
+    :return: the gauges of the connection pool and of the resource cache of :arg:`app`. They are collected in
+        the request to `/metrics`, in the context of the app
+    """
+    from fhirserver import db
+    from fhirserver.pool import pool_stats
+
+    def pool():
+        stats = pool_stats(db.engine)
+        return {(name,): value for name, value in stats.items()}
+
+    def cache():
+        resource_cache = app.extensions.get('resource_cache')
+        stats = resource_cache.stats() if resource_cache is not None else {}
+        return {(name,): value for name, value in stats.items()}
+
+    return [
+        Gauge('fhir_db_pool', 'State and counters of the database connection pool', ('stat',), pool),
+        Gauge('fhir_resource_cache', 'Counters of the resource cache', ('stat',), cache),
+    ]
+
+
+def _authorized():
+    """
+    :return: whether the request to `/metrics` has the bearer token METRICS_TOKEN, or it's not required
+    """
+    token = current_app.config['METRICS_TOKEN']
+    return not token or hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(token))
+
+
+def init_app(app):
+    """
+    Install the hooks of the metrics, if METRICS_ENABLED or the requests can be profiled, and the `/metrics`
+    endpoint, if METRICS_ENABLED and METRICS_ENDPOINT
+    """
+    if not (app.config['METRICS_ENABLED'] or app.config['PROFILING_HEADER'] or app.config['PROFILING_SAMPLE_RATE']):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.after_request(_finish_interaction)
+    if not (app.config['METRICS_ENABLED'] and app.config['METRICS_ENDPOINT']):
+        return
+    metrics = [REQUEST_DURATION, PHASE_DURATION] + collect_app_metrics(app)
+
+    def expose():
+        if not _authorized():
+            return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'}, mimetype='text/plain')
+        lines = [line for metric in metrics for line in metric.collect()]
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', expose)
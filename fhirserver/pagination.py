@@ -0,0 +1,168 @@
+"""
+Helpers for keyset (seek) pagination of search results. The position of a page is carried by an opaque cursor
+token that encodes the sort key of the last entry returned in the previous page
+"""
+import base64
+import binascii
+import json
+import time
+from datetime import date
+
+from sqlalchemy import func
+
+from fhirserver import metrics
+from fhirserver.conditional import collection_version
+from fhirserver.consts import SEARCH_TOTAL
+from fhirserver.db_drivers import sqlalchemy as db_driver
+from fhirserver.exceptions import InvalidQueryParameterException
+from fhirserver.search import SCORE
+
+
+class Page(object):
+    """
+    A page of search results. The entries are fetched lazily from the database cursor in batches of
+    :arg:`batch_size` rows, so that they can be streamed to the client one at a time. The :attr:`next_cursor`
+    is available only once the entries have been consumed
+    """
+
+    def __init__(self, query, count, total, serialize, key, batch_size=100, version=None, last_updated=None):
+        """
+        :param query: the query of the page, already filtered by the cursor and sorted by the keyset
+        :param count: the maximum number of entries of the page
+        :param total: the total number of results of the search, None if they were not counted
+        :param serialize: a function that converts a row in the entry resource
+        :param key: a function that returns the keyset values of a row
+        :param batch_size: the number of rows fetched at a time from the database
+        :param version: the version of the whole result set, that changes when any of the results changes
+        :param last_updated: the last update time of the most recently updated result
+        """
+        self.query = query
+        self.count = count
+        self.total = total
+        self.serialize = serialize
+        self.key = key
+        self.batch_size = batch_size
+        self.version = version
+        self.last_updated = last_updated
+        self.next_cursor = None
+
+    def __iter__(self):
+        last_row = None
+        interaction = metrics.current_interaction()
+        # one more row is fetched to know if there is a next page
+        rows = iter(self.query.limit(self.count + 1).yield_per(self.batch_size))
+        for index, row in enumerate(metrics.timed_iter(rows, 'fetch')):
+            if index == self.count:
+                if last_row is not None:
+                    self.next_cursor = encode_cursor(self.key(last_row))
+                break
+            last_row = row
+            if interaction is None:
+                yield self.serialize(row)
+            else:
+                start = time.perf_counter()
+                item = self.serialize(row)
+                interaction.add('serialize', time.perf_counter() - start)
+                yield item
+
+
+def search_page(model, registry, query_args, search_query, serialize, count, cursor=None, sort=None,
+                total=SEARCH_TOTAL.ACCURATE):
+    """
+    Search the resources matching the query parameters and return a page of at most :arg:`count` results. The
+    keyset for pagination is made of the sort keys followed by the `id`, which makes the order stable. The entries
+    of the page are fetched lazily
+    :param model: the model of the resources, with the `id`, `version_id` and `last_updated` columns
+    :param registry: the :class:`fhirserver.search.SearchRegistry` of the resource type
+    :param query_args: a dict with the parsed search parameters
+    :param search_query: a function that returns the query of the resources matching :arg:`query_args`, given the
+        keyset. The query selects either the model or columns, including the keys that are columns
+    :param serialize: a function that converts a resource of the query, the model or a row, in json
+    :param count: the maximum number of entries of the page
+    :param cursor: the decoded cursor of the previous page, if any
+    :param sort: the parsed `_sort`, if any
+    :param total: how the total number of results is computed, see :class:`fhirserver.consts.SEARCH_TOTAL`.
+        The version of the results is known only when they are counted accurately
+    :return: a :class:`Page`
+    """
+    keys = registry.sort_keys(sort or [], query_args) + [(model.id, False)]
+    # the sort keys that are not columns, i.e. the relevance of a text search, are selected after the resource
+    scores = [attribute for attribute, _ in keys if attribute.key == SCORE]
+    query = search_query(keys)
+    version, last_updated = None, None
+    if total == SEARCH_TOTAL.ACCURATE:
+        # the version of the collection changes whenever a matching resource is added, removed or updated
+        total, versions, last_updated = query.with_entities(
+            func.count(model.id), func.sum(model.version_id), func.max(model.last_updated)
+        ).one()
+        version = collection_version(total, versions, last_updated)
+    elif total == SEARCH_TOTAL.ESTIMATE:
+        total = db_driver.estimate_count(query)
+    else:
+        total = None
+
+    if cursor is not None:
+        if len(cursor) != len(keys):
+            raise InvalidQueryParameterException(400, {'message': {'_cursor': "The cursor doesn't match _sort"}})
+        values = [db_driver.keyset_value(attribute, value) for (attribute, _), value in zip(keys, cursor)]
+        query = query.filter(db_driver.keyset_after(keys, values))
+    # with the scores, the rows of a query of the model are tuples of the model and its scores
+    entities = bool(scores) and query.column_descriptions[0]['expr'] is model
+    query = query.add_columns(*scores)
+    query = query.order_by(*[db_driver.sort_order(attribute, descending) for attribute, descending in keys])
+
+    def entity(row):
+        return row[0] if entities else row
+
+    def key(row):
+        return [cursor_value(getattr(row if attribute.key == SCORE else entity(row), attribute.key))
+                for attribute, _ in keys]
+
+    return Page(query, count, total, lambda row: serialize(entity(row)), key, version=version,
+                last_updated=last_updated)
+
+
+def encode_cursor(values):
+    """
+    Encode the sort key values of the last entry of a page in an opaque, url safe token
+    :param values: a list of json serializable values
+    :return: the cursor token
+    """
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def cursor_value(value):
+    """
+    Convert the value of a sort key in a json serializable value. Dates are encoded as iso strings
+    """
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def decode_cursor(token, name=None, operator=None):
+    """
+    Decode a cursor token created by :func:`encode_cursor`. It is used also as type for the `_cursor` query
+    parameter, so it raises a ValueError in case of an invalid token, as required by Flask Restful
+    :param token: the cursor token
+    :return: the list of sort key values
+    """
+    padding = '=' * (-len(token) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + padding).decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) == 0:
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def page_size(value, name=None, operator=None):
+    """
+    Type of the `_count` query parameter: a non negative integer
+    """
+    count = int(value)
+    if count < 0:
+        raise ValueError('_count must be a non negative integer')
+    return count
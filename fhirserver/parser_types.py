@@ -1,12 +1,19 @@
 import importlib
+import re
+from datetime import timezone
+from decimal import Decimal
 from enum import Enum
+from types import MappingProxyType
 
 from dateutil.parser import isoparse
+from dateutil.relativedelta import relativedelta
 from flask_restful.reqparse import Argument
 # from flask import current_app
 #
 
+from fhirserver import search
 from fhirserver.db_drivers import sqlalchemy as db_driver
+from fhirserver.exceptions import InvalidQueryParameterException
 
 # FHIRPrefixes = ('eq', 'ne', 'gt', 'lt', 'ge', 'le', 'gt', 'sa', 'eb', 'ap')
 
@@ -83,6 +90,8 @@ class BaseFHIRSearch(object):
 
         _check_operator(value, operator, self.OPERATORS)
 
+        self.name = name
+
         self.modifier = operator.replace('=', '') if operator != '=' and operator is not None else None
 
         if self.modifier == FHIRModifiers.MISSING:
@@ -91,15 +100,31 @@ class BaseFHIRSearch(object):
             self.value = None
 
 
+def _number_range(number):
+    """
+    Return the range implied by the precision of a number, i.e. by its significant digits: 100 is [99.5, 100.5),
+    100.0 is [99.95, 100.05) and 1e2 is [50, 150)
+    :param number: the string of the number
+    :return: a tuple with the start and the end of the range, not included, as Decimals
+    """
+    value = Decimal(number)
+    if not value.is_finite():
+        raise ValueError
+    half = Decimal(5).scaleb(value.as_tuple().exponent - 1)
+    return value - half, value + half
+
+
 class FHIRNumber(BaseFHIRSearch):
     """
-    A fhir number parameter can be a number or a number prefixed with a modifier (e.g., 10, 10.0, ne10)
+    A fhir number parameter can be a number or a number prefixed with a modifier (e.g., 10, 10.0, ne10). The number
+    is an implicit range, given by its precision, so the parameter keeps also the :attr:`range` of the number
     """
 
     def __init__(self, value, name=None, operator='='):
         super(FHIRNumber, self).__init__(value, name, operator)
         if isinstance(self.value, bool):
             self.operation = None
+            self.range = None
 
         if self.value is None:
             operation, number = value[0:2], value[2:]
@@ -117,40 +142,159 @@ class FHIRNumber(BaseFHIRSearch):
                     continue
             else:
                 raise ValueError
+            self.range = _number_range(number)
+
+    def number_condition(self, low, high, factor=1):
+        """
+        :param low: the attribute of the lower bound of the values
+        :param high: the attribute of the upper bound of the values, the same of :arg:`low` for single numbers
+        :param factor: the factor that converts the searched number to the unit of the values
+        :return: the condition on the values
+        """
+        start, end = (float(bound * factor) for bound in self.range)
+        value = float((self.range[0] + self.range[1]) / 2 * factor)
+        if self.operation == FHIRPrefixes.EQ:
+            return db_driver.number_eq(low, high, start, end)
+        elif self.operation == FHIRPrefixes.NE:
+            return db_driver.number_ne(low, high, start, end)
+        elif self.operation == FHIRPrefixes.LT:
+            return db_driver.number_lt(low, high, value)
+        elif self.operation == FHIRPrefixes.GT:
+            return db_driver.number_gt(low, high, value)
+        elif self.operation == FHIRPrefixes.LE:
+            return db_driver.number_le(low, high, value)
+        elif self.operation == FHIRPrefixes.GE:
+            return db_driver.number_ge(low, high, value)
+        elif self.operation == FHIRPrefixes.SA:
+            return db_driver.number_sa(low, high, start, end)
+        elif self.operation == FHIRPrefixes.EB:
+            return db_driver.number_eb(low, high, start, end)
+        elif self.operation == FHIRPrefixes.AP:
+            return db_driver.number_ap(low, high, start, end)
+
+    def get_query_condition(self, item, parameter=None):
+        """
+        :param item: the attribute of the values or, if they are ranges, of their lower bounds
+        :param parameter: the search parameter of the values. If the values are ranges, its `high` is the
+            attribute of their upper bounds
+        """
+        if self.modifier == FHIRModifiers.MISSING:
+            return db_driver.missing(item, self.value)
+        high = getattr(parameter, 'high', None)
+        return self.number_condition(item, item if high is None else high)
+
+
+# the components of a FHIR date, used to get its precision
+DATE_FORMAT = re.compile(r'^\d{4}(?:-(\d{2})(?:-(\d{2})(?:T(\d{2})(?::(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?)?)?)?'
+                         r'(?:Z|[+-]\d{2}:\d{2})?$')
+
+
+def _date_range(datestr, value):
+    """
+    Return the range of time implied by the precision of a date, e.g. the whole year for 2020
+    :param datestr: the date string
+    :param value: the parsed date
+    :return: a tuple with the start and the end of the range, not included, as naive UTC datetimes
+    """
+    match = DATE_FORMAT.match(datestr)
+    if match is None:
+        raise ValueError
+    month, day, hour, minute, second, fraction = match.groups()
+    if month is None:
+        delta = relativedelta(years=1)
+    elif day is None:
+        delta = relativedelta(months=1)
+    elif hour is None:
+        delta = relativedelta(days=1)
+    elif minute is None:
+        delta = relativedelta(hours=1)
+    elif second is None:
+        delta = relativedelta(minutes=1)
+    elif fraction is None:
+        delta = relativedelta(seconds=1)
+    else:
+        delta = relativedelta(microseconds=10 ** max(6 - len(fraction), 0))
+
+    start = value
+    if start.tzinfo is not None:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    return start, start + delta
 
 
 class FHIRDate(BaseFHIRSearch):
+    """
+    A fhir date parameter is a date with a prefix (e.g., eq2020-10-13). The date is an implicit range of time,
+    given by its precision, so the parameter keeps also the :attr:`range` of the date
+    """
 
     def __init__(self, value, name=None, operator='='):
         super(FHIRDate, self).__init__(value, name, operator)
         if isinstance(self.value, bool):
             self.operation = None
+            self.range = None
         else:
             operation, datestr = value[0:2], value[2:]
             if operation in FHIRPrefixes.values():
                 # note that the method raises a Value Error if it fails, as required by Flask Restful
                 self.value = isoparse(datestr)
                 self.operation = operation
+                self.range = _date_range(datestr, self.value)
             else:
                 raise ValueError
 
-    def get_query_condition(self, item):
+    def period_condition(self, low, high):
+        """
+        :param low: the attribute of the start of the values
+        :param high: the attribute of the end of the values, not included
+        :return: the condition on the values that are ranges, e.g. Periods
+        """
+        start, end = self.range
+        if self.operation == FHIRPrefixes.EQ:
+            return db_driver.period_eq(low, high, start, end)
+        elif self.operation == FHIRPrefixes.NE:
+            return db_driver.period_ne(low, high, start, end)
+        elif self.operation == FHIRPrefixes.LT:
+            return db_driver.period_lt(low, high, start, end)
+        elif self.operation == FHIRPrefixes.GT:
+            return db_driver.period_gt(low, high, start, end)
+        elif self.operation == FHIRPrefixes.LE:
+            return db_driver.period_le(low, high, start, end)
+        elif self.operation == FHIRPrefixes.GE:
+            return db_driver.period_ge(low, high, start, end)
+        elif self.operation == FHIRPrefixes.SA:
+            return db_driver.period_sa(low, high, start, end)
+        elif self.operation == FHIRPrefixes.EB:
+            return db_driver.period_eb(low, high, start, end)
+        elif self.operation == FHIRPrefixes.AP:
+            return db_driver.period_ap(low, high, start, end)
+
+    def get_query_condition(self, item, parameter=None):
+        """
+        :param item: the attribute of the values or, if they are ranges, of their starts
+        :param parameter: the search parameter of the values. If the values are ranges, its `high` is the
+            attribute of their ends
+        """
         if self.modifier == FHIRModifiers.MISSING:
             return db_driver.missing(item, self.value)
-        elif self.operation == FHIRPrefixes.EQ:
-            return db_driver.date_eq(item, self.value)
+        high = getattr(parameter, 'high', None)
+        if high is not None:
+            return self.period_condition(item, high)
+
+        start, end = self.range
+        if self.operation == FHIRPrefixes.EQ:
+            return db_driver.date_eq(item, start, end)
         elif self.operation == FHIRPrefixes.NE:
-            return db_driver.date_ne(item, self.value)
+            return db_driver.date_ne(item, start, end)
         elif self.operation in (FHIRPrefixes.LT, FHIRPrefixes.EB):
-            return db_driver.date_lt(item, self.value)
+            return db_driver.date_lt(item, start, end)
         elif self.operation in (FHIRPrefixes.GT, FHIRPrefixes.SA):
-            return db_driver.date_gt(item, self.value)
+            return db_driver.date_gt(item, start, end)
         elif self.operation == FHIRPrefixes.LE:
-            return db_driver.date_le(item, self.value)
+            return db_driver.date_le(item, start, end)
         elif self.operation == FHIRPrefixes.GE:
-            return db_driver.date_ge(item, self.value)
+            return db_driver.date_ge(item, start, end)
         elif self.operation == FHIRPrefixes.AP:
-            return db_driver.date_ap(item, self.value)
+            return db_driver.date_ap(item, start, end)
 
 
 class FHIRString(BaseFHIRSearch):
@@ -162,8 +306,16 @@ class FHIRString(BaseFHIRSearch):
         if not isinstance(self.value, bool):
             self.value = value
 
-    def get_query_condition(self, item):
+    def get_query_condition(self, item, parameter=None):
+        """
+        :param parameter: the search parameter of the column. The default search, that matches the values that
+            start with the searched string ignoring case, accents and spacing, uses its normalized shadow column,
+            if it has one
+        """
         if self.modifier is None:
+            normalized = getattr(parameter, 'normalized', None)
+            if normalized is not None:
+                return db_driver.starts_with(normalized, search.normalize(self.value))
             return db_driver.equal(item, self.value)
         elif self.modifier == FHIRModifiers.EXACT:
             return db_driver.exact(item, self.value)
@@ -173,7 +325,54 @@ class FHIRString(BaseFHIRSearch):
             return db_driver.contains(item, self.value)
 
 
+def split_escaped(value, separator):
+    """
+    Split a value of a search parameter on the separators that are not escaped by a backslash, e.g. the commas of
+    the values in OR. The escapes are kept, so that the parts can be split again, see :func:`unescape`
+    """
+    parts = ['']
+    escaped = False
+    for char in value:
+        if char == separator and not escaped:
+            parts.append('')
+            continue
+        parts[-1] += char
+        escaped = char == '\\' and not escaped
+    return parts
+
+
+def unescape(value):
+    """
+    Remove the backslashes that escape the special characters of a value of a search parameter, i.e. `\\,`,
+    `\\|`, `\\$` and `\\\\`
+    """
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _parse_token(value):
+    """
+    :return: a tuple with the system and the code of a token in the format `[system|]code`. The system is None if
+        the token doesn't specify it, and empty for a code without a system (`|code`), while the code is None
+        for any code of the system (`system|`)
+    """
+    parts = split_escaped(value, '|')
+    if len(parts) == 1:
+        return None, unescape(value)
+    elif len(parts) == 2:
+        system, code = (unescape(part) for part in parts)
+        if not system and not code:
+            raise ValueError
+        return system, code or None
+    raise ValueError
+
+
 class FHIRToken(BaseFHIRSearch):
+    """
+    A fhir token parameter is a list of `[system|]code` tokens in OR, separated by commas, e.g.
+    `http://loinc.org|1234-5,http://loinc.org|6789-0`. The parsed tokens are in :attr:`tokens`, while
+    :attr:`system` and :attr:`value` are the ones of the first token. The value of the `:text` modifier is a text
+    and the one of `:in` and `:not-in` is the url of a ValueSet, so it's kept in :attr:`text` as is
+    """
 
     OPERATORS = ('=', FHIRModifiers.MISSING, FHIRModifiers.TEXT, FHIRModifiers.NOT,
                  FHIRModifiers.IN, FHIRModifiers.NOT_IN, FHIRModifiers.BELOW, FHIRModifiers.ABOVE)
@@ -183,18 +382,37 @@ class FHIRToken(BaseFHIRSearch):
 
         if isinstance(self.value, bool):
             self.system = None
+            self.tokens = []
+            self.text = None
         else:
-            parts = value.split('|')
-
-            if len(parts) == 1:
-                system, code = '', value
-            elif len(parts) == 2:
-                system, code = parts
-            else:
-                raise ValueError
-
-            self.system = system
-            self.value = code
+            self.tokens = [_parse_token(token) for token in split_escaped(value, ',')]
+            system, code = self.tokens[0]
+            self.system = system or ''
+            self.value = code or ''
+            self.text = value
+
+    def get_query_condition(self, item, parameter):
+        """
+        :param parameter: the :class:`fhirserver.search.ColumnParameter` of the column, that converts the tokens in
+            the values stored in the column
+        """
+        if self.modifier == FHIRModifiers.MISSING:
+            return db_driver.missing(item, self.value)
+        if self.modifier == FHIRModifiers.TEXT:
+            raise InvalidQueryParameterException(400, {'message': {self.name: 'Unsupported modifier'}})
+
+        values = parameter.to_values(search.expand_tokens(self))
+        if self.modifier in (FHIRModifiers.NOT, FHIRModifiers.NOT_IN):
+            if values is None:
+                return db_driver.missing(item, True)
+            if not values:
+                return search.match_all()
+            return db_driver.not_in_or_missing(item, values, parameter.domain)
+        if values is None:
+            return db_driver.missing(item, False)
+        if not values:
+            return search.match_none()
+        return db_driver.in_values(item, values)
 
 
 class FHIRReference(BaseFHIRSearch):
@@ -227,6 +445,12 @@ class FHIRReference(BaseFHIRSearch):
 
 
 class FHIRQuantity(FHIRNumber):
+    """
+    A fhir quantity parameter is a number, with the prefix, optionally followed by the system and the code of its
+    unit (e.g., 5.4|http://unitsofmeasure.org|mg). The :attr:`code` is None if the unit is not specified, and the
+    :attr:`system` is empty if only the code is
+    """
+
     def __init__(self, value, name=None, operator='='):
 
         parts = value.split('|')
@@ -243,7 +467,7 @@ class FHIRQuantity(FHIRNumber):
             self.code = None
         else:
             self.system = system
-            self.code = code
+            self.code = code or None
 
 
 class FHIRUri(BaseFHIRSearch):
@@ -264,3 +488,93 @@ def query_argument_type_factory(name, typ, dest=None):
 
     return Argument(name, dest=dest, type=typ_handler, operators=typ_handler.OPERATORS,
                     required=False, location='args')
+
+
+def choice_parameter(*choices):
+    """
+    Create the type of a query parameter whose value must be one of :arg:`choices`
+    """
+    def parse(value, name=None, operator=None):
+        if value not in choices:
+            raise ValueError('The value must be one of {}'.format(', '.join(choices)))
+        return value
+    return parse
+
+
+def sort_parameter(value, name=None, operator=None):
+    """
+    Type of the `_sort` query parameter: a comma separated list of search parameters, each one prefixed by `-`
+    for descending order
+    :return: a list of tuples with the name of the search parameter and True if the order is descending
+    """
+    keys = []
+    for key in value.split(','):
+        descending = key.startswith('-')
+        key = key[1:] if descending else key
+        if not key:
+            raise ValueError('Invalid sort')
+        keys.append((key, descending))
+    return keys
+
+
+def elements_parameter(value, name=None, operator=None):
+    """
+    Type of the `_elements` query parameter: a comma separated list of the names of the elements to return
+    :return: the list of the names
+    """
+    elements = [element.strip() for element in value.split(',')]
+    if not all(elements):
+        raise ValueError('Invalid elements')
+    return elements
+
+
+class SearchParser(object):
+    """
+    A parser of the search parameters of a resource type, compiled once from the :class:`Argument` returned by
+    :func:`query_argument_type_factory`. Every parameter name, with each of its modifiers, is mapped to the type
+    that parses it, so that a request is parsed looking up only the query parameters it has, instead of
+    checking every argument with every modifier. The parser is immutable, so it can be shared by the requests
+    """
+
+    def __init__(self, arguments):
+        handlers = {}
+        # the relevance of a text search is a sort key of every resource type
+        dests = {search.SCORE: search.SCORE}
+        for argument in arguments:
+            dests[argument.name] = argument.dest or argument.name
+            for operator in argument.operators:
+                key = argument.name + operator.replace('=', '', 1)
+                handlers[key] = (argument.name, argument.dest or argument.name, argument.type, operator)
+        self._handlers = MappingProxyType(handlers)
+        self._dests = MappingProxyType(dests)
+
+    def parse(self, args):
+        """
+        Parse the query parameters. The parameters that are not supported are ignored and, if a parameter is
+        repeated, only its first value is used. The names of the search parameters of `_sort` are replaced by
+        their destination names
+        :param args: the MultiDict with the query parameters
+        :return: a dict with the parsed value of each parameter of the query, by destination name
+        """
+        parsed = {}
+        errors = {}
+        for key in args:
+            handler = self._handlers.get(key)
+            if handler is None:
+                continue
+            name, dest, typ, operator = handler
+            if dest in parsed:
+                continue
+            try:
+                parsed[dest] = typ(args[key], name, operator)
+            except (ValueError, TypeError) as e:
+                errors[name] = str(e)
+        if parsed.get('sort') is not None:
+            # the search parameters of the sort are referred by destination name, as the parsed parameters
+            try:
+                parsed['sort'] = [(self._dests[key], descending) for key, descending in parsed['sort']]
+            except KeyError:
+                errors['_sort'] = 'Unknown search parameter'
+        if errors:
+            raise InvalidQueryParameterException(400, {'message': errors})
+        return parsed
@@ -0,0 +1,46 @@
+"""
+Phonetic encoding of the names, for the `phonetic` search parameter. The names are encoded with the American
+Soundex, that maps the names that sound alike in English, e.g. Smith and Smyth, to the same 4 character key. The
+keys are computed when the names are written and stored in indexed columns, so that a phonetic search is an
+equality on an index
+"""
+from fhirserver.search import normalize
+
+# the digit of each consonant, while the vowels, H, W and Y have none
+SOUNDEX_CODES = {letter: digit for digit, letters in enumerate(('BFPV', 'CGJKQSXZ', 'DT', 'L', 'MN', 'R'), 1)
+                 for letter in letters}
+
+SOUNDEX_LENGTH = 4
+
+
+def soundex(name):
+    """
+    :return: the Soundex key of :arg:`name`, or None if it has no letters. The accents are ignored, as the
+        characters other than the letters A to Z
+    """
+    if name is None:
+        return None
+    letters = [char for char in normalize(name).upper() if 'A' <= char <= 'Z']
+    if not letters:
+        return None
+    key = letters[0]
+    previous = SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        code = SOUNDEX_CODES.get(letter)
+        if code is not None and code != previous:
+            key += str(code)
+            if len(key) == SOUNDEX_LENGTH:
+                break
+        # the same digits separated by H or W are coded once, while a vowel separates them
+        if letter not in 'HW':
+            previous = code
+    return key.ljust(SOUNDEX_LENGTH, '0')
+
+
+def first_name_soundex(given_names):
+    """
+    :param given_names: the given names, separated by spaces
+    :return: the Soundex key of the first given name, the one the person is called by, or None if there is none
+    """
+    names = given_names.split() if given_names is not None else []
+    return soundex(names[0]) if names else None
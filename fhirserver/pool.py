@@ -0,0 +1,132 @@
+"""
+Configuration and metrics of the database connection pool. The pool is a :class:`MeteredQueuePool`, that
+measures how long the requests wait for a connection and how often the pool overflows or times out, so that
+its saturation can be monitored. The SQLite databases get the pragmas configured by SQLITE_PRAGMAS, e.g. the WAL
+journal mode, that lets the readers work concurrently with a writer
+"""
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics(object):
+    """
+    The counters of the checkouts of a pool
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+        self.overflows = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, overflowed, timed_out=False):
+        """
+        :param seconds: the time waited for the connection
+        :param overflowed: whether a connection beyond the size of the pool has been opened
+        :param timed_out: whether the checkout failed because no connection was available
+        """
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.checkout_time += seconds
+            self.max_checkout_time = max(self.max_checkout_time, seconds)
+            if overflowed:
+                self.overflows += 1
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    A :class:`QueuePool` that keeps the :class:`PoolMetrics` of its checkouts
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        pool = super(MeteredQueuePool, self).recreate()
+        # the pool is recreated e.g. when the database is restarted, but the metrics are the same
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        overflow = self.overflow()
+        try:
+            connection = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.metrics.observe(time.perf_counter() - start, False, timed_out=True)
+            raise
+        # the overflow counts the connections opened, starting from minus the size of the pool
+        self.metrics.observe(time.perf_counter() - start, self.overflow() > max(overflow, 0))
+        return connection
+
+
+def _is_sqlite_memory(url):
+    return url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """
+    Return the options of the engine, used as SQLALCHEMY_ENGINE_OPTIONS, from the DB_POOL_* settings. The
+    in-memory SQLite databases have a single connection, so they keep the pool of Flask-SQLAlchemy
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if _is_sqlite_memory(url):
+        return {}
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if url.drivername.startswith('sqlite'):
+        # the pooled connections are used by several threads, one at a time
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """
+    Execute the :arg:`pragmas`, a dict of name and value, on every new connection of a SQLite engine
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def execute_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+
+def pool_stats(engine):
+    """
+    :return: a dict with the state and the metrics of the connection pool of :arg:`engine`, empty if the pool is
+        not a :class:`MeteredQueuePool`
+    """
+    pool = engine.pool
+    if not isinstance(pool, MeteredQueuePool):
+        return {}
+    metrics = pool.metrics
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'checkouts': metrics.checkouts,
+        'checkout_time': metrics.checkout_time,
+        'max_checkout_time': metrics.max_checkout_time,
+        'overflows': metrics.overflows,
+        'timeouts': metrics.timeouts,
+    }
@@ -0,0 +1,95 @@
+"""
+Profiling of single requests and log of the slow queries.
+
+A request is profiled when it has the PROFILING_HEADER header or, at random, with probability
+PROFILING_SAMPLE_RATE. The phases of a profiled request, measured as for the metrics in
+:class:`fhirserver.metrics.Interaction`, are returned in the `Server-Timing` header and logged by the logger
+`fhirserver.profiling`. The body of a streamed response is written after its headers, so their `Server-Timing`
+only has the phases before the streaming, while the log has all of them.
+
+The queries of the DAOs that take more than SLOW_QUERY_THRESHOLD_MS milliseconds, from their execution to the
+fetch of their last row, are logged with their SQL and number of rows by the logger `fhirserver.slow_queries`.
+The parameters of the queries are the searched values, e.g. names and birthdates of patients, so they are
+logged only if SLOW_QUERY_LOG_PARAMETERS is set, e.g. on a development server. With PROFILING_HEADER and
+SLOW_QUERY_THRESHOLD_MS empty and a sample rate of 0, the only cost is a lookup in the configuration per request
+and per query
+"""
+import logging
+import random
+import time
+
+from flask import current_app, has_app_context, request
+from flask_sqlalchemy import BaseQuery
+
+logger = logging.getLogger('fhirserver.profiling')
+slow_query_logger = logging.getLogger('fhirserver.slow_queries')
+
+
+def is_profiled(config):
+    """
+    :return: True if the current request has to be profiled
+    """
+    header = config['PROFILING_HEADER']
+    if header and request.headers.get(header, '').lower() in ('1', 'true', 'yes'):
+        return True
+    sample_rate = config['PROFILING_SAMPLE_RATE']
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def server_timing(interaction):
+    """
+    :return: the value of the `Server-Timing` header with the phases of :arg:`interaction` so far, in milliseconds
+    """
+    metrics = ['{};dur={:.3f}'.format(phase, seconds * 1000) for phase, seconds in interaction.phases.items()]
+    metrics.append('total;dur={:.3f}'.format(interaction.elapsed() * 1000))
+    return ', '.join(metrics)
+
+
+def log_profile(interaction, status):
+    phases = ' '.join('{}={:.3f}ms'.format(phase, seconds * 1000) for phase, seconds in interaction.phases.items())
+    logger.info('%s %s%s %s: total=%.3fms %s queries=%d', interaction.interaction, interaction.resource_type,
+                '?' + interaction.search_params if interaction.search_params else '', status,
+                interaction.elapsed() * 1000, phases, interaction.queries)
+
+
+class ProfiledQuery(BaseQuery):
+    """
+    The query class of the sessions, that logs the slow queries
+    """
+
+    def __iter__(self):
+        threshold = current_app.config['SLOW_QUERY_THRESHOLD_MS'] if has_app_context() else None
+        if not threshold:
+            return super().__iter__()
+        return self._logged_iter(threshold / 1000)
+
+    def _logged_iter(self, threshold):
+        # only the time spent in the database is counted, not the time the caller spends on each row
+        start = time.perf_counter()
+        rows = super().__iter__()
+        elapsed = time.perf_counter() - start
+        row_count = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    elapsed += time.perf_counter() - start
+                    return
+                elapsed += time.perf_counter() - start
+                row_count += 1
+                yield row
+        finally:
+            if elapsed >= threshold:
+                self._log_slow_query(elapsed, row_count)
+
+    def _log_slow_query(self, elapsed, row_count):
+        bind = self.session.get_bind(self._bind_mapper(), clause=self.statement)
+        compiled = self.statement.compile(dialect=bind.dialect)
+        if current_app.config['SLOW_QUERY_LOG_PARAMETERS']:
+            slow_query_logger.warning('Slow query (%.3fms, %d rows): %s; parameters: %r', elapsed * 1000,
+                                      row_count, compiled, compiled.params)
+        else:
+            slow_query_logger.warning('Slow query (%.3fms, %d rows): %s; parameters: %d redacted', elapsed * 1000,
+                                      row_count, compiled, len(compiled.params))
@@ -0,0 +1,123 @@
+"""
+Routing of the read queries to the read replicas of the database. The replicas are configured by
+DB_REPLICA_URIS and become the binds `replica-<n>` of Flask-SQLAlchemy. The DAOs run the queries of the read and
+search interactions on :func:`read_session` and write on `db.session`, that is bound to the primary.
+
+The replicas lag behind the primary, so a client that has just written a resource could read an old version.
+For read-your-writes consistency, after a write the client is pinned to the primary for DB_REPLICA_STICKINESS
+seconds: the time of the last write is kept in a dedicated cookie of the client, and in the request context for
+the rest of the request. The cookie is not signed, so that it doesn't depend on the SECRET_KEY: a client that
+forges it can only send its own reads to the primary, as it would by writing
+"""
+import itertools
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy.orm import Session
+
+from fhirserver import db
+
+# the prefix of the names of the binds of the replicas
+REPLICA_BIND = 'replica-'
+# the cookie with the time of the last write of the client
+LAST_WRITE_COOKIE = 'fhir_last_write'
+
+
+def replica_binds(uris):
+    """
+    :param uris: the list of the URIs of the replicas
+    :return: the SQLALCHEMY_BINDS of the replicas
+    """
+    return {'{}{}'.format(REPLICA_BIND, index): uri for index, uri in enumerate(uris)}
+
+
+class ReplicaRouter(object):
+    """
+    Chooses the database of the read queries of the requests, balancing them over the replicas round-robin
+    """
+
+    def __init__(self, app):
+        self.binds = sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {} if key.startswith(REPLICA_BIND))
+        self.stickiness = app.config['DB_REPLICA_STICKINESS']
+        self._next = itertools.count()
+        app.teardown_appcontext(self.close)
+        app.after_request(self.set_cookie)
+
+    def is_sticky(self):
+        """
+        :return: True if the client has written recently, so it has to read from the primary
+        """
+        if g.get('replica_wrote'):
+            return True
+        if not has_request_context():
+            return False
+        try:
+            last_write = float(request.cookies[LAST_WRITE_COOKIE])
+        except (KeyError, ValueError):
+            return False
+        # a time in the future is not valid, so a client can't pin itself to the primary forever
+        return 0 <= time.time() - last_write < self.stickiness
+
+    def session(self):
+        """
+        :return: the session for the read queries of the current request. All the queries of a request use the
+            same replica, so that they see the same snapshot
+        """
+        if not self.binds or self.is_sticky():
+            return db.session
+        if 'replica_session' not in g:
+            bind = self.binds[next(self._next) % len(self.binds)]
+            g.replica_session = Session(bind=db.get_engine(current_app, bind), query_cls=db.Query)
+        return g.replica_session
+
+    def mark_write(self):
+        g.replica_wrote = True
+        self.close()
+
+    def set_cookie(self, response):
+        """
+        Send the time of the write of the request, if any, to the client
+        """
+        if g.get('replica_wrote'):
+            response.set_cookie(LAST_WRITE_COOKIE, '{:.3f}'.format(time.time()), max_age=self.stickiness,
+                                httponly=True, samesite='Lax')
+        return response
+
+    @staticmethod
+    def close(exception=None):
+        replica_session = g.pop('replica_session', None)
+        if replica_session is not None:
+            replica_session.close()
+
+
+def _get_router():
+    return current_app.extensions.get('replicas')
+
+
+def read_session():
+    """
+    :return: the session for the read queries, bound to a replica or, if there are no replicas or the client
+        has written recently, to the primary
+    """
+    router = _get_router()
+    if router is None:
+        return db.session
+    return router.session()
+
+
+def reads_from_replica():
+    """
+    :return: whether the read queries of the current request go to a replica
+    """
+    router = _get_router()
+    return router is not None and bool(router.binds) and not router.is_sticky()
+
+
+def mark_write():
+    """
+    Pin the client to the primary after a write. It must be called after the write is committed, since a
+    replica session opened before the commit would not see it
+    """
+    router = _get_router()
+    if router is not None:
+        router.mark_write()
@@ -1,3 +1,9 @@
 from .patient import PatientListResource, PatientResource
+from .generic import RESOURCE_DEFINITIONS, resource_classes
 
-RESOURCES = ['Patient']
+# the rest resources of the resource types without a hand-written model, that are stored by the generic
+# resource store, are created from their definitions
+for _definition in RESOURCE_DEFINITIONS:
+    globals().update(resource_classes(_definition))
+
+RESOURCES = ['Patient'] + [definition.resource_type for definition in RESOURCE_DEFINITIONS]
@@ -0,0 +1,341 @@
+import os
+import re
+import uuid
+
+from flask import request, current_app, send_from_directory
+from flask_restful import reqparse, Resource
+from flask_restful.reqparse import Argument
+from werkzeug.exceptions import HTTPException
+
+from fhirserver import resources, ISSUE_TYPE
+from fhirserver.bulk.export import export_resources
+from fhirserver.bulk.importer import ImportState, import_resources
+from fhirserver.exceptions import InvalidHeaderException, InvalidQueryParameterException, NotFoundException, \
+    OperationFailedException, InvalidElementException
+from fhirserver.jobs import Job, JOB_STATUS, process_owner, owner_alive
+from fhirserver.resources.router import BaseListResource, _get_resource
+
+EXPORT_JOB = 'export'
+IMPORT_JOB = 'import'
+NDJSON_FORMATS = ('application/fhir+ndjson', 'application/ndjson', 'ndjson')
+
+
+def _resource_types(value, name=None, operator=None):
+    """
+    Type of the `_type` parameter: a comma separated list of supported resource types
+    """
+    resource_types = value.split(',')
+    if any(resource_type not in resources.RESOURCES for resource_type in resource_types):
+        raise ValueError('Unsupported resource type')
+    return resource_types
+
+
+def _parse_prefer_header():
+    """
+    Check that the client asked for an asynchronous response, as required by the FHIR async request pattern
+    """
+    parser = reqparse.RequestParser(bundle_errors=True)
+    parser.add_argument('Prefer', type=str, location='headers', choices=('respond-async',), required=True)
+    try:
+        parser.parse_args()
+    except HTTPException as e:
+        raise InvalidHeaderException(e.code, e.data)
+
+
+# the ids of the jobs, that are part of the paths of their files
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _export_state_path(job_id):
+    """
+    :return: the state file of an export job, in its output directory, so that all the processes can read it
+    """
+    if JOB_ID.match(job_id) is None:
+        raise NotFoundException
+    return os.path.join(current_app.config['BULK_EXPORT_DIR'], job_id, 'job.json')
+
+
+def _get_job(job_id, kind, state_path=None):
+    job = current_app.extensions['jobs'].get(job_id, kind, state_path)
+    if job is None or job.status == JOB_STATUS.CANCELLED:
+        raise NotFoundException
+    return job
+
+
+def _in_progress_response(progress):
+    headers = {
+        'X-Progress': progress,
+        'Retry-After': str(current_app.config['BULK_RETRY_AFTER'])
+    }
+    return '', 202, headers
+
+
+class ExportResource(Resource):
+    """
+    Kick-off of the $export operation, at system level or for a resource type
+    """
+
+    @staticmethod
+    def _parse_parameters():
+        parser = reqparse.RequestParser()
+        parser.add_argument(Argument('_outputFormat', dest='output_format', choices=NDJSON_FORMATS, location='args'))
+        parser.add_argument(Argument('_type', dest='types', type=_resource_types, location='args'))
+        try:
+            return parser.parse_args()
+        except HTTPException as e:
+            raise InvalidQueryParameterException(e.code, e.data)
+
+    def get(self, resource_type=None):
+        if resource_type is not None and resource_type not in resources.RESOURCES:
+            raise NotFoundException
+
+        BaseListResource._parse_headers()
+        _parse_prefer_header()
+        args = self._parse_parameters()
+
+        resource_types = args['types'] or resources.RESOURCES
+        if resource_type is not None:
+            resource_types = [rt for rt in resource_types if rt == resource_type]
+        export_resources_list = [(rt, _get_resource('{}ListResource'.format(rt))) for rt in resource_types]
+
+        config = current_app.config
+        job_id = uuid.uuid4().hex
+        # the state of the job is saved in its output directory, which is deleted when the job is removed
+        job = Job(EXPORT_JOB, request.url, job_id, _export_state_path(job_id))
+        output_dir = os.path.dirname(job.state_path)
+        current_app.extensions['jobs'].submit(job, export_resources, export_resources_list, output_dir,
+                                              config['BULK_EXPORT_CHUNK_SIZE'], config['BULK_EXPORT_GZIP'])
+
+        headers = {
+            'Content-Location': '{}$export-status/{}'.format(request.url_root, job.id)
+        }
+        return '', 202, headers
+
+
+class ExportStatusResource(Resource):
+    """
+    Status polling of an $export job. When the job is completed, it returns the manifest with the urls of the
+    exported files. The job can be polled, and removed, by any process of the server
+    """
+
+    def get(self, job_id):
+        job = _get_job(job_id, EXPORT_JOB, _export_state_path(job_id))
+        if job.status == JOB_STATUS.FAILED:
+            raise OperationFailedException(job.error)
+        if job.status != JOB_STATUS.COMPLETED:
+            return _in_progress_response(job.progress or job.status)
+
+        manifest = {
+            'transactionTime': job.transaction_time.isoformat() + 'Z',
+            'request': job.request_url,
+            'requiresAccessToken': False,
+            'output': [{
+                'type': output['type'],
+                'url': '{}$export-file/{}/{}'.format(request.url_root, job.id, output['file']),
+                'count': output['count']
+            } for output in job.result],
+            'error': []
+        }
+        return manifest, 200, {'Content-Type': 'application/json'}
+
+    def delete(self, job_id):
+        state_path = _export_state_path(job_id)
+        _get_job(job_id, EXPORT_JOB, state_path)
+        # the files are deleted by the cleanup of the job, once it's no longer writing them
+        current_app.extensions['jobs'].remove(job_id, state_path)
+        return '', 202
+
+
+class ExportFileResource(Resource):
+    """
+    Download of a file of a completed $export job. Range requests are supported, so that clients can resume the
+    download of large files
+    """
+
+    def get(self, job_id, file_name):
+        job = _get_job(job_id, EXPORT_JOB, _export_state_path(job_id))
+        if job.status != JOB_STATUS.COMPLETED or file_name not in [output['file'] for output in job.result]:
+            raise NotFoundException
+
+        mimetype = 'application/gzip' if file_name.endswith('.gz') else 'application/fhir+ndjson'
+        return send_from_directory(os.path.join(current_app.config['BULK_EXPORT_DIR'], job.id), file_name,
+                                   mimetype=mimetype, conditional=True)
+
+
+def _import_state_path(job_id):
+    return os.path.join(current_app.config['BULK_IMPORT_STATE_DIR'], '{}.json'.format(job_id))
+
+
+def _get_import_state(job_id):
+    try:
+        return ImportState.load(_import_state_path(job_id))
+    except (OSError, ValueError):
+        raise NotFoundException
+
+
+def _remove_files(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _import_running(state):
+    """
+    :return: whether the job of an import is running, in this process or in another one that renews its lease
+    """
+    if state.owner is not None and state.owner == process_owner():
+        job = current_app.extensions['jobs'].get(state.job_id, IMPORT_JOB)
+        return job is not None and not job.done
+    return owner_alive(state.owner, state.heartbeat, current_app.config['BULK_JOB_LEASE'])
+
+
+def _start_import(state):
+    """
+    Start, or resume, the job of an import. It's called with the lock of the state held, so that the state records
+    its owner before any other process can check if it's running
+    """
+    state.owner = process_owner()
+    state.error = None
+    state.save()
+    job = Job(IMPORT_JOB, state.request_url, state.job_id)
+    job.progress = state.progress
+    job.when_done(lambda: state.release(job.error))
+    import_resources_map = {input_file['type']: _get_resource('{}ListResource'.format(input_file['type']))
+                            for input_file in state.inputs}
+    current_app.extensions['jobs'].submit(job, import_resources, state, import_resources_map,
+                                          current_app.config['BULK_IMPORT_CHUNK_SIZE'])
+    headers = {
+        'Content-Location': '{}$import-status/{}'.format(request.url_root, job.id)
+    }
+    return '', 202, headers
+
+
+class ImportResource(Resource):
+    """
+    Kick-off of the $import operation. The body is a Parameters resource with the `inputFormat` and one or more
+    `input` parameters, each one with the `type` of the resources and the `url` of an NDJSON file. The files must
+    be in the local directory BULK_IMPORT_DIR
+    """
+
+    @staticmethod
+    def _input_path(url, element):
+        import_dir = os.path.realpath(current_app.config['BULK_IMPORT_DIR'])
+        path = url[len('file://'):] if url.startswith('file://') else url
+        path = os.path.realpath(os.path.join(import_dir, path))
+        if os.path.commonpath([import_dir, path]) != import_dir or not os.path.isfile(path):
+            raise InvalidElementException("The input file is not available", element)
+        return path
+
+    def _parse_parameters(self, data):
+        if not isinstance(data, dict) or data.get('resourceType') != 'Parameters':
+            raise InvalidElementException("The body must be a Parameters resource", 'resourceType')
+
+        inputs = []
+        for index, parameter in enumerate(data.get('parameter', [])):
+            element = 'parameter[{}]'.format(index)
+            if parameter.get('name') == 'inputFormat':
+                input_format = parameter.get('valueCode', parameter.get('valueString'))
+                if input_format not in NDJSON_FORMATS:
+                    raise InvalidElementException("Only NDJSON is supported", element, ISSUE_TYPE.NOT_SUPPORTED)
+            elif parameter.get('name') == 'input':
+                parts = {part.get('name'): part for part in parameter.get('part', [])}
+                resource_type = parts.get('type', {}).get('valueCode')
+                if resource_type not in resources.RESOURCES:
+                    raise InvalidElementException("Unsupported resource type", '{}.part.type'.format(element),
+                                                  ISSUE_TYPE.NOT_SUPPORTED)
+                url = parts.get('url', {}).get('valueUri')
+                if url is None:
+                    raise InvalidElementException("Missing input url", '{}.part.url'.format(element),
+                                                  ISSUE_TYPE.REQUIRED)
+                inputs.append({
+                    'type': resource_type,
+                    'url': url,
+                    'path': self._input_path(url, '{}.part.url'.format(element)),
+                    'count': 0
+                })
+
+        if not inputs:
+            raise InvalidElementException("At least one input is required", 'parameter', ISSUE_TYPE.REQUIRED)
+        return inputs
+
+    def post(self):
+        BaseListResource._parse_headers()
+        _parse_prefer_header()
+        inputs = self._parse_parameters(request.json)
+
+        job = Job(IMPORT_JOB, request.url)
+        os.makedirs(current_app.config['BULK_IMPORT_STATE_DIR'], exist_ok=True)
+        state = ImportState(_import_state_path(job.id), job.id, request.url,
+                            job.transaction_time.isoformat() + 'Z', inputs)
+        with state.locked():
+            return _start_import(state)
+
+
+class ImportStatusResource(Resource):
+    """
+    Status polling of an $import job. A POST resumes a job that failed or was interrupted, starting from the last
+    committed chunk. The status is read from the saved state, so that any process of the server can report it
+    """
+
+    @staticmethod
+    def _manifest(state):
+        manifest = {
+            'transactionTime': state.transaction_time,
+            'request': state.request_url,
+            'requiresAccessToken': False,
+            'output': [{
+                'type': input_file['type'],
+                'inputUrl': input_file['url'],
+                'count': input_file['count']
+            } for input_file in state.inputs],
+            'error': []
+        }
+        if state.errors > 0:
+            manifest['error'].append({
+                'type': 'OperationOutcome',
+                'url': '{}$import-errors/{}'.format(request.url_root, state.job_id),
+                'count': state.errors
+            })
+        return manifest
+
+    def get(self, job_id):
+        state = _get_import_state(job_id)
+        if _import_running(state):
+            return _in_progress_response(state.progress)
+        if state.input_index < len(state.inputs):
+            raise OperationFailedException(
+                state.error or "The import was interrupted, it can be resumed with a POST to this url")
+        return self._manifest(state), 200, {'Content-Type': 'application/json'}
+
+    def post(self, job_id):
+        # the state is checked and the job started with the lock held, so that only one request resumes it
+        with _get_import_state(job_id).locked():
+            state = _get_import_state(job_id)
+            if _import_running(state):
+                return _in_progress_response(state.progress)
+            if state.input_index == len(state.inputs):
+                return self._manifest(state), 200, {'Content-Type': 'application/json'}
+            return _start_import(state)
+
+    def delete(self, job_id):
+        state = _get_import_state(job_id)
+        current_app.extensions['jobs'].remove(job_id)
+        # a running job, of any process, stops at its next checkpoint, when it finds that the state was deleted
+        with state.locked():
+            _remove_files(state.path, state.errors_path)
+        _remove_files('{}.lock'.format(state.path))
+        return '', 202
+
+
+class ImportErrorsResource(Resource):
+    """
+    Download of the errors of an $import job. Each line has the `input` url and the `line` number of a resource
+    that was not imported, with the `outcome` of the validation
+    """
+
+    def get(self, job_id):
+        state = _get_import_state(job_id)
+        if not os.path.exists(state.errors_path):
+            raise NotFoundException
+        return send_from_directory(os.path.dirname(state.errors_path), os.path.basename(state.errors_path),
+                                   mimetype='application/fhir+ndjson', conditional=True)
@@ -0,0 +1,104 @@
+from flask import request
+from flask_restful import Resource
+
+from fhirserver.consts import SEARCH_TOTAL
+from fhirserver.conditional import conditional_read
+from fhirserver.dao.generic import ResourceDefinition, GenericDAO
+from fhirserver.parser_types import query_argument_type_factory, FHIRSearchTypes
+
+# the resource types stored by the generic resource store. Each search parameter is declared with its type and
+# the expression of the elements it indexes, see :func:`fhirserver.dao.generic.extract`
+RESOURCE_DEFINITIONS = [
+    ResourceDefinition('Practitioner', {
+        'active': (FHIRSearchTypes.TOKEN, 'active'),
+        'address': (FHIRSearchTypes.STRING, 'address'),
+        'family': (FHIRSearchTypes.STRING, 'name.family'),
+        'gender': (FHIRSearchTypes.TOKEN, 'gender'),
+        'given': (FHIRSearchTypes.STRING, 'name.given'),
+        'identifier': (FHIRSearchTypes.TOKEN, 'identifier'),
+        'name': (FHIRSearchTypes.STRING, 'name'),
+        'telecom': (FHIRSearchTypes.TOKEN, 'telecom'),
+    }, ('identifier', 'active', 'name', 'telecom', 'address', 'gender', 'birthDate')),
+    ResourceDefinition('Organization', {
+        'active': (FHIRSearchTypes.TOKEN, 'active'),
+        'address': (FHIRSearchTypes.STRING, 'address'),
+        'identifier': (FHIRSearchTypes.TOKEN, 'identifier'),
+        'name': (FHIRSearchTypes.STRING, 'name | alias'),
+        'type': (FHIRSearchTypes.TOKEN, 'type'),
+    }, ('identifier', 'active', 'type', 'name', 'alias', 'partOf')),
+    ResourceDefinition('Observation', {
+        'category': (FHIRSearchTypes.TOKEN, 'category'),
+        'code': (FHIRSearchTypes.TOKEN, 'code'),
+        'date': (FHIRSearchTypes.DATE, 'effectiveDateTime | effectivePeriod'),
+        'identifier': (FHIRSearchTypes.TOKEN, 'identifier'),
+        'status': (FHIRSearchTypes.TOKEN, 'status'),
+        'value-quantity': (FHIRSearchTypes.QUANTITY, 'valueQuantity'),
+    }, ('identifier', 'basedOn', 'status', 'code', 'subject', 'context', 'effective', 'issued', 'performer',
+        'value', 'related', 'component')),
+    ResourceDefinition('RiskAssessment', {
+        'identifier': (FHIRSearchTypes.TOKEN, 'identifier'),
+        'method': (FHIRSearchTypes.TOKEN, 'method'),
+        'probability': (FHIRSearchTypes.NUMBER, 'prediction.probabilityDecimal | prediction.probabilityRange'),
+        'risk': (FHIRSearchTypes.TOKEN, 'prediction.qualitativeRisk'),
+        'status': (FHIRSearchTypes.TOKEN, 'status'),
+    }, ('identifier', 'basedOn', 'parent', 'status', 'method', 'code', 'subject', 'encounter', 'occurrence',
+        'condition', 'performer', 'reasonCode', 'reasonReference', 'basis', 'prediction', 'mitigation', 'note')),
+]
+
+
+class GenericResource(Resource):
+    """
+    Rest resource for a resource type of the generic resource store. The subclasses set the :attr:`dao`
+    """
+    dao = None
+
+    def get(self, resource_id):
+        return conditional_read(self.dao.resource_type, resource_id, lambda: self.dao.get(resource_id),
+                                lambda: self.dao.get_version(resource_id))
+
+
+class GenericListResource(Resource):
+    """
+    Rest list resource for a resource type of the generic resource store. The subclasses set the :attr:`dao`
+    """
+    dao = None
+
+    @property
+    def SUMMARY_ELEMENTS(self):
+        return self.dao.definition.summary_elements
+
+    def get_search_parameters(self):
+        return [query_argument_type_factory(name, typ)
+                for name, (typ, _) in self.dao.definition.search_parameters.items()]
+
+    def get(self, arguments, count, cursor=None, sort=None, total=SEARCH_TOTAL.ACCURATE, elements=None):
+        return self.dao.search(arguments, count, cursor, sort, total, elements)
+
+    def count(self, arguments):
+        return self.dao.count(arguments)
+
+    def parse(self, data):
+        return self.dao.parse(data)
+
+    def post(self):
+        return self.dao.create(self.parse(request.json))
+
+    def export(self, batch_size):
+        return self.dao.iter_all(batch_size)
+
+    def bulk_post(self, items):
+        return self.dao.bulk_create(items)
+
+
+def resource_classes(definition):
+    """
+    Create the rest resources of a resource type of the generic resource store
+    :param definition: the :class:`ResourceDefinition` of the resource type
+    :return: a dict with the `<resource type>Resource` and `<resource type>ListResource` classes by name
+    """
+    dao = GenericDAO(definition)
+    names = ('{}Resource'.format(definition.resource_type), '{}ListResource'.format(definition.resource_type))
+    return {
+        names[0]: type(names[0], (GenericResource,), {'dao': dao}),
+        names[1]: type(names[1], (GenericListResource,), {'dao': dao}),
+    }
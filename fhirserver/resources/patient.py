@@ -1,10 +1,10 @@
 from flask import request
 from flask_restful import Resource
 
-from fhirclient.models.fhirabstractbase import FHIRValidationError
 from fhirclient.models.patient import Patient as FHIRPatient
 from fhirserver import db
-from fhirserver.exceptions import InvalidBodyException, NotFoundException
+from fhirserver.consts import SEARCH_TOTAL
+from fhirserver.conditional import conditional_read
 from fhirserver.dao.patient import PatientDAO
 from fhirserver.parser_types import query_argument_type_factory, FHIRSearchTypes
 
@@ -22,16 +22,19 @@ class PatientResource(Resource):
     Rest resource for Patient
     """
     def get(self, patient_id):
-        patient = PatientDAO.get(patient_id)
-        if patient is None:
-            raise NotFoundException
-        else:
-            return patient.as_json(), 200,
+        return conditional_read('Patient', patient_id, lambda: PatientDAO.get(patient_id),
+                                lambda: PatientDAO.get_version(patient_id))
 
 
 class PatientListResource(Resource):
 
+    # the elements of a Patient that are part of its summary, as defined by the FHIR specification
+    SUMMARY_ELEMENTS = ('identifier', 'active', 'name', 'telecom', 'gender', 'birthDate', 'deceased', 'address',
+                        'managingOrganization', 'link')
+
     def get_search_parameters(self):
+        # the parameters of the elements that are not stored in the database are answered with a 400, see
+        # `PatientDAO.SEARCH_PARAMETERS`
         arguments = [
             query_argument_type_factory('active', FHIRSearchTypes.TOKEN),
             query_argument_type_factory('address', FHIRSearchTypes.STRING),
@@ -39,7 +42,7 @@ class PatientListResource(Resource):
             query_argument_type_factory('address-country', FHIRSearchTypes.STRING),
             query_argument_type_factory('address-postalcode', FHIRSearchTypes.STRING),
             query_argument_type_factory('address-state', FHIRSearchTypes.STRING),
-            query_argument_type_factory('address-use', FHIRSearchTypes.STRING),
+            query_argument_type_factory('address-use', FHIRSearchTypes.TOKEN),
             query_argument_type_factory('birthdate', FHIRSearchTypes.DATE),
             query_argument_type_factory('death-date', FHIRSearchTypes.DATE),
             query_argument_type_factory('deceased', FHIRSearchTypes.TOKEN),
@@ -47,7 +50,7 @@ class PatientListResource(Resource):
             query_argument_type_factory('family', FHIRSearchTypes.STRING),
             query_argument_type_factory('gender', FHIRSearchTypes.TOKEN),
             query_argument_type_factory('general-practitioner', FHIRSearchTypes.REFERENCE),
-            query_argument_type_factory('given', FHIRSearchTypes.TOKEN),
+            query_argument_type_factory('given', FHIRSearchTypes.STRING),
             query_argument_type_factory('identifier', FHIRSearchTypes.TOKEN),
             query_argument_type_factory('language', FHIRSearchTypes.TOKEN),
             query_argument_type_factory('link', FHIRSearchTypes.REFERENCE),
@@ -59,16 +62,30 @@ class PatientListResource(Resource):
         ]
         return arguments
 
-    def get(self, arguments):
-        patients = PatientDAO.search(**arguments)
-        return patients
+    def get(self, arguments, count, cursor=None, sort=None, total=SEARCH_TOTAL.ACCURATE, elements=None):
+        return PatientDAO.search(arguments, count, cursor, sort, total, elements)
+
+    def count(self, arguments):
+        return PatientDAO.count(arguments)
+
+    @staticmethod
+    def parse(data):
+        """
+        Validate the json of a Patient
+        :return: the patient ready to be stored
+        """
+        return PatientDAO.parse(data)
 
     def post(self):
-        data = request.json
-        try:
-            patient = FHIRPatient(data)
-        except FHIRValidationError as e:
-            raise InvalidBodyException(e)
-        else:
-            res = PatientDAO.create(patient)
-            return res
+        patient = self.parse(request.json)
+        return PatientDAO.create(patient)
+
+    def export(self, batch_size):
+        return PatientDAO.iter_all(batch_size)
+
+    def bulk_post(self, items):
+        """
+        Insert several patients returned by :meth:`parse` at once. The caller commits the transaction
+        :return: the ids of the new patients
+        """
+        return PatientDAO.bulk_create(items)
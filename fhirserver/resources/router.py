@@ -1,12 +1,45 @@
-from flask import request
+import hashlib
+import json
+from urllib.parse import urlencode
+
+from flask import request, current_app, Response, stream_with_context
 from flask_restful import reqparse, Resource
+from flask_restful.reqparse import Argument
+from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+
+from fhirserver import db, resources, metrics, ISSUE_TYPE
+from fhirserver.conditional import not_modified, validators
+from fhirserver.exceptions import InvalidHeaderException, NotFoundException, FHIRServerException, \
+    InvalidElementException, InvalidBundleEntryException, InvalidBundleException, OperationFailedException
+from fhirserver.pagination import decode_cursor, page_size
+from fhirserver.consts import SEARCH_SUMMARY, SEARCH_TOTAL
+from fhirserver.replicas import mark_write
+from fhirserver.parser_types import FHIRSearchTypes, SearchParser, query_argument_type_factory, sort_parameter, \
+    choice_parameter, elements_parameter
 
-from fhirclient.models.bundle import Bundle, BundleEntry
-from fhirserver import resources
-from fhirserver.exceptions import InvalidHeaderException, NotFoundException, InvalidQueryParameterException
-from fhirserver.parser_types import FHIRSearchTypes, \
-    query_argument_type_factory
+# the search parameters common to all the resources. The ones that a resource type doesn't store are answered
+# with a 400, see :meth:`fhirserver.search.SearchRegistry.conditions`, so that they don't match every resource
+COMMON_SEARCH_PARAMETERS = [
+    query_argument_type_factory('_content', FHIRSearchTypes.STRING, 'content'),
+    query_argument_type_factory('_id', FHIRSearchTypes.TOKEN, 'id'),
+    query_argument_type_factory('_lastUpdated', FHIRSearchTypes.DATE, 'lastUpdated'),
+    query_argument_type_factory('_profile', FHIRSearchTypes.URI, 'profile'),
+    query_argument_type_factory('_query', FHIRSearchTypes.TOKEN, 'query'),
+    query_argument_type_factory('_security', FHIRSearchTypes.TOKEN, 'security'),
+    query_argument_type_factory('_source', FHIRSearchTypes.URI, 'source'),
+    query_argument_type_factory('_tag', FHIRSearchTypes.TOKEN, 'tag'),
+    query_argument_type_factory('_text', FHIRSearchTypes.STRING, 'text'),
+    Argument('_count', dest='count', type=page_size, location='args'),
+    Argument('_cursor', dest='cursor', type=decode_cursor, location='args'),
+    Argument('_sort', dest='sort', type=sort_parameter, location='args'),
+    Argument('_summary', dest='summary', type=choice_parameter(SEARCH_SUMMARY.TRUE, SEARCH_SUMMARY.COUNT,
+                                                               SEARCH_SUMMARY.FALSE), location='args'),
+    Argument('_elements', dest='elements', type=elements_parameter, location='args'),
+    Argument('_total', dest='total', type=choice_parameter(SEARCH_TOTAL.NONE, SEARCH_TOTAL.ESTIMATE,
+                                                           SEARCH_TOTAL.ACCURATE), location='args'),
+]
 
 
 def _get_resource(resource_cls_name):
@@ -21,6 +54,8 @@ def _get_resource(resource_cls_name):
 class BaseResource(Resource):
     def get(self, resource_type, resource_id):
         resource = _get_resource('{}Resource'.format(resource_type))
+        # only the known resource types are labels of the metrics, so that the requests can't add series
+        metrics.start_interaction(resource_type, 'read')
         return resource.get(resource_id)
 
 
@@ -48,45 +83,109 @@ class BaseListResource(Resource):
         return {name: value for name, value in args.items() if value is not None}
 
     @staticmethod
-    def _parse_search_parameters(resource_arguments):
+    def compile_search_parser(resource):
         """
-        Parse
-        :return:
+        Compile the parser of the search parameters of a resource type, with the parameters common to all the
+        resources and the ones returned by the `get_search_parameters` of :arg:`resource`
+        :return: a :class:`SearchParser`
         """
-        parser = reqparse.RequestParser()
-        parser.add_argument(query_argument_type_factory('_content', FHIRSearchTypes.STRING, 'content'))
-        parser.add_argument(query_argument_type_factory('_id', FHIRSearchTypes.TOKEN, 'id'))
-        parser.add_argument(query_argument_type_factory('_lastUpdated', FHIRSearchTypes.DATE, 'lastUpdated'))
-        parser.add_argument(query_argument_type_factory('_profile', FHIRSearchTypes.URI, 'profile'))
-        parser.add_argument(query_argument_type_factory('_query', FHIRSearchTypes.TOKEN, 'query'))
-        parser.add_argument(query_argument_type_factory('_security', FHIRSearchTypes.TOKEN, 'security'))
-        parser.add_argument(query_argument_type_factory('_source', FHIRSearchTypes.URI, 'source'))
-        parser.add_argument(query_argument_type_factory('_tag', FHIRSearchTypes.TOKEN, 'tag'))
+        return SearchParser(COMMON_SEARCH_PARAMETERS + resource.get_search_parameters())
 
-        for argument in resource_arguments:
-            parser.add_argument(argument)
+    @staticmethod
+    def _parse_search_parameters(resource_type):
+        parser = current_app.extensions['search_parsers'][resource_type]
+        return parser.parse(request.args)
 
-        try:
-            args = parser.parse_args()
-        except HTTPException as e:
-            raise InvalidQueryParameterException(e.code, e.data)
-        return {name: value for name, value in args.items() if value is not None}
+    @staticmethod
+    def _get_page_size(count):
+        """
+        Return the number of entries of a page, given the requested `_count`
+        """
+        if count is None:
+            return current_app.config['DEFAULT_PAGE_SIZE']
+        return min(count, current_app.config['MAX_PAGE_SIZE'])
+
+    @staticmethod
+    def _create_link(relation, **params):
+        """
+        Create a Bundle link to the current search, replacing the query parameters in :arg:`params`
+        """
+        args = request.args.to_dict(flat=False)
+        args.update(params)
+        return {
+            'relation': relation,
+            'url': '{}?{}'.format(request.base_url, urlencode(args, doseq=True))
+        }
+
+    @staticmethod
+    def _full_url(resource_type, resource_id):
+        return '{}{}/{}'.format(request.url_root, resource_type, resource_id)
 
     @staticmethod
-    def _create_bundle_response(entries):
-        bundle = Bundle()
-        bundle.type = 'searchset'
-        bundle.entry = []
-        bundle.total = len(entries)
-        for item in entries:
-            entry = BundleEntry()
-            entry.fullUrl = '{}{}'.format(request.base_url, item.id.value)
-            entry.resource = item
-            bundle.entry.append(entry)
+    def _collection_etag(page):
+        """
+        The ETag of a page of search results. It depends on the version of the whole result set and on the
+        query, so that each page and each search have their own ETag
+        """
+        if page.version is None:
+            return None
+        data = '{} {}'.format(request.full_path, page.version).encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def _create_links(self, page):
+        links = [self._create_link('self')]
+        if page.next_cursor is not None:
+            links.append(self._create_link('next', _cursor=page.next_cursor))
+        return links
+
+    def _create_bundle_response(self, resource_type, page):
+        """
+        Create the searchset Bundle json. The entries are the json of the resources, so the Bundle is built
+        directly as a dict instead of going through the fhirclient Bundle
+        """
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'searchset'
+        }
+        if page.total is not None:
+            bundle['total'] = page.total
+        entries = [{'fullUrl': self._full_url(resource_type, item['id']), 'resource': item} for item in page]
+        # empty arrays are not allowed in FHIR json
+        if entries:
+            bundle['entry'] = entries
+        # the links are created after the entries have been fetched, since the cursor of the next page is known
+        # only at that point
+        bundle['link'] = self._create_links(page)
         return bundle
 
+    def _stream_bundle_response(self, resource_type, page):
+        """
+        Serialize the searchset Bundle writing the entries one at a time, as they are fetched from the
+        database, so that the whole Bundle is never kept in memory. The links are written after the entries
+        since the cursor of the next page is known only at the end
+        """
+        yield '{"resourceType":"Bundle","type":"searchset"'
+        if page.total is not None:
+            yield ',"total":{}'.format(page.total)
+        # empty arrays are not allowed in FHIR json, so the entry element is opened with the first entry
+        separator = ',"entry":['
+        for item in page:
+            entry = {
+                'fullUrl': self._full_url(resource_type, item['id']),
+                'resource': item
+            }
+            with metrics.phase('render'):
+                data = json.dumps(entry, separators=(',', ':'))
+            yield separator + data
+            separator = ','
+        if separator == ',':
+            yield ']'
+        yield ',"link":{}}}'.format(json.dumps(self._create_links(page), separators=(',', ':')))
+
     def post(self, resource_type):
         resource = _get_resource('{}ListResource'.format(resource_type))
+        # only the known resource types are labels of the metrics, so that the requests can't add series
+        metrics.start_interaction(resource_type, 'create')
 
         self._parse_headers()
 
@@ -94,21 +193,203 @@ class BaseListResource(Resource):
 
         headers = self.base_headers.copy()
         headers.update({
-            'Location': '{}/{}'.format(request.base_url, item.id.value),
+            'Location': self._full_url(resource_type, item['id']),
         })
-        return item.as_json(), 201, headers
+        return item, 201, headers
 
     def get(self, resource_type):
         resource = _get_resource('{}ListResource'.format(resource_type))
+        # only the known resource types are labels of the metrics, so that the requests can't add series
+        metrics.start_interaction(resource_type, 'search-type')
+
+        with metrics.phase('parse'):
+            parsed_arguments = self._parse_search_parameters(resource_type)
+        # the names of the parameters are the shape of the query, while the paging doesn't change it. They are the
+        # parameters of the registry, and the metrics label only the queries with one of them
+        metrics.set_search_params(name for name in parsed_arguments if name not in ('count', 'cursor'))
+        count = self._get_page_size(parsed_arguments.pop('count', None))
+        cursor = parsed_arguments.pop('cursor', None)
+        sort = parsed_arguments.pop('sort', None)
+        summary = parsed_arguments.pop('summary', None)
+        elements = parsed_arguments.pop('elements', None)
+        total = parsed_arguments.pop('total', SEARCH_TOTAL.ACCURATE)
 
-        arguments = resource.get_search_parameters()
+        if summary == SEARCH_SUMMARY.COUNT:
+            # only the number of results is returned, so the matching resources are counted without loading them
+            bundle = {
+                'resourceType': 'Bundle',
+                'type': 'searchset',
+                'total': resource.count(parsed_arguments),
+                'link': [self._create_link('self')]
+            }
+            return bundle, 200, self.base_headers
 
-        parsed_arguments = self._parse_search_parameters(arguments)
+        if summary == SEARCH_SUMMARY.TRUE:
+            elements = resource.SUMMARY_ELEMENTS
+        page = resource.get(parsed_arguments, count, cursor, sort, total, elements)
 
-        items = resource.get(parsed_arguments)
+        # the conditional headers are checked before fetching the entries of the page
+        etag = self._collection_etag(page)
+        response = not_modified(etag, page.last_updated)
+        if response is not None:
+            return response
+        headers = self.base_headers.copy()
+        headers.update(validators(etag, page.last_updated))
 
-        bundle = self._create_bundle_response(items)
-        return bundle.as_json(), 200, self.base_headers
+        if current_app.config['STREAM_SEARCH_RESULTS']:
+            stream = stream_with_context(self._stream_bundle_response(resource_type, page))
+            return Response(stream, 200, headers, mimetype='application/fhir+json')
 
+        return self._create_bundle_response(resource_type, page), 200, headers
 
 
+class SystemResource(Resource):
+    """
+    Rest resource for the interactions at the server base. It processes batch and transaction Bundles, inserting
+    the resources of all the entries with one bulk insert per resource type in a single database transaction. If the
+    database rejects the bulk inserts, the entries are inserted one by one to find the ones that fail
+    """
+
+    BUNDLE_TYPES = ('batch', 'transaction')
+
+    def __init__(self):
+        self.base_headers = {
+            'Content-type': 'application/fhir+json'
+        }
+
+    @staticmethod
+    def _status(http_code):
+        return '{} {}'.format(http_code, HTTP_STATUS_CODES[http_code])
+
+    @staticmethod
+    def _get_entry_resource(entry):
+        """
+        Check the request of a Bundle entry
+        :return: a tuple with the resource type and the list resource which handles it
+        """
+        if not isinstance(entry, dict) or not isinstance(entry.get('request'), dict):
+            raise InvalidElementException("The entry has no request", 'request', ISSUE_TYPE.REQUIRED)
+        if entry['request'].get('method') != 'POST':
+            raise InvalidElementException("Only POST requests are supported", 'request.method',
+                                          ISSUE_TYPE.NOT_SUPPORTED)
+
+        resource_type = str(entry['request'].get('url', '')).strip('/')
+        resource = _get_resource('{}ListResource'.format(resource_type))
+
+        data = entry.get('resource')
+        if not isinstance(data, dict) or data.get('resourceType') != resource_type:
+            raise InvalidElementException("The resource doesn't match the request url", 'resource')
+        return resource_type, resource
+
+    @staticmethod
+    def _insert_entries(items, commit):
+        """
+        Insert the entries of a Bundle one by one, each one in its own database transaction, to find the ones that
+        the database rejects once their bulk insert failed
+        :param items: the items of the entries grouped by resource type
+        :param commit: whether to commit the entries, or to roll them back since they belong to a failed transaction
+        :return: a tuple with a dict of the locations of the inserted resources by entry index, and the list of the
+            tuples of the index of a failed entry and its exception
+        """
+        locations = {}
+        errors = []
+        for resource_type, (resource, type_items) in items.items():
+            for index, item in type_items:
+                try:
+                    resource_id = resource.bulk_post([item])[0]
+                    if commit:
+                        db.session.commit()
+                    else:
+                        db.session.rollback()
+                except SQLAlchemyError:
+                    current_app.logger.exception('Insert of the Bundle entry %s failed', index)
+                    db.session.rollback()
+                    errors.append((index, InvalidBundleEntryException(
+                        index, OperationFailedException("The resource could not be stored"), 'resource')))
+                else:
+                    locations[index] = '{}/{}'.format(resource_type, resource_id)
+        return locations, sorted(errors, key=lambda error: error[0])
+
+    def post(self):
+        BaseListResource._parse_headers()
+
+        data = request.json
+        if not isinstance(data, dict) or data.get('resourceType') != 'Bundle':
+            raise InvalidElementException("The body must be a Bundle", 'resourceType')
+        if data.get('type') not in self.BUNDLE_TYPES:
+            raise InvalidElementException("Only batch and transaction Bundles are supported", 'type',
+                                          ISSUE_TYPE.NOT_SUPPORTED)
+        transaction = data['type'] == 'transaction'
+
+        entries = data.get('entry', [])
+        max_entries = current_app.config['BUNDLE_MAX_ENTRIES']
+        if len(entries) > max_entries:
+            raise InvalidElementException("The Bundle has more than {} entries".format(max_entries), 'entry',
+                                          ISSUE_TYPE.TOO_COSTLY, 413)
+        responses = [None] * len(entries)
+        # the valid entries grouped by resource type, to insert them in bulk
+        items = {}
+        errors = []
+        for index, entry in enumerate(entries):
+            try:
+                resource_type, resource = self._get_entry_resource(entry)
+            except FHIRServerException as e:
+                errors.append((index, InvalidBundleEntryException(index, e)))
+                continue
+            try:
+                item = resource.parse(entry['resource'])
+            except FHIRServerException as e:
+                errors.append((index, InvalidBundleEntryException(index, e, 'resource')))
+                continue
+            items.setdefault(resource_type, (resource, []))[1].append((index, item))
+
+        if transaction and errors:
+            raise InvalidBundleException([e for _, e in errors])
+
+        locations = {}
+        try:
+            for resource_type, (resource, type_items) in items.items():
+                ids = resource.bulk_post([item for _, item in type_items])
+                for (index, _), resource_id in zip(type_items, ids):
+                    locations[index] = '{}/{}'.format(resource_type, resource_id)
+            db.session.commit()
+        except SQLAlchemyError:
+            current_app.logger.exception('Bulk insert of the Bundle entries failed')
+            db.session.rollback()
+            locations, insert_errors = self._insert_entries(items, not transaction)
+            if transaction:
+                if insert_errors:
+                    raise InvalidBundleException([e for _, e in insert_errors], 500)
+                # the entries are rejected only together, e.g. because they conflict
+                raise OperationFailedException("The Bundle could not be stored")
+            errors.extend(insert_errors)
+        except Exception:
+            db.session.rollback()
+            raise
+        if locations:
+            mark_write()
+
+        for index, location in locations.items():
+            responses[index] = {
+                'response': {
+                    'status': self._status(201),
+                    'location': location
+                }
+            }
+        for index, e in errors:
+            responses[index] = {
+                'response': {
+                    'status': self._status(e.http_code),
+                    'outcome': e.to_operation_outcome().as_json()
+                }
+            }
+
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': '{}-response'.format(data['type'])
+        }
+        # empty arrays are not allowed in FHIR json
+        if responses:
+            bundle['entry'] = responses
+        return bundle, 200, self.base_headers
+
@@ -0,0 +1,545 @@
+"""
+Registry of the search parameters of the resources. Every search parameter is mapped to the indexed columns or
+expressions of the database that store its values, so that each parameter is resolved by a predicate that the
+database can answer with an index
+"""
+import unicodedata
+import warnings
+
+from sqlalchemy import Column, String, or_, and_, false, true, inspect, select, func, bindparam, Index, union
+from sqlalchemy.exc import SAWarning
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BooleanClauseList
+
+from fhirserver.db_drivers import sqlalchemy as db_driver
+from fhirserver.exceptions import InvalidQueryParameterException
+from fhirserver.fulltext import TextMatch, TextScore, WORDS
+from fhirserver.ucum import unit_key
+
+# the sort key of the relevance of the results of a text search, see :meth:`SearchRegistry.sort_keys`
+SCORE = '_score'
+
+
+def normalize(value):
+    """
+    Normalize a string for the default string search, that ignores case, accents and spacing: the string is
+    lowercased, its accents are removed and its whitespace is collapsed
+    :return: the normalized string, or None if :arg:`value` is None
+    """
+    if value is None:
+        return None
+    decomposed = unicodedata.normalize('NFKD', value)
+    folded = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(folded.casefold().split())
+
+
+def shadow_column(source, encode, type_, index=True):
+    """
+    A column with the values of the column :arg:`source` encoded for a search, e.g. normalized or phonetic. The ORM
+    models keep it up to date when the source is set, see :func:`shadow_values`, while the inserts without it get
+    the default. The rows written before the column existed are filled by :func:`backfill_shadow_columns`
+    :param source: the name of the source column
+    :param encode: the function that encodes a value of the source, or None
+    :param type_: the type of the column
+    :param index: False if the column is indexed with other columns by the table
+    """
+    def default(context):
+        return encode(context.get_current_parameters().get(source))
+
+    return Column(type_, nullable=True, default=default, index=index, info={'shadow': (source, encode)})
+
+
+def shadow_values(table, source, value):
+    """
+    :return: a dict with the values of the shadow columns of :arg:`table` for the value of the column :arg:`source`
+    """
+    values = {}
+    for column in table.columns:
+        if column.info.get('shadow', (None,))[0] == source:
+            values[column.key] = column.info['shadow'][1](value)
+    return values
+
+
+def normalized_column(source, length, index=True):
+    """
+    A shadow column with the :func:`normalize` values of the column :arg:`source`, for the default string search.
+    Its values are compared by code point on every database, so that a prefix is a range of its index
+    :param source: the name of the source column
+    :param length: the length of the source column
+    :param index: False if the column is indexed with other columns by the table
+    """
+    type_ = String(length).with_variant(String(length, collation='C'), 'postgresql') \
+        .with_variant(String(length, collation='utf8mb4_bin'), 'mysql')
+    return shadow_column(source, normalize, type_, index)
+
+
+def backfill_shadow_columns(engine, metadata, batch_size):
+    """
+    Fill the shadow columns of the rows that miss their values, e.g. after the columns have been added to a table
+    that already has rows. The rows are updated in batches, one transaction per batch, following the order of
+    their primary key, that has to be a single column
+    :return: a dict with the number of the updated rows, by table and column name
+    """
+    updated = {}
+    for table in metadata.sorted_tables:
+        if not engine.has_table(table.name):
+            continue
+        key = list(table.primary_key.columns)[0]
+        for column in table.columns:
+            if 'shadow' not in column.info:
+                continue
+            source, encode = column.info['shadow']
+            source = table.c[source]
+            update = table.update().where(key == bindparam('row_key')).values({column.name: bindparam('encoded')})
+            count = 0
+            last = None
+            while True:
+                query = select([key, source]).where(and_(column.is_(None), source.isnot(None)))
+                if last is not None:
+                    # the values that can't be encoded stay empty, so the next batches skip them by key
+                    query = query.where(key > last)
+                with engine.begin() as connection:
+                    rows = connection.execute(query.order_by(key).limit(batch_size)).fetchall()
+                    if not rows:
+                        break
+                    connection.execute(update, [{'row_key': row_key, 'encoded': encode(value)}
+                                                for row_key, value in rows])
+                count += len(rows)
+                last = rows[-1][0]
+            updated['{}.{}'.format(table.name, column.name)] = count
+    return updated
+
+
+def _unsupported_modifier(query_parameter):
+    return InvalidQueryParameterException(400, {'message': {query_parameter.name: 'Unsupported modifier'}})
+
+
+def _check_value_set(query_parameter):
+    from fhirserver.dao.terminology import TerminologyDAO
+
+    if not TerminologyDAO.has_value_set(query_parameter.text):
+        raise InvalidQueryParameterException(400, {'message': {query_parameter.name: 'Unknown ValueSet'}})
+
+
+def expand_tokens(query_parameter):
+    """
+    Expand the tokens of a token parameter according to its modifier, with the codes of the local terminology,
+    see :mod:`fhirserver.dao.terminology`: the codes of the ValueSet of `:in` and `:not-in`, the descendants of
+    the codes of `:below` and their ancestors for `:above`
+    :return: the list of the tuples with the system and the code of the expanded tokens
+    """
+    from fhirserver.dao.terminology import TerminologyDAO
+    from fhirserver.parser_types import FHIRModifiers
+
+    if query_parameter.modifier in (FHIRModifiers.IN, FHIRModifiers.NOT_IN):
+        _check_value_set(query_parameter)
+        return TerminologyDAO.expand(query_parameter.text)
+    if query_parameter.modifier in (FHIRModifiers.BELOW, FHIRModifiers.ABOVE):
+        below = query_parameter.modifier == FHIRModifiers.BELOW
+        tokens = []
+        for system, code in query_parameter.tokens:
+            if code is None:
+                tokens.append((system, code))
+            else:
+                tokens.extend(TerminologyDAO.subsumed(system or None, code, below))
+        return tokens
+    return query_parameter.tokens
+
+
+class ColumnParameter(object):
+    """
+    A search parameter stored in an indexed column of the table of the resource
+    """
+
+    def __init__(self, column, system=None, codes=None, normalized=None):
+        """
+        :param column: the model attribute of the column
+        :param system: the code system of the values of a token parameter, if they have one
+        :param codes: a dict that maps the codes of a token parameter to the values stored in the column
+        :param normalized: the model attribute of the indexed shadow column with the :func:`normalize` values of a
+            string parameter, searched by the default string search
+        """
+        self.column = column
+        self.system = system
+        self.codes = codes
+        self.normalized = normalized
+        # the columns used to sort the results by this parameter
+        self.sort_columns = [column]
+
+    def condition(self, query_parameter):
+        return query_parameter.get_query_condition(self.column, self)
+
+    def to_values(self, tokens):
+        """
+        Convert the tokens of a token parameter in the values stored in the column
+        :param tokens: a list of tuples with the system and the code of the tokens, see
+            :class:`fhirserver.parser_types.FHIRToken`
+        :return: the list of the values, without the tokens that can't match any value of the column, or None if
+            the tokens match any value, i.e. they have a token with the system of the column and no code
+        """
+        values = []
+        for system, code in tokens:
+            if system is not None and system != (self.system or ''):
+                continue
+            if code is None:
+                return None
+            value = code if self.codes is None else self.codes.get(code)
+            if value is not None and value not in values:
+                values.append(value)
+        return values
+
+    @property
+    def domain(self):
+        """
+        The values that the column can have, if they are known
+        """
+        return list(self.codes.values()) if self.codes is not None else None
+
+
+class AnyColumnParameter(object):
+    """
+    A search parameter whose values are stored in several indexed columns, which matches a resource if any of
+    the columns matches, e.g. the `name` of a Patient, that can be the given or the family name
+    """
+
+    def __init__(self, *parameters):
+        """
+        :param parameters: the :class:`ColumnParameter` of each column
+        """
+        self.parameters = list(parameters)
+        self.sort_columns = [parameter.column for parameter in parameters]
+
+    def condition(self, query_parameter):
+        return or_(*[parameter.condition(query_parameter) for parameter in self.parameters])
+
+
+class FullTextParameter(object):
+    """
+    A search parameter that matches the resources with all the words of the searched text in the columns of a
+    full-text index, e.g. the `_content` of a Patient
+    """
+
+    def __init__(self, index):
+        """
+        :param index: the :class:`fhirserver.fulltext.FullTextIndex` of the table of the resource
+        """
+        self.index = index
+        self.sort_columns = None
+
+    def condition(self, query_parameter):
+        if query_parameter.modifier is not None:
+            raise _unsupported_modifier(query_parameter)
+        return TextMatch(self.index, self.index.columns, query_parameter.value, WORDS)
+
+    def score(self, query_parameter):
+        """
+        :return: the expression of the relevance of the match of a resource
+        """
+        return TextScore(self.index, query_parameter.value)
+
+
+class PhoneticParameter(object):
+    """
+    A search parameter that matches the resources with a value that sounds like the searched string, e.g. the
+    `phonetic` of a Patient. The phonetic keys of the values are stored in indexed shadow columns, so it matches
+    a resource if the key of the searched string is equal to any of them
+    """
+
+    def __init__(self, encode, *columns):
+        """
+        :param encode: the function that computes the phonetic key of a string, e.g.
+            :func:`fhirserver.phonetic.soundex`
+        :param columns: the model attributes of the columns of the keys
+        """
+        self.encode = encode
+        self.columns = list(columns)
+        self.sort_columns = None
+
+    def condition(self, query_parameter):
+        if query_parameter.modifier is not None:
+            raise _unsupported_modifier(query_parameter)
+        key = self.encode(query_parameter.value)
+        if key is None:
+            return match_none()
+        return or_(*[column == key for column in self.columns])
+
+
+class IndexParameter(object):
+    """
+    A search parameter of the generic resource store. Its values are extracted from the resources when they are
+    written and stored in the rows of an index table, tagged with the resource type and the name of the
+    parameter, so a resource matches if it has a matching row
+    """
+
+    def __init__(self, index, resource_type, name, resource_id):
+        """
+        :param index: the model of the index table
+        :param resource_type: the resource type of the parameter
+        :param name: the name of the parameter, as stored in the index rows
+        :param resource_id: the attribute of the id of the resources table
+        """
+        self.index = index
+        self.resource_type = resource_type
+        self.name = name
+        self.resource_id = resource_id
+        # the shadow column of the normalized values of the string index rows
+        self.normalized = getattr(index, 'normalized', None)
+        # the upper bounds of the values of the number and date index rows, whose `value` is the lower bound
+        self.high = getattr(index, 'high', None)
+        # the values of a resource are in several rows, so they can't be used to sort the resources
+        self.sort_columns = None
+
+    def matching(self, *conditions):
+        """
+        :return: the condition that matches the resources with an index row that satisfies :arg:`conditions`.
+            The index rows are selected by a subquery on the index of the table, and the resources by primary key.
+            If the last condition is an OR, e.g. the single numbers and the ranges of :func:`number_eq`, each branch
+            is a subquery of the UNION, because SQLite doesn't use a different index for each branch of an OR
+        """
+        branches = [conditions]
+        if conditions and isinstance(conditions[-1], BooleanClauseList) and conditions[-1].operator is operators.or_:
+            branches = [conditions[:-1] + (branch,) for branch in conditions[-1].clauses]
+        selects = [select([self.index.resource_id]).where(and_(self.index.resource_type == self.resource_type,
+                                                               self.index.name == self.name, *branch))
+                   for branch in branches]
+        return self.resource_id.in_(selects[0] if len(selects) == 1 else union(*selects))
+
+    def condition(self, query_parameter):
+        from fhirserver.parser_types import FHIRModifiers
+
+        if query_parameter.modifier == FHIRModifiers.MISSING:
+            present = self.matching()
+            return ~present if query_parameter.value else present
+        return self.matching(query_parameter.get_query_condition(self.index.value, self))
+
+
+class TextIndexParameter(IndexParameter):
+    """
+    A text search parameter of the generic resource store, e.g. `_content`, whose index rows have texts searched
+    by words with the full-text index of the table
+    """
+
+    def text_match(self, text):
+        """
+        :return: the condition on the index rows that have all the words of :arg:`text`
+        """
+        return TextMatch(self.index.__table__.info['fulltext'], ('value',), text, WORDS)
+
+    def condition(self, query_parameter):
+        if query_parameter.modifier is not None:
+            raise _unsupported_modifier(query_parameter)
+        return self.matching(self.text_match(query_parameter.value))
+
+    def score(self, query_parameter):
+        """
+        :return: the expression of the relevance of the match of a resource, the best one of its index rows
+        """
+        score = TextScore(self.index.__table__.info['fulltext'], query_parameter.value)
+        return select([func.max(score)]).where(and_(
+            self.index.resource_type == self.resource_type, self.index.name == self.name,
+            self.index.resource_id == self.resource_id, self.text_match(query_parameter.value)
+        )).as_scalar()
+
+
+class TokenIndexParameter(IndexParameter):
+    """
+    A token search parameter of the generic resource store, whose index rows have the system and the code of
+    each token. The texts of the tokens, searched by the `:text` modifier, are in the rows of a
+    :class:`TextIndexParameter`
+    """
+
+    def __init__(self, index, resource_type, name, resource_id, texts=None):
+        """
+        :param texts: the :class:`TextIndexParameter` of the texts of the tokens
+        """
+        super(TokenIndexParameter, self).__init__(index, resource_type, name, resource_id)
+        self.texts = texts
+
+    def token_condition(self, tokens):
+        """
+        :return: the condition on the index rows that have any of :arg:`tokens`. The codes are grouped by system,
+            so that the tokens in OR are IN lists of the composite index of the codes
+        """
+        codes = {}
+        for system, code in tokens:
+            codes.setdefault(system, set()).add(code)
+        conditions = []
+        for system, system_codes in codes.items():
+            condition = []
+            if system is not None:
+                condition.append(self.index.system == system if system else self.index.system.is_(None))
+            # a token without a code matches all the codes of its system
+            if None not in system_codes:
+                condition.append(db_driver.in_values(self.index.code, sorted(system_codes)))
+            conditions.append(and_(*condition))
+        if len(conditions) < 2:
+            return conditions[0] if conditions else false()
+        all_codes = {code for system_codes in codes.values() for code in system_codes}
+        if None in all_codes:
+            return or_(*conditions)
+        # the codes of all the systems are a range of the index, then each code is checked with its system
+        return and_(db_driver.in_values(self.index.code, sorted(all_codes)), or_(*conditions))
+
+    def condition(self, query_parameter):
+        from fhirserver.parser_types import FHIRModifiers
+        from fhirserver.dao.terminology import TerminologyDAO
+
+        modifier = query_parameter.modifier
+        if modifier == FHIRModifiers.MISSING:
+            return super(TokenIndexParameter, self).condition(query_parameter)
+        if modifier == FHIRModifiers.TEXT:
+            if self.texts is None:
+                raise _unsupported_modifier(query_parameter)
+            return self.texts.matching(self.texts.text_match(query_parameter.text))
+        if modifier in (FHIRModifiers.IN, FHIRModifiers.NOT_IN):
+            # the codes of the ValueSet are joined in the database, so the expansion is never read
+            _check_value_set(query_parameter)
+            codes = TerminologyDAO.value_set_codes(query_parameter.text).alias()
+            matching = self.matching(codes.c.system == self.index.system, codes.c.code == self.index.code)
+        elif modifier in (None, FHIRModifiers.NOT, FHIRModifiers.BELOW, FHIRModifiers.ABOVE):
+            matching = self.matching(self.token_condition(expand_tokens(query_parameter)))
+        else:
+            raise _unsupported_modifier(query_parameter)
+        return ~matching if modifier in (FHIRModifiers.NOT, FHIRModifiers.NOT_IN) else matching
+
+
+class QuantityIndexParameter(IndexParameter):
+    """
+    A quantity search parameter of the generic resource store, whose index rows have the value and the unit of
+    each quantity, and the value converted to the canonical unit. A search with a unit is converted to the
+    canonical unit too, so that it's a range of the index of the canonical values of the unit
+    """
+
+    def condition(self, query_parameter):
+        from fhirserver.parser_types import FHIRModifiers
+
+        if query_parameter.modifier == FHIRModifiers.MISSING:
+            return super(QuantityIndexParameter, self).condition(query_parameter)
+        if query_parameter.modifier is not None:
+            raise _unsupported_modifier(query_parameter)
+        if query_parameter.code is None:
+            return self.matching(query_parameter.number_condition(self.index.value, self.index.value))
+        unit, factor = unit_key(query_parameter.system, query_parameter.code)
+        value = self.index.canonical_value
+        return self.matching(self.index.unit == unit, query_parameter.number_condition(value, value, factor))
+
+
+class SearchRegistry(object):
+    """
+    The search parameters supported for a resource type, by destination name of the parsed query parameter
+    """
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+
+    def __contains__(self, name):
+        return name in self.parameters
+
+    def sort_keys(self, sort, query_args=None):
+        """
+        :param sort: the parsed `_sort`, a list of tuples with the name of a search parameter and True if the order
+            is descending. The name `_score` is the relevance of the results of the text search of the query
+        :param query_args: a dict with the parsed search parameters of the query
+        :return: a list of tuples with the attribute of each sort key, or the labeled expression of the relevance,
+            and True if the order is descending
+        """
+        keys = []
+        for name, descending in sort:
+            if name == SCORE:
+                keys.append((self.score(query_args or {}), descending))
+                continue
+            parameter = self.parameters.get(name)
+            if parameter is None or parameter.sort_columns is None:
+                raise InvalidQueryParameterException(400, {'message': {'_sort': 'Unsupported search parameter'}})
+            keys.extend((column, descending) for column in parameter.sort_columns)
+        return keys
+
+    def score(self, query_args):
+        """
+        :return: the expression of the relevance of the results, labeled `_score`, given by the first text search
+            parameter of :arg:`query_args`
+        """
+        for name, query_parameter in query_args.items():
+            parameter = self.parameters.get(name)
+            if query_parameter is not None and hasattr(parameter, 'score'):
+                return parameter.score(query_parameter).label(SCORE)
+        raise InvalidQueryParameterException(400, {'message': {'_sort': '_score requires a text search'}})
+
+    def conditions(self, query_args):
+        """
+        :param query_args: a dict with the parsed search parameters
+        :return: the list of conditions to filter the query of the resources
+        """
+        conditions = []
+        for name, query_parameter in query_args.items():
+            if query_parameter is None:
+                continue
+            try:
+                parameter = self.parameters[name]
+            except KeyError:
+                raise InvalidQueryParameterException(400, {'message': {
+                    getattr(query_parameter, 'name', None) or name: 'Unsupported search parameter'}})
+            conditions.append(parameter.condition(query_parameter))
+        return conditions
+
+
+def match_none():
+    """
+    A condition that no resource matches, e.g. for a token with an unknown code
+    """
+    return false()
+
+
+def match_all():
+    """
+    A condition that every resource matches, e.g. for a token with an unknown code and the :not modifier
+    """
+    return true()
+
+
+def sort_indexes(registry, sorts, unique_key):
+    """
+    Index advisor for the sorts of a resource type. The keyset pagination of a sort filters and orders the rows
+    by the sort keys followed by a unique key, so each sort is served by a composite index on the same columns,
+    in the same order
+    :param registry: the :class:`SearchRegistry` of the resource type
+    :param sorts: the sorts expected to be frequent, in the format of `_sort`
+    :param unique_key: the attribute of the unique key, the last key of every sort
+    :return: the list of the indexes, that are added to the table of the resource
+    """
+    from fhirserver.parser_types import sort_parameter
+
+    indexes = []
+    for sort in sorts:
+        keys = registry.sort_keys(sort_parameter(sort))
+        names = []
+        columns = []
+        for attribute, descending in keys + [(unique_key, False)]:
+            column = attribute.property.columns[0]
+            names.append('{}_desc'.format(column.name) if descending else column.name)
+            columns.append(column.desc() if descending else column)
+        name = 'ix_{}_sort_{}'.format(unique_key.property.columns[0].table.name, '_'.join(names[:-1]))
+        indexes.append(Index(name, *columns, info={'sort_index': True}))
+    return indexes
+
+
+def create_missing_sort_indexes(engine, metadata):
+    """
+    Create the indexes of :func:`sort_indexes` that don't exist yet, e.g. after a new sort has been declared for a
+    table that already exists, since `create_all` creates only the indexes of new tables
+    :return: the names of the new indexes
+    """
+    inspector = inspect(engine)
+    created = []
+    for table in metadata.sorted_tables:
+        if not any(index.info.get('sort_index') for index in table.indexes) or not engine.has_table(table.name):
+            continue
+        with warnings.catch_warnings():
+            # the reflection of the expression indexes is not supported by every dialect
+            warnings.simplefilter('ignore', SAWarning)
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.info.get('sort_index') and index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    return created
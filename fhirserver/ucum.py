@@ -0,0 +1,135 @@
+"""
+Conversion of the UCUM units to their canonical form, so that the quantities in different units of the same
+kind, e.g. mg and g, are stored and searched as values of a single unit. A unit is the product of its terms,
+separated by `.` or `/` (left to right, as in UCUM), each one an atom with an optional prefix and exponent, e.g.
+`mg/dL` or `mmol.L-1`. The canonical unit is the product of the base units of the atoms, e.g. `g.m-3`, and the
+factor converts the values. Only a subset of the atoms is known, and the units with an offset, like `Cel`, can't
+be converted by a factor: the quantities with the units that can't be converted keep their unit
+"""
+import re
+from decimal import Decimal
+
+UCUM_SYSTEM = 'http://unitsofmeasure.org'
+
+PREFIXES = {
+    'Y': Decimal('1e24'), 'Z': Decimal('1e21'), 'E': Decimal('1e18'), 'P': Decimal('1e15'), 'T': Decimal('1e12'),
+    'G': Decimal('1e9'), 'M': Decimal('1e6'), 'k': Decimal('1e3'), 'h': Decimal('1e2'), 'da': Decimal('1e1'),
+    'd': Decimal('1e-1'), 'c': Decimal('1e-2'), 'm': Decimal('1e-3'), 'u': Decimal('1e-6'), 'n': Decimal('1e-9'),
+    'p': Decimal('1e-12'), 'f': Decimal('1e-15'), 'a': Decimal('1e-18'), 'z': Decimal('1e-21'),
+    'y': Decimal('1e-24'),
+}
+
+# the factor and the base units, with their exponents, of each atom. The atoms in brackets and the atoms that are
+# not metric don't take a prefix
+ATOMS = {
+    'g': (Decimal(1), {'g': 1}),
+    'm': (Decimal(1), {'m': 1}),
+    's': (Decimal(1), {'s': 1}),
+    'mol': (Decimal(1), {'mol': 1}),
+    'K': (Decimal(1), {'K': 1}),
+    'A': (Decimal(1), {'A': 1}),
+    'L': (Decimal('1e-3'), {'m': 3}),
+    'l': (Decimal('1e-3'), {'m': 3}),
+    'eq': (Decimal(1), {'mol': 1}),
+    'Pa': (Decimal('1e3'), {'g': 1, 'm': -1, 's': -2}),
+    'bar': (Decimal('1e8'), {'g': 1, 'm': -1, 's': -2}),
+    'm[Hg]': (Decimal('133322387.415'), {'g': 1, 'm': -1, 's': -2}),
+    'U': (Decimal(1) / Decimal('6e7'), {'mol': 1, 's': -1}),
+    'kat': (Decimal(1), {'mol': 1, 's': -1}),
+    'cal': (Decimal('4184'), {'g': 1, 'm': 2, 's': -2}),
+    'J': (Decimal('1e3'), {'g': 1, 'm': 2, 's': -2}),
+}
+METRIC_ATOMS = set(ATOMS)
+ATOMS.update({
+    'min': (Decimal(60), {'s': 1}),
+    'h': (Decimal(3600), {'s': 1}),
+    'd': (Decimal(86400), {'s': 1}),
+    'wk': (Decimal(604800), {'s': 1}),
+    'mo': (Decimal(2629800), {'s': 1}),
+    'a': (Decimal(31557600), {'s': 1}),
+    '%': (Decimal('1e-2'), {}),
+    '[lb_av]': (Decimal('453.59237'), {'g': 1}),
+    '[oz_av]': (Decimal('28.349523125'), {'g': 1}),
+    '[in_i]': (Decimal('0.0254'), {'m': 1}),
+    '[ft_i]': (Decimal('0.3048'), {'m': 1}),
+    '[mi_i]': (Decimal('1609.344'), {'m': 1}),
+})
+
+TERM = re.compile(r'^(?P<atom>[^\d{}-]+|\[[^\]]+\])(?P<exponent>-?\d+)?$')
+POWER_OF_TEN = re.compile(r'^10[*^](?P<exponent>-?\d+)$')
+
+
+def _atom(symbol):
+    """
+    :return: the factor and the base units of an atom with an optional prefix, or None if it's not known
+    """
+    if symbol in ATOMS:
+        return ATOMS[symbol]
+    for length in (2, 1):
+        prefix, atom = symbol[:length], symbol[length:]
+        if prefix in PREFIXES and atom in METRIC_ATOMS:
+            factor, units = ATOMS[atom]
+            return PREFIXES[prefix] * factor, units
+    return None
+
+
+def _term(term):
+    """
+    :return: the factor and the base units of a term of a unit, or None if it's not known
+    """
+    # the annotations, e.g. {cells}, have no unit
+    term = re.sub(r'\{[^}]*\}', '', term)
+    if term in ('', '1'):
+        return Decimal(1), {}
+    match = POWER_OF_TEN.match(term)
+    if match is not None:
+        return Decimal(10) ** int(match.group('exponent')), {}
+    if term.isdigit():
+        return Decimal(term), {}
+    match = TERM.match(term)
+    if match is None:
+        return None
+    atom = _atom(match.group('atom'))
+    if atom is None:
+        return None
+    exponent = int(match.group('exponent') or 1)
+    factor, units = atom
+    return factor ** exponent, {unit: power * exponent for unit, power in units.items()}
+
+
+def canonical_unit(code):
+    """
+    :param code: the UCUM code of a unit
+    :return: a tuple with the canonical unit and the factor that converts the values to it, or None if the unit
+        can't be converted
+    """
+    factor = Decimal(1)
+    units = {}
+    for operator, term in re.findall(r'(^|[./])([^./]*)', code):
+        converted = _term(term)
+        if converted is None:
+            return None
+        term_factor, term_units = converted
+        sign = -1 if operator == '/' else 1
+        factor = factor * term_factor if sign > 0 else factor / term_factor
+        for unit, power in term_units.items():
+            units[unit] = units.get(unit, 0) + sign * power
+    canonical = '.'.join('{}{}'.format(unit, power if power != 1 else '')
+                         for unit, power in sorted(units.items()) if power != 0)
+    return canonical or '1', factor
+
+
+def unit_key(system, code):
+    """
+    The key of the unit of the quantities that can be compared, as a tuple with the key and the factor that
+    converts the values to the unit of the key. The UCUM units are converted to their canonical unit, while the
+    units of the other systems are compared as they are. A unit without a system is taken as a UCUM unit
+    :return: the tuple or None if the quantity has no unit code
+    """
+    if code is None:
+        return None
+    if system in (UCUM_SYSTEM, '', None):
+        canonical = canonical_unit(code)
+        if canonical is not None:
+            return canonical
+    return '{}|{}'.format(system or '', code), Decimal(1)
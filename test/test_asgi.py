@@ -0,0 +1,90 @@
+import asyncio
+import json
+import unittest
+
+from flask_testing import TestCase as FlaskTestCase
+
+from fhirserver import create_app, TESTING, db
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    WSGIMiddleware = None
+
+
+def call(app, method, path, query_string=b'', headers=(), body=b''):
+    """
+    Send a request to an ASGI application
+    :return: a tuple with the status, the headers and the body of the response
+    """
+    headers = list(headers) + ([('content-length', str(len(body)))] if body else [])
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'scheme': 'http',
+        'method': method,
+        'path': path,
+        'raw_path': path.encode('latin-1'),
+        'root_path': '',
+        'query_string': query_string,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 50000),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start = sent[0]
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+
+@unittest.skipIf(WSGIMiddleware is None, 'a2wsgi is not installed')
+class TestASGI(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        self.asgi_app = WSGIMiddleware(self.app, workers=self.app.config['ASGI_WORKERS'])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def test_routes(self):
+        patient = {
+            'resourceType': 'Patient',
+            'name': [{'family': 'Reed', 'given': ['Lou']}],
+            'gender': 'male',
+            'birthDate': '1942-03-02',
+        }
+        status, _, body = call(self.asgi_app, 'POST', '/Patient', headers=[('content-type', 'application/json'),
+                                                                            ('accept', 'application/fhir+json')],
+                               body=json.dumps(patient).encode())
+        self.assertEqual(status, 201)
+        patient_id = json.loads(body)['id']
+
+        status, _, body = call(self.asgi_app, 'GET', '/Patient/{}'.format(patient_id),
+                               headers=[('accept', 'application/fhir+json')])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['name'][0]['family'], 'Reed')
+
+        status, _, body = call(self.asgi_app, 'GET', '/Patient', query_string=b'family=Reed',
+                               headers=[('accept', 'application/fhir+json')])
+        self.assertEqual(status, 200)
+        self.assertEqual([entry['resource']['id'] for entry in json.loads(body)['entry']], [patient_id])
+
+    def test_not_found(self):
+        status, _, _ = call(self.asgi_app, 'GET', '/Patient/missing', headers=[('accept', 'application/fhir+json')])
+        self.assertEqual(status, 404)
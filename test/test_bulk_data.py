@@ -0,0 +1,445 @@
+import gzip
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import unquote
+
+from flask_testing import TestCase
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.bulk.importer import ImportState, import_resources
+from fhirserver.consts import ISSUE_TYPE
+from fhirserver.dao.patient import PatientModel
+from fhirserver.jobs import Job, JobCancelled, JobManager, JOB_STATUS, process_owner
+from fhirserver.resources.router import _get_resource
+
+
+class TestBulkData(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        self.patients_data = [{
+            'given_name': 'Carla',
+            'family_name': 'Espinoza',
+            'gender': 'f',
+            'birthdate': datetime.fromisoformat('1965-12-11'),
+            'address': 'Sacred Heart Street'
+        }, {
+            'given_name': 'Elliot',
+            'family_name': 'Reed',
+            'gender': 'f',
+            'birthdate': datetime.fromisoformat('1970-06-18'),
+        }, {
+            'given_name': 'John Arthur',
+            'family_name': 'Dorian',
+            'gender': 'm',
+        }, {
+            'given_name': 'Percival',
+            'family_name': 'Cox',
+            'gender': 'm',
+            'birthdate': datetime.fromisoformat('1962-07-13')
+        }]
+        for patient in self.patients_data:
+            pm = PatientModel(**patient)
+            db.session.add(pm)
+            patient['id'] = pm.id
+        db.session.commit()
+        self.async_headers = {'Accept': 'application/fhir+json', 'Prefer': 'respond-async'}
+        os.makedirs(self.app.config['BULK_IMPORT_DIR'], exist_ok=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.app.config['BULK_IMPORT_DIR'], ignore_errors=True)
+        shutil.rmtree(self.app.config['BULK_IMPORT_STATE_DIR'], ignore_errors=True)
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _wait_job(self, status_url, timeout=10):
+        start = time.time()
+        while time.time() - start < timeout:
+            res = self.client.get(status_url)
+            if res.status_code != 202:
+                return res
+            self.assertIn('X-Progress', res.headers)
+            time.sleep(0.05)
+        self.fail('The job did not complete')
+
+    def _export(self, url):
+        res = self.client.get(url, headers=self.async_headers)
+        self.assertEqual(res.status_code, 202)
+        res = self._wait_job(res.headers['Content-Location'])
+        self.assert200(res)
+        return res.json
+
+    def _download(self, url, **kwargs):
+        res = self.client.get(url, **kwargs)
+        data = res.data
+        res.close()
+        return res, data
+
+    def test_export(self):
+        for url in ('/$export', '/Patient/$export', '/$export?_type=Patient&_outputFormat=application/fhir%2Bndjson'):
+            manifest = self._export(url)
+            self.assertEqual(unquote(manifest['request']), unquote('http://localhost{}'.format(url)))
+            self.assertFalse(manifest['requiresAccessToken'])
+            self.assertEqual(len(manifest['output']), 1)
+            self.assertEqual(manifest['output'][0]['type'], 'Patient')
+            self.assertEqual(manifest['output'][0]['count'], len(self.patients_data))
+
+            res, data = self._download(manifest['output'][0]['url'])
+            self.assert200(res)
+            self.assertEqual(res.headers['Content-Type'], 'application/fhir+ndjson')
+            patients = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+            self.assertEqual(sorted(patient['id'] for patient in patients),
+                             sorted(patient['id'] for patient in self.patients_data))
+
+    def test_export_chunked_and_compressed(self):
+        self.app.config['BULK_EXPORT_CHUNK_SIZE'] = 3
+        self.app.config['BULK_EXPORT_GZIP'] = True
+        manifest = self._export('/$export')
+        self.assertEqual([output['count'] for output in manifest['output']], [3, 1])
+
+        ids = []
+        for output in manifest['output']:
+            self.assertTrue(output['url'].endswith('.ndjson.gz'))
+            res, data = self._download(output['url'])
+            self.assert200(res)
+            ids.extend(json.loads(line)['id'] for line in gzip.decompress(data).decode('utf-8').splitlines())
+        self.assertEqual(sorted(ids), sorted(patient['id'] for patient in self.patients_data))
+
+    def test_export_file_range_request(self):
+        manifest = self._export('/$export')
+        url = manifest['output'][0]['url']
+        _, data = self._download(url)
+
+        res, partial_data = self._download(url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['Content-Range'], 'bytes 10-19/{}'.format(len(data)))
+        self.assertEqual(partial_data, data[10:20])
+
+    def test_export_delete(self):
+        res = self.client.get('/$export', headers=self.async_headers)
+        status_url = res.headers['Content-Location']
+        self._wait_job(status_url)
+
+        res = self.client.delete(status_url)
+        self.assertEqual(res.status_code, 202)
+        res = self.client.get(status_url)
+        self.assert404(res)
+
+    def test_export_expiry(self):
+        res = self.client.get('/$export', headers=self.async_headers)
+        status_url = res.headers['Content-Location']
+        self.assert200(self._wait_job(status_url))
+        output_dir = os.path.join(self.app.config['BULK_EXPORT_DIR'], status_url.rsplit('/', 1)[1])
+        self.assertTrue(os.path.isdir(output_dir))
+
+        self.app.extensions['jobs'].expiry = 0
+        time.sleep(0.01)
+        self.assert404(self.client.get(status_url))
+        self.assertEqual(self.app.extensions['jobs'].jobs, {})
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_remove_running_job(self):
+        manager = self.app.extensions['jobs']
+        started, release = threading.Event(), threading.Event()
+        cleaned = []
+
+        def function(job):
+            started.set()
+            release.wait(5)
+            job.check_cancelled()
+
+        job = Job('test', 'http://localhost/test')
+        job.cleanup = lambda: cleaned.append(job.status)
+        manager.submit(job, function)
+        self.assertTrue(started.wait(5))
+        manager.remove(job.id)
+        # the cleanup waits for the worker to stop
+        self.assertEqual(cleaned, [])
+        release.set()
+        job.future.result(5)
+        self.assertEqual(cleaned, [JOB_STATUS.CANCELLED])
+        self.assertIsNone(manager.get(job.id, 'test'))
+
+    def test_export_other_process(self):
+        # another process of the server, with its own jobs, that shares the directory of the exports
+        other = create_app(TESTING)
+        other_client = other.test_client()
+        res = self.client.get('/$export', headers=self.async_headers)
+        status_url = res.headers['Content-Location']
+        self.assert200(self._wait_job(status_url))
+
+        res = other_client.get(status_url)
+        self.assert200(res)
+        self.assertEqual(res.json['output'][0]['count'], len(self.patients_data))
+        res, data = self._download(res.json['output'][0]['url'])
+        self.assert200(res)
+        self.assertEqual(len(data.decode('utf-8').splitlines()), len(self.patients_data))
+
+        self.assertEqual(other_client.delete(status_url).status_code, 202)
+        self.assert404(self.client.get(status_url))
+        self.assertFalse(os.path.exists(os.path.join(self.app.config['BULK_EXPORT_DIR'],
+                                                     status_url.rsplit('/', 1)[1])))
+        other.extensions['jobs'].shutdown()
+
+    def test_remove_running_job_of_other_process(self):
+        manager = self.app.extensions['jobs']
+        other = JobManager(self.app, 1, 60, 60)
+        started, release = threading.Event(), threading.Event()
+
+        def function(job):
+            started.set()
+            release.wait(5)
+            job.check_cancelled()
+
+        state_path = os.path.join(self.app.config['BULK_EXPORT_DIR'], uuid.uuid4().hex, 'job.json')
+        job = manager.submit(Job('test', 'http://localhost/test', state_path=state_path), function)
+        self.assertTrue(started.wait(5))
+        self.assertEqual(other.get(job.id, 'test', state_path).status, JOB_STATUS.IN_PROGRESS)
+        other.remove(job.id, state_path)
+        self.assertIsNone(other.get(job.id, 'test', state_path))
+        # the owner stops the job, and deletes its files, at the next check
+        self.assertTrue(os.path.exists(os.path.dirname(state_path)))
+        release.set()
+        job.future.result(5)
+        self.assertEqual(job.status, JOB_STATUS.CANCELLED)
+        self.assertFalse(os.path.exists(os.path.dirname(state_path)))
+        self.assertIsNone(manager.get(job.id, 'test'))
+        other.shutdown()
+
+    def test_export_dead_owner(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        job_id = uuid.uuid4().hex
+        job = Job('export', 'http://localhost/$export', job_id,
+                  os.path.join(self.app.config['BULK_EXPORT_DIR'], job_id, 'job.json'))
+        job.owner = '{}:{}'.format(socket.gethostname(), process.pid)
+        job.status = JOB_STATUS.IN_PROGRESS
+        os.makedirs(os.path.dirname(job.state_path))
+        job.save(create=True)
+
+        status_url = '/$export-status/{}'.format(job.id)
+        self.assertEqual(self.client.get(status_url).status_code, 500)
+        self.assertEqual(self.client.delete(status_url).status_code, 202)
+        self.assertFalse(os.path.exists(os.path.dirname(job.state_path)))
+
+    def test_export_wrong_request(self):
+        res = self.client.get('/$export', headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+        self.assertEqual(res.json['issue'][0]['expression'], ['Prefer'])
+
+        for query in ('_type=Unknown', '_outputFormat=application/json'):
+            res = self.client.get('/$export?{}'.format(query), headers=self.async_headers)
+            self.assert400(res)
+            self.assertEqual(res.json['issue'][0]['code'], ISSUE_TYPE.INVALID)
+
+        res = self.client.get('/Unknown/$export', headers=self.async_headers)
+        self.assert404(res)
+        res = self.client.get('/$export-status/unknown')
+        self.assert404(res)
+
+    def _write_import_file(self, file_name, lines):
+        with open(os.path.join(self.app.config['BULK_IMPORT_DIR'], file_name), 'w') as import_file:
+            for line in lines:
+                import_file.write(line if isinstance(line, str) else json.dumps(line))
+                import_file.write('\n')
+
+    @staticmethod
+    def _import_parameters(*urls):
+        parameters = [{'name': 'inputFormat', 'valueCode': 'application/fhir+ndjson'}]
+        for url in urls:
+            parameters.append({
+                'name': 'input',
+                'part': [{'name': 'type', 'valueCode': 'Patient'}, {'name': 'url', 'valueUri': url}]
+            })
+        return {'resourceType': 'Parameters', 'parameter': parameters}
+
+    def _patient(self, index):
+        return {
+            'resourceType': 'Patient',
+            'name': [{'given': ['Patient'], 'family': 'Number{}'.format(index)}],
+            'gender': 'other'
+        }
+
+    def test_import(self):
+        self.app.config['BULK_IMPORT_CHUNK_SIZE'] = 2
+        self._write_import_file('patients.ndjson', [
+            self._patient(0),
+            self._patient(1),
+            '{"resourceType": "Patient", ',
+            '',
+            self._patient(2),
+            dict(self._patient(3), name={'family': 'Wrong'}),
+            {'resourceType': 'Patient', 'name': [{'family': 'Genderless'}]},
+            self._patient(4),
+            {'resourceType': 'Patient', 'name': [{'family': 'Givenless'}], 'gender': 'other'},
+            dict(self._patient(5), gender='robot'),
+        ])
+        self._write_import_file('more_patients.ndjson', [self._patient(index) for index in range(5, 10)])
+
+        parameters = self._import_parameters('patients.ndjson', 'file://more_patients.ndjson')
+        res = self.client.post('/$import', json=parameters, headers=self.async_headers)
+        self.assertEqual(res.status_code, 202)
+        res = self._wait_job(res.headers['Content-Location'])
+        self.assert200(res)
+
+        self.assertEqual([output['count'] for output in res.json['output']], [4, 5])
+        self.assertEqual(res.json['error'][0]['count'], 5)
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data) + 9)
+
+        _, data = self._download(res.json['error'][0]['url'])
+        errors = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        self.assertEqual([error['line'] for error in errors], [3, 6, 7, 9, 10])
+        self.assertEqual(errors[0]['outcome']['issue'][0]['code'], ISSUE_TYPE.STRUCTURE)
+        self.assertEqual(errors[1]['outcome']['issue'][0]['expression'], ['name'])
+        self.assertEqual(errors[2]['outcome']['issue'][0]['code'], ISSUE_TYPE.REQUIRED)
+        # the resources that are valid FHIR, but can't be stored, fail on their own too
+        self.assertEqual(errors[3]['outcome']['issue'][0]['expression'], ['name[0].given'])
+        self.assertEqual(errors[4]['outcome']['issue'][0]['expression'], ['gender'])
+
+    def test_import_resume(self):
+        lines = [json.dumps(self._patient(index)) for index in range(6)]
+        self._write_import_file('patients.ndjson', lines)
+        import_path = os.path.join(self.app.config['BULK_IMPORT_DIR'], 'patients.ndjson')
+
+        # a job that was interrupted after the first two lines have been committed
+        os.makedirs(self.app.config['BULK_IMPORT_STATE_DIR'], exist_ok=True)
+        state = ImportState(os.path.join(self.app.config['BULK_IMPORT_STATE_DIR'], 'interrupted.json'),
+                            'interrupted', 'http://localhost/$import', '2020-03-01T10:00:00Z',
+                            [{'type': 'Patient', 'url': 'patients.ndjson', 'path': import_path, 'count': 2}],
+                            offset=len(lines[0]) + len(lines[1]) + 2, line=2)
+        state.save()
+
+        res = self.client.get('/$import-status/interrupted')
+        self.assertEqual(res.status_code, 500)
+
+        res = self.client.post('/$import-status/interrupted')
+        self.assertEqual(res.status_code, 202)
+        res = self._wait_job('/$import-status/interrupted')
+        self.assert200(res)
+        self.assertEqual(res.json['output'][0]['count'], 6)
+        self.assertEqual(res.json['error'], [])
+
+        families = [patient.family_name for patient in PatientModel.query.filter(PatientModel.given_name == 'Patient')]
+        self.assertEqual(sorted(families), ['Number{}'.format(index) for index in range(2, 6)])
+
+        res = self.client.delete('/$import-status/interrupted')
+        self.assertEqual(res.status_code, 202)
+        self.assert404(self.client.get('/$import-status/interrupted'))
+
+    def _interrupted_import(self, owner=None):
+        """
+        Save the state of an import of 4 patients that was interrupted after the first one, started by :arg:`owner`
+        """
+        lines = [json.dumps(self._patient(index)) for index in range(4)]
+        self._write_import_file('patients.ndjson', lines)
+        os.makedirs(self.app.config['BULK_IMPORT_STATE_DIR'], exist_ok=True)
+        state = ImportState(os.path.join(self.app.config['BULK_IMPORT_STATE_DIR'], 'interrupted.json'),
+                            'interrupted', 'http://localhost/$import', '2020-03-01T10:00:00Z',
+                            [{'type': 'Patient', 'url': 'patients.ndjson', 'count': 1,
+                              'path': os.path.join(self.app.config['BULK_IMPORT_DIR'], 'patients.ndjson')}],
+                            offset=len(lines[0]) + 1, line=1, owner=owner)
+        state.save()
+        return state
+
+    def test_import_running_in_other_process(self):
+        # the parent process is alive, and it renews the lease
+        state = self._interrupted_import('{}:{}'.format(socket.gethostname(), os.getppid()))
+        count = PatientModel.query.count()
+
+        res = self.client.get('/$import-status/interrupted')
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.headers['X-Progress'], state.progress)
+        res = self.client.post('/$import-status/interrupted')
+        self.assertEqual(res.status_code, 202)
+        self.assertIsNone(self.app.extensions['jobs'].get('interrupted', 'import'))
+
+        # once the lease expires, the job is resumed by this process
+        with open(state.path, encoding='utf-8') as state_file:
+            saved = json.load(state_file)
+        saved['heartbeat'] -= self.app.config['BULK_JOB_LEASE'] + 1
+        with open(state.path, 'w', encoding='utf-8') as state_file:
+            json.dump(saved, state_file)
+        self.assertEqual(self.client.get('/$import-status/interrupted').status_code, 500)
+        res = self.client.post('/$import-status/interrupted')
+        self.assertEqual(res.status_code, 202)
+        self.assert200(self._wait_job('/$import-status/interrupted'))
+        self.assertEqual(PatientModel.query.count(), count + 3)
+        self.assertIsNone(ImportState.load(state.path).owner)
+
+    def test_import_concurrent_resume(self):
+        self._interrupted_import()
+        count = PatientModel.query.count()
+        statuses = []
+
+        def resume():
+            statuses.append(self.app.test_client().post('/$import-status/interrupted').status_code)
+
+        threads = [threading.Thread(target=resume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        # a request after the end of the job gets the manifest
+        self.assertEqual(len(statuses), 4)
+        self.assertTrue(set(statuses) <= {200, 202})
+        self.assert200(self._wait_job('/$import-status/interrupted'))
+        # the job was resumed once
+        self.assertEqual(PatientModel.query.count(), count + 3)
+
+    def test_import_dead_owner(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        self._interrupted_import('{}:{}'.format(socket.gethostname(), process.pid))
+        self.assertEqual(self.client.get('/$import-status/interrupted').status_code, 500)
+        self.assertEqual(self.client.post('/$import-status/interrupted').status_code, 202)
+        self.assert200(self._wait_job('/$import-status/interrupted'))
+
+    def test_import_checkpoint_of_other_owner(self):
+        state = self._interrupted_import(process_owner())
+        count = PatientModel.query.count()
+        # another process resumed the job, or it was removed, so this job must not commit its chunks
+        other = ImportState.load(state.path)
+        other.owner = 'other-host:1'
+        other.save()
+        job = Job('import', state.request_url, state.job_id)
+        with self.assertRaises(JobCancelled):
+            import_resources(job, state, {'Patient': _get_resource('PatientListResource')}, 2)
+        self.assertEqual(PatientModel.query.count(), count)
+
+        os.remove(state.path)
+        state.owner = other.owner
+        with self.assertRaises(JobCancelled):
+            import_resources(job, state, {'Patient': _get_resource('PatientListResource')}, 2)
+        self.assertEqual(PatientModel.query.count(), count)
+
+    def test_import_wrong_request(self):
+        self._write_import_file('patients.ndjson', [self._patient(0)])
+        res = self.client.post('/$import', json=self._import_parameters('patients.ndjson'),
+                               headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+
+        for url in ('missing.ndjson', '../../etc/passwd', '/etc/passwd'):
+            res = self.client.post('/$import', json=self._import_parameters(url), headers=self.async_headers)
+            self.assert400(res)
+            self.assertEqual(res.json['issue'][0]['expression'], ['parameter[1].part.url'])
+
+        parameters = self._import_parameters('patients.ndjson')
+        parameters['parameter'][1]['part'][0]['valueCode'] = 'Unknown'
+        res = self.client.post('/$import', json=parameters, headers=self.async_headers)
+        self.assert400(res)
+        self.assertEqual(res.json['issue'][0]['code'], ISSUE_TYPE.NOT_SUPPORTED)
+
+        res = self.client.post('/$import', json={'resourceType': 'Parameters'}, headers=self.async_headers)
+        self.assert400(res)
+        self.assertEqual(res.json['issue'][0]['code'], ISSUE_TYPE.REQUIRED)
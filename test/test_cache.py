@@ -0,0 +1,176 @@
+import threading
+import time
+from unittest import TestCase
+
+from flask_testing import TestCase as FlaskTestCase
+
+from fhirserver import create_app, TESTING, db
+from fhirserver import cache as resource_cache
+from fhirserver.cache import LRUCache, SharedCache, TOMBSTONE, create_cache
+from fhirserver.dao.patient import PatientModel, PatientDAO
+
+
+class DictClient(object):
+    """
+    A client with the Redis interface used by SharedCache, which stores the values in a dict
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if not nx or key not in self.data:
+            self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TestCacheBackends(TestCase):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        cache.set('c', b'3')
+        # b is the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2, 'evictions': 1})
+
+    def test_lru_ttl(self):
+        cache = LRUCache(2, 0.01)
+        cache.set('a', b'1')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_lru_delete(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', b'1')
+        cache.delete('a')
+        cache.delete('unknown')
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_add(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', b'1')
+        cache.add('a', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        # a tombstone is a miss, that is not replaced until it expires
+        cache.set('a', TOMBSTONE, 0.01)
+        self.assertIsNone(cache.get('a'))
+        cache.add('a', b'2')
+        self.assertIsNone(cache.get('a'))
+        time.sleep(0.02)
+        cache.add('a', b'2')
+        self.assertEqual(cache.get('a'), b'2')
+
+    def test_shared(self):
+        client = DictClient()
+        cache = SharedCache(client, 60)
+        cache.set('a', b'1')
+        self.assertEqual(client.data, {'fhir:a': b'1'})
+        self.assertEqual(cache.get('a'), b'1')
+        cache.add('a', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.add('a', b'2')
+        self.assertEqual(cache.get('a'), b'2')
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1})
+
+    def test_concurrent_stats(self):
+        cache = LRUCache(10, 60)
+        cache.set('a', b'1')
+
+        def read():
+            for _ in range(1000):
+                cache.get('a')
+                cache.get('b')
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats()['hits'], 8000)
+        self.assertEqual(cache.stats()['misses'], 8000)
+
+    def test_create_cache(self):
+        config = {'RESOURCE_CACHE': 'lru', 'RESOURCE_CACHE_SIZE': 10, 'RESOURCE_CACHE_TTL': 60}
+        self.assertIsInstance(create_cache(config), LRUCache)
+        # an empty value from the environment disables the cache
+        for backend in (None, ''):
+            self.assertIsNone(create_cache(dict(config, RESOURCE_CACHE=backend)))
+
+
+class TestResourceCache(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        self.patient = PatientModel(given_name='Carla', family_name='Espinoza', gender='f')
+        db.session.add(self.patient)
+        db.session.commit()
+        self.cache = self.app.extensions['resource_cache']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def test_read(self):
+        url = '/Patient/{}'.format(self.patient.id)
+        res = self.client.get(url, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+        # the changes made bypassing the DAO are not seen until the entry is invalidated
+        self.patient.family_name = 'Turk'
+        db.session.commit()
+        res = self.client.get(url, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.headers['Content-Type'], 'application/fhir+json')
+        self.assertEqual(res.json['name'][0]['family'], 'Espinoza')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+        self.cache.delete('Patient/{}'.format(self.patient.id))
+        res = self.client.get(url, headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(res.json['name'][0]['family'], 'Turk')
+
+    def test_not_found_is_not_cached(self):
+        res = self.client.get('/Patient/unknown', headers={'Accept': 'application/fhir+json'})
+        self.assert404(res)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_write_invalidation(self):
+        patient = PatientDAO.parse({
+            'resourceType': 'Patient',
+            'name': [{'given': ['Elliot'], 'family': 'Reed'}],
+            'gender': 'female'
+        })
+        self.cache.set('Patient/{}'.format(patient.id), b'{"stale": true}')
+        PatientDAO.create(patient)
+        self.assertIsNone(self.cache.get('Patient/{}'.format(patient.id)))
+
+    def test_read_before_write(self):
+        # a read that started before a write doesn't cache the old version after the write invalidated it
+        url = '/Patient/{}'.format(self.patient.id)
+        with self.app.test_request_context(url):
+            data = PatientDAO.get(self.patient.id)
+            resource_cache.invalidate('Patient', self.patient.id)
+            resource_cache.store('Patient', self.patient.id, data)
+            self.assertIsNone(resource_cache.lookup('Patient', self.patient.id))
+
+    def test_disabled_cache(self):
+        self.app.extensions['resource_cache'] = None
+        res = self.client.get('/Patient/{}'.format(self.patient.id), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.json['id'], self.patient.id)
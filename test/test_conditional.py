@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+
+from flask_testing import TestCase
+from werkzeug.http import http_date
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel
+
+
+class TestConditionalRequests(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        self.patient = PatientModel(given_name='Carla', family_name='Espinoza', gender='f',
+                                    last_updated=datetime(2020, 3, 1, 10, 30, 15, 250000))
+        db.session.add(self.patient)
+        db.session.add(PatientModel(given_name='Elliot', family_name='Reed', gender='f'))
+        db.session.commit()
+        self.url = '/Patient/{}'.format(self.patient.id)
+        self.cache = self.app.extensions['resource_cache']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _get(self, url, **headers):
+        headers['Accept'] = 'application/fhir+json'
+        return self.client.get(url, headers=headers)
+
+    def test_read_validators(self):
+        res = self._get(self.url)
+        self.assert200(res)
+        self.assertEqual(res.headers['ETag'], 'W/"1"')
+        self.assertEqual(res.headers['Last-Modified'], 'Sun, 01 Mar 2020 10:30:15 GMT')
+        self.assertEqual(res.json['meta'], {'versionId': '1', 'lastUpdated': '2020-03-01T10:30:15.250Z'})
+
+    def test_read_if_none_match(self):
+        for _ in range(2):
+            # the first request checks the version in the database, the second one the cached resource
+            res = self._get(self.url, **{'If-None-Match': 'W/"1"'})
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.data, b'')
+            self.assertEqual(res.headers['ETag'], 'W/"1"')
+            self._get(self.url)
+
+        res = self._get(self.url, **{'If-None-Match': 'W/"0"'})
+        self.assert200(res)
+        self.assertEqual(res.json['id'], self.patient.id)
+
+    def test_not_modified_is_not_serialized(self):
+        res = self._get(self.url, **{'If-None-Match': 'W/"1"'})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_read_if_modified_since(self):
+        res = self._get(self.url, **{'If-Modified-Since': 'Sun, 01 Mar 2020 10:30:15 GMT'})
+        self.assertEqual(res.status_code, 304)
+        res = self._get(self.url, **{'If-Modified-Since': 'Sun, 01 Mar 2020 10:30:14 GMT'})
+        self.assert200(res)
+
+        # If-None-Match takes precedence
+        res = self._get(self.url, **{'If-Modified-Since': 'Sun, 01 Mar 2020 10:30:15 GMT', 'If-None-Match': 'W/"0"'})
+        self.assert200(res)
+
+    def test_conditional_read_not_found(self):
+        res = self._get('/Patient/unknown', **{'If-None-Match': 'W/"1"'})
+        self.assert404(res)
+
+    def test_conditional_search(self):
+        res = self._get('/Patient/?_count=10')
+        self.assert200(res)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertIn('Last-Modified', res.headers)
+
+        res = self._get('/Patient/?_count=10', **{'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        res = self._get('/Patient/?_count=10', **{'If-Modified-Since': http_date(datetime.utcnow() +
+                                                                                         timedelta(days=1))})
+        self.assertEqual(res.status_code, 304)
+
+        # another search has another version
+        res = self._get('/Patient/?_count=1', **{'If-None-Match': etag})
+        self.assert200(res)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        # a new patient changes the version of the results
+        db.session.add(PatientModel(given_name='Kim', family_name='Hedges', gender='f'))
+        db.session.commit()
+        res = self._get('/Patient/?_count=10', **{'If-None-Match': etag})
+        self.assert200(res)
+        self.assertEqual(res.json['total'], 3)
+
+    def test_conditional_search_replaced_result(self):
+        res = self._get('/Patient/?gender=female')
+        etag = res.headers['ETag']
+        # a patient leaves the results and another one, with the same version, enters them
+        db.session.delete(self.patient)
+        db.session.add(PatientModel(given_name='Kim', family_name='Hedges', gender='f'))
+        db.session.commit()
+        self.cache.delete('Patient/{}'.format(self.patient.id))
+        res = self._get('/Patient/?gender=female', **{'If-None-Match': etag})
+        self.assert200(res)
+        self.assertEqual(res.json['total'], 2)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_conditional_search_streamed(self):
+        self.app.config['STREAM_SEARCH_RESULTS'] = True
+        res = self._get('/Patient/')
+        self.assert200(res)
+        res = self._get('/Patient/', **{'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
@@ -0,0 +1,119 @@
+from unittest import TestCase
+
+from flask_testing import TestCase as FlaskTestCase
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite, mysql
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel, PATIENTS_FULLTEXT
+from fhirserver.fulltext import TextMatch, TextScore, CONTAINS, WORDS, create_missing_fulltext_indexes
+
+
+class TestCompile(TestCase):
+
+    def _compile(self, element, dialect):
+        return str(select([PatientModel.id]).where(element).compile(
+            dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+    def test_sqlite(self):
+        sql = self._compile(TextMatch(PATIENTS_FULLTEXT, ['family_name'], 'Reed', CONTAINS), sqlite.dialect())
+        self.assertIn("patients.rowid IN (SELECT patients_fts.rowid", sql)
+        self.assertIn("""patients_fts MATCH '{family_name} : ("Reed")'""", sql)
+        self.assertNotIn('= 1', sql)
+
+        # the words shorter than a trigram are matched by LIKE
+        sql = self._compile(TextMatch(PATIENTS_FULLTEXT, PATIENTS_FULLTEXT.columns, 'Elliot J Reed', WORDS),
+                            sqlite.dialect())
+        self.assertIn("""patients_fts MATCH '"Elliot" AND "Reed"'""", sql)
+        self.assertIn("lower(patients.family_name) LIKE '%j%'", sql)
+
+        sql = self._compile(TextScore(PATIENTS_FULLTEXT, 'Reed') > 0, sqlite.dialect())
+        self.assertIn('SELECT -patients_fts.rank', sql)
+
+    def test_postgresql(self):
+        sql = self._compile(TextMatch(PATIENTS_FULLTEXT, ['family_name'], '50%', CONTAINS), postgresql.dialect())
+        # the wildcards of the searched text are escaped
+        self.assertIn("lower(patients.family_name) LIKE '%%50", sql)
+        self.assertIn("ESCAPE", sql)
+        sql = self._compile(TextMatch(PATIENTS_FULLTEXT, PATIENTS_FULLTEXT.columns, 'Reed', WORDS),
+                            postgresql.dialect())
+        self.assertIn("to_tsvector('simple', (((((coalesce(patients.given_name, '') || ' ')", sql)
+        self.assertIn("@@ plainto_tsquery('simple', 'Reed')", sql)
+        sql = self._compile(TextScore(PATIENTS_FULLTEXT, 'Reed') > 0, postgresql.dialect())
+        self.assertIn('ts_rank(to_tsvector(', sql)
+
+    def test_other_databases(self):
+        sql = self._compile(TextMatch(PATIENTS_FULLTEXT, ['family_name', 'given_name'], 'Reed', CONTAINS),
+                            mysql.dialect())
+        self.assertIn("lower(patients.family_name) LIKE '%%reed%%'", sql)
+        self.assertIn("OR lower(patients.given_name) LIKE '%%reed%%'", sql)
+
+
+class TestFullTextSearch(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        self.patients = [
+            PatientModel(given_name='Elliot', family_name='Reed', gender='f', address='Sacred Heart Street'),
+            PatientModel(given_name='Percival', family_name='Cox', gender='m', address='Reed Road'),
+            PatientModel(given_name='John', family_name='Dorian', gender='m', address='Reed Reed Street'),
+        ]
+        db.session.add_all(self.patients)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _search(self, query):
+        res = self.client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return res.json
+
+    def _families(self, query):
+        return [entry['resource']['name'][0]['family'] for entry in self._search(query).get('entry', [])]
+
+    def test_contains(self):
+        self.assertEqual(self._families('family:contains=EED'), ['Reed'])
+        self.assertEqual(self._families('family:contains=ee'), ['Reed'])
+        self.assertEqual(sorted(self._families('address:contains=reed')), ['Cox', 'Dorian'])
+        self.assertEqual(self._families('given:contains=%'), [])
+
+    def test_index_is_maintained(self):
+        patient = self.patients[0]
+        patient.family_name = 'Dorian'
+        db.session.commit()
+        self.assertEqual(self._families('family:contains=Reed'), [])
+        self.assertEqual(len(self._families('family:contains=Dorian')), 2)
+        db.session.delete(patient)
+        db.session.commit()
+        self.assertEqual(len(self._families('family:contains=Dorian')), 1)
+
+    def test_content(self):
+        self.assertEqual(self._search('_content=reed')['total'], 3)
+        self.assertEqual(self._families('_content=reed street&_sort=family'), ['Dorian', 'Reed'])
+        self.assertEqual(self._families('_content=Elliot Cox'), [])
+
+    def test_ranking(self):
+        self.assertEqual(self._families('_content=reed&_sort=-_score'), ['Dorian', 'Cox', 'Reed'])
+
+        families = []
+        query = '_content=reed&_sort=-_score&_count=1'
+        while query is not None:
+            bundle = self._search(query)
+            families.extend(entry['resource']['name'][0]['family'] for entry in bundle['entry'])
+            links = {link['relation']: link['url'] for link in bundle['link']}
+            query = links['next'].split('?', 1)[1] if 'next' in links else None
+        self.assertEqual(families, ['Dorian', 'Cox', 'Reed'])
+
+        res = self.client.get('/Patient?_sort=-_score', headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+
+    def test_create_missing_indexes(self):
+        db.session.execute('DROP TABLE patients_fts')
+        db.session.commit()
+        self.assertIn('patients_fts', create_missing_fulltext_indexes(db.engine, db.metadata))
+        self.assertEqual(self._families('family:contains=Reed'), ['Reed'])
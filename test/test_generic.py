@@ -0,0 +1,228 @@
+from unittest import TestCase
+
+from flask_testing import TestCase as FlaskTestCase
+from werkzeug.datastructures import MultiDict
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.generic import extract, ResourceModel
+from fhirserver.resources.router import _get_resource
+
+
+class TestExtract(TestCase):
+
+    def test_extract(self):
+        resource = {
+            'name': [{'family': 'Cox', 'given': ['Percival', 'Ulysses']}, {'family': 'Kelso'}],
+            'effectivePeriod': {'start': '2020-03-01'}
+        }
+        self.assertEqual(extract(resource, 'name.family'), ['Cox', 'Kelso'])
+        self.assertEqual(extract(resource, 'name.given'), ['Percival', 'Ulysses'])
+        self.assertEqual(extract(resource, 'effectiveDateTime | effectivePeriod'), [{'start': '2020-03-01'}])
+        self.assertEqual(extract(resource, 'address.text'), [])
+
+
+class TestGenericStore(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        self.practitioners = [{
+            'resourceType': 'Practitioner',
+            'identifier': [{'system': 'http://sacred-heart.org/staff', 'value': '1'}],
+            'name': [{'family': 'Cox', 'given': ['Percival']},
+                     {'family': 'Cox', 'given': ['Perry'], 'use': 'nickname'}],
+            'telecom': [{'system': 'email', 'value': 'cox@sacred-heart.org'}],
+            'gender': 'male'
+        }, {
+            'resourceType': 'Practitioner',
+            'identifier': [{'system': 'http://sacred-heart.org/staff', 'value': '2'}],
+            'name': [{'family': 'Kelso', 'given': ['Bob']}],
+            'address': [{'city': 'San Di Frangeles'}],
+            'gender': 'male'
+        }, {
+            'resourceType': 'Practitioner',
+            'name': [{'family': 'Reed', 'given': ['Elliot']}],
+            'gender': 'female'
+        }]
+        self.ids = [self._post('Practitioner', data).json['id'] for data in self.practitioners]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _post(self, resource_type, data):
+        return self.client.post('/{}'.format(resource_type), json=data, headers={'Accept': 'application/fhir+json'})
+
+    def _search(self, query):
+        res = self.client.get('/Practitioner?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return sorted(entry['resource']['id'] for entry in res.json.get('entry', []))
+
+    def test_create_and_read(self):
+        res = self.client.get('/Practitioner/{}'.format(self.ids[0]), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.headers['ETag'], 'W/"1"')
+        # the whole resource is stored, so no element is lost
+        self.assertEqual(res.json['name'], self.practitioners[0]['name'])
+        self.assertEqual(res.json['telecom'], self.practitioners[0]['telecom'])
+        self.assertEqual(res.json['meta']['versionId'], '1')
+
+        self.assert404(self.client.get('/Practitioner/unknown', headers={'Accept': 'application/fhir+json'}))
+
+    def test_invalid_resource(self):
+        res = self._post('Practitioner', {'resourceType': 'Practitioner', 'gender': 1})
+        self.assert400(res)
+        res = self._post('Practitioner', {'resourceType': 'Patient'})
+        self.assert400(res)
+
+    def test_search(self):
+        cox, kelso, reed = self.ids
+        self.assertEqual(self._search(''), sorted(self.ids))
+        self.assertEqual(self._search('family=cox'), [cox])
+        # every name is indexed, not only the first one
+        self.assertEqual(self._search('given=Perry'), [cox])
+        self.assertEqual(self._search('name=Elliot'), [reed])
+        self.assertEqual(self._search('address=San Di Frangeles'), [kelso])
+        self.assertEqual(self._search('address=san  di'), [kelso])
+        self.assertEqual(self._search('family=KEL'), [kelso])
+        self.assertEqual(self._search('address:missing=true'), sorted([cox, reed]))
+        self.assertEqual(self._search('gender=male'), sorted([cox, kelso]))
+        self.assertEqual(self._search('gender:not=male'), [reed])
+        self.assertEqual(self._search('identifier=http://sacred-heart.org/staff|2'), [kelso])
+        self.assertEqual(self._search('identifier=http://other.org|2'), [])
+        self.assertEqual(self._search('telecom=cox@sacred-heart.org'), [cox])
+        self.assertEqual(self._search('_id={}'.format(reed)), [reed])
+        self.assertEqual(self._search('gender=male&family=Kelso'), [kelso])
+
+    def test_search_pagination(self):
+        res = self.client.get('/Practitioner?_count=2&_sort=-_lastUpdated', headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(res.json['total'], 3)
+        self.assertEqual(len(res.json['entry']), 2)
+        next_url = [link['url'] for link in res.json['link'] if link['relation'] == 'next'][0]
+        res = self.client.get(next_url, headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(len(res.json['entry']), 1)
+
+        res = self.client.get('/Practitioner?_sort=family', headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+
+    def test_search_elements(self):
+        res = self.client.get('/Practitioner?_elements=name&family=Kelso', headers={'Accept': 'application/fhir+json'})
+        resource = res.json['entry'][0]['resource']
+        self.assertEqual(set(resource), {'resourceType', 'id', 'meta', 'name'})
+        self.assertEqual(resource['meta']['tag'][0]['code'], 'SUBSETTED')
+
+        res = self.client.get('/Practitioner?_summary=count&gender=male', headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(res.json['total'], 2)
+
+    def test_observation(self):
+        observations = [{
+            'resourceType': 'Observation',
+            'status': 'final',
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': '8867-4'}]},
+            'effectiveDateTime': '2020-03-01T10:30:00Z',
+            'valueQuantity': {'value': 80, 'unit': 'beats/minute'}
+        }, {
+            'resourceType': 'Observation',
+            'status': 'preliminary',
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': '8310-5'}]},
+            'effectivePeriod': {'start': '2020-04-01', 'end': '2020-04-02'}
+        }]
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{'resource': data, 'request': {'method': 'POST', 'url': 'Observation'}} for data in observations]
+        }
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        ids = [entry['response']['location'].split('/')[1] for entry in res.json['entry']]
+
+        def search(query):
+            res = self.client.get('/Observation?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            return [entry['resource']['id'] for entry in res.json.get('entry', [])]
+
+        self.assertEqual(search('code=http://loinc.org|8867-4'), [ids[0]])
+        self.assertEqual(search('date=eq2020-03'), [ids[0]])
+        self.assertEqual(search('date=ge2020-03-15'), [ids[1]])
+        self.assertEqual(search('status=preliminary'), [ids[1]])
+
+        # the name of a choice element selects all its types
+        res = self.client.get('/Observation?_elements=value&_id={}'.format(ids[0]),
+                              headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(set(res.json['entry'][0]['resource']), {'resourceType', 'id', 'meta', 'valueQuantity'})
+
+    def test_date_ranges(self):
+        dates = [{'effectivePeriod': {'start': '2019-12', 'end': '2020-02'}},
+                 {'effectiveDateTime': '2020-05'},
+                 {'effectivePeriod': {'start': '2021-01-01T10:00:00Z'}}]
+        ids = [self._post('Observation', dict(date, resourceType='Observation', status='final',
+                                              code={'text': 'test'})).json['id'] for date in dates]
+
+        def search(query):
+            res = self.client.get('/Observation?date={}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            return sorted(entry['resource']['id'] for entry in res.json.get('entry', []))
+
+        period, month, open_period = ids
+        # a Period matches the dates it overlaps, up to the end of the precision of its end
+        self.assertEqual(search('eq2020-01'), [period])
+        self.assertEqual(search('eq2020-02-29'), [period])
+        self.assertEqual(search('eq2020-03-01'), [])
+        # a date with month precision is the whole month
+        self.assertEqual(search('eq2020-05-20'), [month])
+        self.assertEqual(search('gt2020-05-15'), sorted([month, open_period]))
+        self.assertEqual(search('lt2020-05-15'), sorted([period, month]))
+        self.assertEqual(search('sa2020-05-15'), [open_period])
+        self.assertEqual(search('eb2020-05-15'), [period])
+        self.assertEqual(search('ne2020-05'), sorted([period, open_period]))
+        # a Period without end is open
+        self.assertEqual(search('ge2100'), [open_period])
+        self.assertEqual(search('ap2020-06-01'), [month])
+
+    def test_text_search(self):
+        cox, kelso, reed = self.ids
+        self.assertEqual(self._search('family:contains=ELS'), [kelso])
+        self.assertEqual(self._search('given:contains=er'), [cox])
+        # all the strings of a resource are its content
+        self.assertEqual(self._search('_content=kelso frangeles'), [kelso])
+        self.assertEqual(self._search('_content=email'), [cox])
+        self.assertEqual(self._search('_content=elliot kelso'), [])
+
+        observations = [{
+            'resourceType': 'Observation',
+            'status': 'final',
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': '2339-0',
+                                 'display': 'Glucose [Mass/volume] in Blood'}], 'text': 'Blood glucose'},
+            'text': {'status': 'generated', 'div': '<div xmlns="http://www.w3.org/1999/xhtml">Fasting &amp; '
+                                                   '<b>glucose</b></div>'}
+        }, {
+            'resourceType': 'Observation',
+            'status': 'final',
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': '718-7',
+                                 'display': 'Hemoglobin [Mass/volume] in Blood'}]}
+        }]
+        glucose, hemoglobin = [self._post('Observation', data).json['id'] for data in observations]
+
+        def search(query):
+            res = self.client.get('/Observation?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            return [entry['resource']['id'] for entry in res.json.get('entry', [])]
+
+        self.assertEqual(search('code:text=glucose'), [glucose])
+        self.assertEqual(sorted(search('code:text=blood')), sorted([glucose, hemoglobin]))
+        self.assertEqual(search('_text=fasting glucose'), [glucose])
+        self.assertEqual(search('_text=hemoglobin'), [])
+        self.assertEqual(search('_content=blood&_sort=-_score'), [glucose, hemoglobin])
+
+    def test_index_plans(self):
+        parser = self.app.extensions['search_parsers']['Practitioner']
+        dao = _get_resource('PractitionerListResource').dao
+        for query_string in ('family=Cox', 'gender=male', 'gender:not=male', 'identifier=2', 'telecom=cox',
+                             'gender=male,female', 'identifier=http://sacred-heart.org/staff|1,2'):
+            query_args = parser.parse(MultiDict([query_string.split('=', 1)]))
+            sql = str(dao.search_query(query_args, ResourceModel.id).statement.compile(
+                db.engine, compile_kwargs={'literal_binds': True}))
+            plan = [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN {}'.format(sql))]
+            self.assertTrue(any('USING INDEX ix_search_' in step for step in plan), '{}: {}'.format(query_string, plan))
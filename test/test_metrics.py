@@ -0,0 +1,139 @@
+import re
+from unittest import TestCase, mock
+
+from flask_testing import TestCase as FlaskTestCase
+
+from config import TestConfig
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel
+from fhirserver.metrics import Histogram
+
+
+class TestHistogram(TestCase):
+
+    def test_collect(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0, float('inf')))
+        histogram.observe(0.05, '/a')
+        histogram.observe(0.5, '/a')
+        histogram.observe(5, '/a')
+        histogram.observe(0.5, 'with "quotes"')
+        self.assertEqual(histogram.collect()[:7], [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/a",le="0.1"} 1',
+            'latency_seconds_bucket{route="/a",le="1.0"} 2',
+            'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+            'latency_seconds_sum{route="/a"} 5.55',
+            'latency_seconds_count{route="/a"} 3',
+        ])
+        self.assertIn('latency_seconds_count{route="with \\"quotes\\""} 1', histogram.collect())
+
+
+class TestMetricsEndpoint(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        db.session.add(PatientModel(given_name='Elliot', family_name='Reed', gender='f'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _metric(self, text, name, **labels):
+        """
+        :return: the sum of the series of :arg:`name` that have all :arg:`labels`, or None if there are none
+        """
+        values = [float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+                  if line.startswith(name + '{') and all('{}="{}"'.format(key, value) in line
+                                                         for key, value in labels.items())]
+        return sum(values) if values else None
+
+    def _metrics(self):
+        return self.client.get('/metrics').data.decode('utf-8')
+
+    def _increase(self, before, after, name, **labels):
+        return (self._metric(after, name, **labels) or 0) - (self._metric(before, name, **labels) or 0)
+
+    def test_search_metrics(self):
+        # the metrics are global, so only their increase is checked
+        before = self._metrics()
+        for stream in (False, True):
+            self.app.config['STREAM_SEARCH_RESULTS'] = stream
+            res = self.client.get('/Patient?family=Reed&gender=female&_count=10',
+                                  headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            self.assertEqual(res.json['total'], 1)
+            # the servers close the responses, and the streamed ones are measured until then
+            res.close()
+        res = self.client.get('/metrics')
+        self.assert200(res)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        text = res.data.decode('utf-8')
+
+        # the combinations of the parameters are not labels, so that the requests can't add series
+        self.assertNotIn('family,gender', text)
+        labels = {'resource_type': 'Patient', 'interaction': 'search-type', 'search_params': 'multiple'}
+        self.assertEqual(self._increase(before, text, 'fhir_request_duration_seconds_count', status='200', **labels),
+                         2)
+        for phase in ('parse', 'query', 'fetch', 'serialize', 'render'):
+            self.assertEqual(self._increase(before, text, 'fhir_request_phase_seconds_count', phase=phase, **labels),
+                             2, phase)
+        self.assertIsNotNone(self._metric(text, 'fhir_db_pool', stat='checkouts'))
+        self.assertIsNotNone(self._metric(text, 'fhir_resource_cache', stat='hits'))
+
+    def test_single_search_parameter(self):
+        before = self._metrics()
+        self.assert200(self.client.get('/Patient?family=Reed', headers={'Accept': 'application/fhir+json'}))
+        self.assertEqual(self._increase(before, self._metrics(), 'fhir_request_duration_seconds_count',
+                                        interaction='search-type', search_params='family'), 1)
+
+    def test_metrics_token(self):
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        res = self.client.get('/metrics')
+        self.assert401(res)
+        self.assertEqual(res.headers['WWW-Authenticate'], 'Bearer')
+        self.assert401(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}))
+        self.assert200(self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}))
+
+    def test_endpoint_disabled(self):
+        from config import ProductionConfig
+
+        self.assertFalse(ProductionConfig.METRICS_ENDPOINT)
+        with mock.patch.object(TestConfig, 'METRICS_ENDPOINT', False):
+            app = create_app(TESTING)
+        self.assertNotIn('metrics', app.view_functions)
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+
+    def test_read_and_create_metrics(self):
+        patient_id = PatientModel.query.first().id
+        before = self._metrics()
+        self.client.get('/Patient/{}'.format(patient_id), headers={'Accept': 'application/fhir+json'})
+        self.client.get('/Patient/unknown', headers={'Accept': 'application/fhir+json'})
+        self.client.post('/Patient', json={'resourceType': 'Patient', 'gender': 'female'},
+                         headers={'Accept': 'application/fhir+json'})
+        text = self._metrics()
+        for interaction, status in (('read', '200'), ('read', '404'), ('create', '400')):
+            self.assertEqual(self._increase(before, text, 'fhir_request_duration_seconds_count',
+                                            interaction=interaction, status=status), 1, (interaction, status))
+
+    def test_unknown_resource_types(self):
+        before = self._metrics()
+        for url in ('/Bogus1', '/Bogus2/1', '/Bogus3?name=x'):
+            self.assert404(self.client.get(url, headers={'Accept': 'application/fhir+json'}))
+        self.assert404(self.client.post('/Bogus4', json={}, headers={'Accept': 'application/fhir+json'}))
+        text = self._metrics()
+        self.assertNotIn('Bogus', text)
+        self.assertEqual(len(text.splitlines()), len(before.splitlines()))
+
+    def test_disabled(self):
+        app = create_app(TESTING)
+        app.config['METRICS_ENABLED'] = False
+        with app.test_request_context('/Patient'):
+            from fhirserver import metrics
+            metrics.start_interaction('Patient', 'search-type')
+            self.assertIsNone(metrics.current_interaction())
+        self.assertTrue(re.match(r'^# HELP', self.client.get('/metrics').data.decode('utf-8')))
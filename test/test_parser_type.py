@@ -1,9 +1,13 @@
+from decimal import Decimal
+from datetime import datetime
 from unittest import TestCase
 
 from dateutil.parser import isoparse
+from werkzeug.datastructures import MultiDict
 
+from fhirserver.exceptions import InvalidQueryParameterException
 from fhirserver.parser_types import FHIRNumber, FHIRDate, FHIRString, FHIRToken, FHIRReference, FHIRQuantity, FHIRUri, \
-    FHIRModifiers
+    FHIRModifiers, FHIRSearchTypes, SearchParser, query_argument_type_factory
 from fhirserver.resources import RESOURCES
 
 _search_prefixes = ('eq', 'ne', 'gt', 'lt', 'ge', 'le', 'gt', 'sa', 'eb', 'ap')
@@ -51,6 +55,13 @@ class TestFHIRSearchTypes(TestCase):
             self.assertEqual(fn.value, 100.00)
             self.assertIsNone(fn.modifier)
 
+    def test_number_range(self):
+        # the range of a number is given by its precision
+        self.assertEqual(FHIRNumber('100').range, (Decimal('99.5'), Decimal('100.5')))
+        self.assertEqual(FHIRNumber('100.00').range, (Decimal('99.995'), Decimal('100.005')))
+        self.assertEqual(FHIRNumber('1e2').range, (Decimal('50'), Decimal('150')))
+        self.assertRaises(ValueError, FHIRNumber, 'nan')
+
     def test_wrong_number(self):
         self.assertRaises(ValueError, FHIRNumber, "st100", None, None)
         self.assertRaises(ValueError, FHIRNumber, "100,00", None, None)
@@ -65,6 +76,19 @@ class TestFHIRSearchTypes(TestCase):
                 self.assertEqual(fd.operation, op)
                 self.assertEqual(fd.value, isoparse(date_str))
 
+    def test_date_range(self):
+        for date_str, start, end in (
+                ('2020', datetime(2020, 1, 1), datetime(2021, 1, 1)),
+                ('2020-12', datetime(2020, 12, 1), datetime(2021, 1, 1)),
+                ('2020-10-13', datetime(2020, 10, 13), datetime(2020, 10, 14)),
+                ('2020-10-13T10', datetime(2020, 10, 13, 10), datetime(2020, 10, 13, 11)),
+                ('2020-10-13T10:13', datetime(2020, 10, 13, 10, 13), datetime(2020, 10, 13, 10, 14)),
+                ('2020-10-13T10:13:15', datetime(2020, 10, 13, 10, 13, 15), datetime(2020, 10, 13, 10, 13, 16)),
+                ('2020-10-13T10:13:15.12', datetime(2020, 10, 13, 10, 13, 15, 120000),
+                 datetime(2020, 10, 13, 10, 13, 15, 130000)),
+                ('2020-10-13T00:13:15+02:00', datetime(2020, 10, 12, 22, 13, 15), datetime(2020, 10, 12, 22, 13, 16))):
+            self.assertEqual(FHIRDate('eq{}'.format(date_str)).range, (start, end))
+
     def test_date_with_missing_modifier(self):
         fd = FHIRDate('true', None, FHIRModifiers.MISSING)
         self.assertTrue(fd.value)
@@ -128,6 +152,17 @@ class TestFHIRSearchTypes(TestCase):
             self.assertEqual(ft.value, code_value)
             self.assertEqual(ft.modifier, operator)
 
+    def test_token_list(self):
+        ft = FHIRToken('http://loinc.org|1234-5,6789-0,|no-system,http://loinc.org|,a\\,b\\|c', None, '=')
+        self.assertEqual(ft.tokens, [('http://loinc.org', '1234-5'), (None, '6789-0'), ('', 'no-system'),
+                                     ('http://loinc.org', None), (None, 'a,b|c')])
+        self.assertEqual(ft.system, 'http://loinc.org')
+        self.assertEqual(ft.value, '1234-5')
+        # the url of a ValueSet or a text are kept as they are
+        ft = FHIRToken('http://hl7.org/fhir/ValueSet/x|4.0.1', None, FHIRModifiers.IN)
+        self.assertEqual(ft.text, 'http://hl7.org/fhir/ValueSet/x|4.0.1')
+        self.assertRaises(ValueError, FHIRToken, 'a,|', None, '=')
+
     def test_token_with_missing_modifier(self):
         ft = FHIRToken('true', None, FHIRModifiers.MISSING)
         self.assertTrue(ft.value)
@@ -232,4 +267,37 @@ class TestFHIRSearchTypes(TestCase):
 
         fu = FHIRUri('false', None, FHIRModifiers.MISSING)
         self.assertFalse(fu.value)
-        self.assertEqual(fu.modifier, FHIRModifiers.MISSING)
\ No newline at end of file
+        self.assertEqual(fu.modifier, FHIRModifiers.MISSING)
+
+class TestSearchParser(TestCase):
+
+    def setUp(self):
+        self.parser = SearchParser([
+            query_argument_type_factory('_lastUpdated', FHIRSearchTypes.DATE, 'lastUpdated'),
+            query_argument_type_factory('family', FHIRSearchTypes.STRING),
+            query_argument_type_factory('birthdate', FHIRSearchTypes.DATE),
+        ])
+
+    def test_parse(self):
+        args = self.parser.parse(MultiDict([
+            ('family:exact', 'Reed'),
+            ('_lastUpdated', 'gt2020-01-01'),
+            ('birthdate:missing', 'true'),
+            ('unknown', 'ignored')
+        ]))
+        self.assertEqual(set(args), {'family', 'lastUpdated', 'birthdate'})
+        self.assertIsInstance(args['family'], FHIRString)
+        self.assertEqual(args['family'].modifier, FHIRModifiers.EXACT)
+        self.assertEqual(args['lastUpdated'].value, isoparse('2020-01-01'))
+        self.assertTrue(args['birthdate'].value)
+
+    def test_parse_repeated_parameter(self):
+        args = self.parser.parse(MultiDict([('family', 'Reed'), ('family:contains', 'Cox'), ('family', 'Dorian')]))
+        self.assertEqual(args['family'].value, 'Reed')
+
+    def test_parse_errors(self):
+        for args in ([('birthdate', '19650606')], [('family:unknown', 'Reed'), ('birthdate:missing', 'maybe')]):
+            with self.assertRaises(InvalidQueryParameterException) as context:
+                self.parser.parse(MultiDict(args))
+            self.assertEqual(context.exception.http_code, 400)
+            self.assertEqual([error.path for error in context.exception.errors], ['birthdate'])
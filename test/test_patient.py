@@ -1,10 +1,12 @@
 from datetime import datetime
+from unittest import mock
 
 from fhirserver import create_app, TESTING
 from fhirserver.consts import ISSUE_TYPE, ISSUE_SEVERITY
-from fhirserver.dao.patient import PatientModel
+from fhirserver.dao.patient import PatientModel, PatientDAO
 from fhirserver import db
 from flask_testing import TestCase
+from sqlalchemy.exc import IntegrityError
 
 
 class TestPatient(TestCase):
@@ -63,6 +65,7 @@ class TestPatient(TestCase):
             pm = PatientModel(**patient)
             db.session.add(pm)
             patient['id'] = pm.id
+            patient['last_updated'] = pm.last_updated
 
         db.session.commit()
 
@@ -140,10 +143,158 @@ class TestPatient(TestCase):
         self.assert200(res)
         self.assertEqual(res.json['resourceType'], 'Bundle')
         self.assertEqual(res.json['type'], 'searchset')
+        # results are sorted by id, which is the pagination key
+        patients_data = sorted(self.patients_data, key=lambda p: p['id'])
         for index, patient in enumerate(res.json['entry']):
             self.assertEqual(patient['fullUrl'],
-                             '{}/Patient/{}'.format(self.settings['api_base'], self.patients_data[index]['id']))
-            self.assertEqual(patient['resource'], PatientModel(**self.patients_data[index]).to_fhir_res().as_json())
+                             '{}/Patient/{}'.format(self.settings['api_base'], patients_data[index]['id']))
+            self.assertEqual(patient['resource'], PatientModel(**patients_data[index]).to_fhir_res().as_json())
+
+    def test_search_pagination(self):
+        patients_ids = sorted(patient['id'] for patient in self.patients_data)
+        url = '/Patient?_count=3'
+        found_ids = []
+        while url is not None:
+            res = self.client.get(url, headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            self.assertEqual(res.json['total'], len(patients_ids))
+            self.assertLessEqual(len(res.json['entry']), 3)
+            found_ids.extend(entry['resource']['id'] for entry in res.json['entry'])
+            links = {link['relation']: link['url'] for link in res.json['link']}
+            self.assertIn('self', links)
+            url = links.get('next')
+        self.assertEqual(found_ids, patients_ids)
+
+    def _search_all_pages(self, url):
+        found = []
+        while url is not None:
+            res = self.client.get(url, headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            found.extend(entry['resource'] for entry in res.json.get('entry', []))
+            url = {link['relation']: link['url'] for link in res.json['link']}.get('next')
+        return found
+
+    def test_search_sort(self):
+        # the patients without birthdate come first in ascending order and last in descending order
+        for query, expected in (('_sort=family', ['Cox', 'Dorian', 'Espinoza', 'Reed']),
+                                ('_sort=-family', ['Reed', 'Espinoza', 'Dorian', 'Cox']),
+                                ('_sort=birthdate', ['Dorian', 'Cox', 'Espinoza', 'Reed']),
+                                ('_sort=-birthdate', ['Reed', 'Espinoza', 'Cox', 'Dorian']),
+                                ('_sort=-gender,birthdate', ['Dorian', 'Cox', 'Espinoza', 'Reed']),
+                                ('_sort=address,-family', ['Cox', 'Reed', 'Espinoza', 'Dorian'])):
+            for count in (1, 2, 10):
+                patients = self._search_all_pages('/Patient?{}&_count={}'.format(query, count))
+                self.assertEqual([patient['name'][0]['family'] for patient in patients], expected,
+                                 '{} _count={}'.format(query, count))
+
+    def test_search_sort_ties(self):
+        for index in range(5):
+            db.session.add(PatientModel(given_name='Twin', family_name='Reed', gender='f'))
+        db.session.commit()
+        patients = self._search_all_pages('/Patient?_sort=family,given&_count=2')
+        self.assertEqual(len(patients), len(self.patients_data) + 5)
+        self.assertEqual(len({patient['id'] for patient in patients}), len(patients))
+        twins = [patient['id'] for patient in patients if patient['name'][0]['given'] == ['Twin']]
+        self.assertEqual(twins, sorted(twins))
+
+    def test_search_wrong_sort(self):
+        for query in ('_sort=unknown', '_sort=', '_sort=family,-', '_sort=family&_cursor=WyJhIl0'):
+            res = self.client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert400(res)
+            self.assertEqual(res.json['resourceType'], 'OperationOutcome')
+
+    def test_search_summary_count(self):
+        with mock.patch.object(PatientDAO, '_serialize') as serialize:
+            res = self.client.get('/Patient?_summary=count&address=Sacred Heart Street',
+                                  headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.json['total'], 3)
+        self.assertNotIn('entry', res.json)
+        self.assertEqual(res.json['link'][0]['relation'], 'self')
+        serialize.assert_not_called()
+
+    def test_search_elements(self):
+        subsetted = {'system': 'http://terminology.hl7.org/CodeSystem/v3-ObservationValue', 'code': 'SUBSETTED'}
+        for direct in (True, False):
+            PatientDAO.DIRECT_SERIALIZATION = direct
+            try:
+                res = self.client.get('/Patient?_elements=name,birthDate,telecom&_sort=-birthdate&_count=2',
+                                      headers={'Accept': 'application/fhir+json'})
+            finally:
+                PatientDAO.DIRECT_SERIALIZATION = True
+            self.assert200(res)
+            patient = res.json['entry'][0]['resource']
+            self.assertEqual(set(patient), {'resourceType', 'id', 'meta', 'name', 'birthDate'})
+            self.assertEqual(patient['name'], [{'given': ['Elliot'], 'family': 'Reed'}])
+            self.assertEqual(patient['meta']['tag'], [subsetted])
+
+            # the sort keys are loaded to build the cursor of the next page
+            next_url = [link['url'] for link in res.json['link'] if link['relation'] == 'next'][0]
+            res = self.client.get(next_url, headers={'Accept': 'application/fhir+json'})
+            self.assertEqual([entry['resource']['name'][0]['family'] for entry in res.json['entry']],
+                             ['Cox', 'Dorian'])
+
+        res = self.client.get('/Patient?_elements=,name', headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+
+    def test_search_elements_projection(self):
+        query = PatientDAO.search({}, 10, elements=['gender']).query
+        self.assertEqual([column['name'] for column in query.column_descriptions],
+                         ['id', 'version_id', 'last_updated', 'gender'])
+
+    def test_search_summary_true(self):
+        res = self.client.get('/Patient?_summary=true&family=Reed', headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        patient = res.json['entry'][0]['resource']
+        self.assertEqual(set(patient), {'resourceType', 'id', 'meta', 'name', 'gender', 'birthDate', 'address'})
+        self.assertEqual(patient['meta']['tag'][0]['code'], 'SUBSETTED')
+
+    def test_search_total(self):
+        for total, expected in (('accurate', 4), ('estimate', 4), ('none', None)):
+            for stream in (False, True):
+                self.app.config['STREAM_SEARCH_RESULTS'] = stream
+                res = self.client.get('/Patient?_total={}&_count=2'.format(total),
+                                      headers={'Accept': 'application/fhir+json'})
+                self.assert200(res)
+                self.assertEqual(res.json.get('total'), expected)
+                self.assertEqual(len(res.json['entry']), 2)
+                # the version of the results is known only if they are counted
+                self.assertEqual('ETag' in res.headers, total == 'accurate')
+
+        for query in ('_total=all', '_summary=none'):
+            res = self.client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert400(res)
+
+    def test_search_pagination_with_filter(self):
+        res = self.client.get('/Patient?address=Sacred Heart Street&_count=2',
+                              headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.json['total'], 3)
+        self.assertEqual(len(res.json['entry']), 2)
+        next_url = [link['url'] for link in res.json['link'] if link['relation'] == 'next'][0]
+        self.assertIn('address=Sacred+Heart+Street', next_url)
+
+        res = self.client.get(next_url, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(len(res.json['entry']), 1)
+        self.assertNotIn('next', [link['relation'] for link in res.json['link']])
+
+    def test_search_streaming(self):
+        for query in ('', 'address=Sacred Heart Street&_count=2', 'address=Unknown'):
+            self.app.config['STREAM_SEARCH_RESULTS'] = False
+            expected = self.client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.app.config['STREAM_SEARCH_RESULTS'] = True
+            res = self.client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert200(res)
+            self.assertTrue(res.is_streamed)
+            self.assertEqual(res.headers['Content-Type'], 'application/fhir+json')
+            self.assertEqual(res.json, expected.json)
+
+    def test_search_wrong_pagination_parameters(self):
+        for query in ('_count=-1', '_count=notanumber', '_cursor=notacursor'):
+            res = self.client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+            self.assert400(res)
+            self.assertEqual(res.json['resourceType'], 'OperationOutcome')
 
     def _search_patient(self, queries):
         for query in queries:
@@ -155,7 +306,8 @@ class TestPatient(TestCase):
             self.assertEqual(res.json['resourceType'], 'Bundle')
             self.assertEqual(res.json['type'], 'searchset')
             self.assertEqual(res.json['total'], query['expected'])
-            self.assertEqual(len(res.json['entry']), query['expected'])
+            # empty arrays are not allowed in FHIR json, so entry is missing when nothing is found
+            self.assertEqual(len(res.json.get('entry', [])), query['expected'])
 
     def test_search_by_string(self):
         queries = [
@@ -168,6 +320,39 @@ class TestPatient(TestCase):
         ]
         self._search_patient(queries)
 
+    def test_search_by_name(self):
+        queries = [
+            {'family': 'reed', 'expected': 1},
+            {'family:exact': 'reed', 'expected': 0},
+            {'family:exact': 'Reed', 'expected': 1},
+            {'given': 'Elliot', 'expected': 1},
+            {'name': 'cox', 'expected': 1},
+            {'name': 'Percival', 'expected': 1},
+            {'name': 'Unknown', 'expected': 0},
+            {'name': 'Reed', 'gender': 'female', 'expected': 1},
+        ]
+        self._search_patient(queries)
+
+    def test_search_by_token(self):
+        queries = [
+            {'_id': self.patients_data[0]['id'], 'expected': 1},
+            {'gender': 'female', 'expected': 2},
+            {'gender': 'http://hl7.org/fhir/administrative-gender|male', 'expected': 2},
+            {'gender': 'http://unknown.org|male', 'expected': 0},
+            {'gender': 'unknown', 'expected': 0},
+            {'gender:not': 'female', 'expected': 2},
+            {'gender:not': 'notacode', 'expected': 4},
+            {'active': 'true', 'expected': 4},
+            {'active': 'false', 'expected': 0},
+            {'identifier:missing': 'true', 'expected': 4},
+        ]
+        self._search_patient(queries)
+
+    def test_search_unsupported_modifier(self):
+        res = self.client.get('/Patient?gender:text=female', headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+        self.assertEqual(res.json['issue'][0]['expression'], ['gender'])
+
     def test_search_by_date(self):
         queries = [
             {'birthdate:missing': 'true', 'expected': 1},
@@ -211,3 +396,131 @@ class TestPatient(TestCase):
     #     self.assertEqual(res.json['total'], 0)
     #     self.assertEqual(res.json['entry'], [])
 
+
+    def _bundle(self, bundle_type, patients):
+        return {
+            'resourceType': 'Bundle',
+            'type': bundle_type,
+            'entry': [{
+                'resource': dict(patient, resourceType='Patient'),
+                'request': {'method': 'POST', 'url': 'Patient'}
+            } for patient in patients]
+        }
+
+    def test_batch_creation(self):
+        invalid_patient = dict(self.patient_data, name=self.patient_data['name'][0])
+        bundle = self._bundle('batch', [self.patient_data, self.patient_data, invalid_patient, self.patient_data])
+        bundle['entry'].append({'resource': dict(self.patient_data, resourceType='Patient'),
+                                'request': {'method': 'PUT', 'url': 'Patient/123'}})
+
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.json['resourceType'], 'Bundle')
+        self.assertEqual(res.json['type'], 'batch-response')
+        statuses = [entry['response']['status'] for entry in res.json['entry']]
+        self.assertEqual(statuses, ['201 Created', '201 Created', '400 Bad Request', '201 Created', '400 Bad Request'])
+        self.assertEqual(res.json['entry'][2]['response']['outcome']['issue'], [{
+            'code': ISSUE_TYPE.INVALID,
+            'severity': ISSUE_SEVERITY.FATAL,
+            'expression': ['entry[2].resource.name']
+        }])
+        self.assertEqual(res.json['entry'][4]['response']['outcome']['issue'], [{
+            'code': ISSUE_TYPE.NOT_SUPPORTED,
+            'severity': ISSUE_SEVERITY.FATAL,
+            'expression': ['entry[4].request.method']
+        }])
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data) + 3)
+
+        location = res.json['entry'][0]['response']['location']
+        res = self.client.get('/{}'.format(location), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.json['name'], self.patient_data['name'])
+
+    def test_batch_with_incomplete_entries(self):
+        no_given = dict(self.patient_data, name=[{'family': 'Reed'}])
+        unknown_gender = dict(self.patient_data, gender='robot')
+        bundle = self._bundle('batch', [no_given, self.patient_data, unknown_gender])
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        statuses = [entry['response']['status'] for entry in res.json['entry']]
+        self.assertEqual(statuses, ['400 Bad Request', '201 Created', '400 Bad Request'])
+        self.assertEqual(res.json['entry'][0]['response']['outcome']['issue'], [{
+            'code': ISSUE_TYPE.REQUIRED,
+            'severity': ISSUE_SEVERITY.FATAL,
+            'expression': ['entry[0].resource.name[0].given']
+        }])
+        self.assertEqual(res.json['entry'][2]['response']['outcome']['issue'][0]['expression'],
+                         ['entry[2].resource.gender'])
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data) + 1)
+
+    def test_transaction_creation(self):
+        bundle = self._bundle('transaction', [self.patient_data] * 5)
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertEqual(res.json['type'], 'transaction-response')
+        self.assertEqual(len(res.json['entry']), 5)
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data) + 5)
+
+    def test_transaction_with_invalid_entry(self):
+        invalid_patient = dict(self.patient_data, name=self.patient_data['name'][0])
+        bundle = self._bundle('transaction', [self.patient_data, invalid_patient])
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+        self.assertEqual(res.json['resourceType'], 'OperationOutcome')
+        self.assertEqual(res.json['issue'], [{
+            'code': ISSUE_TYPE.INVALID,
+            'severity': ISSUE_SEVERITY.FATAL,
+            'expression': ['entry[1].resource.name']
+        }])
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data))
+
+    def test_wrong_bundle_type(self):
+        bundle = self._bundle('collection', [self.patient_data])
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+        self.assertEqual(res.json['issue'][0]['code'], ISSUE_TYPE.NOT_SUPPORTED)
+
+    def _failing_bulk_create(self):
+        """
+        Make the database reject the patients with family name Fail
+        """
+        bulk_create = PatientDAO.bulk_create
+
+        def fail(patients):
+            if any(patient.family_name == 'Fail' for patient in patients):
+                raise IntegrityError('INSERT', {}, Exception('rejected'))
+            return bulk_create(patients)
+        return mock.patch.object(PatientDAO, 'bulk_create', side_effect=fail)
+
+    def test_batch_with_database_error(self):
+        failing_patient = dict(self.patient_data, name=[{'given': ['Paolino'], 'family': 'Fail'}])
+        bundle = self._bundle('batch', [self.patient_data, failing_patient, self.patient_data])
+        with self._failing_bulk_create():
+            res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        statuses = [entry['response']['status'] for entry in res.json['entry']]
+        self.assertEqual(statuses, ['201 Created', '500 Internal Server Error', '201 Created'])
+        self.assertEqual(res.json['entry'][1]['response']['outcome']['issue'], [{
+            'code': ISSUE_TYPE.EXCEPTION,
+            'severity': ISSUE_SEVERITY.FATAL,
+            'expression': ['entry[1].resource']
+        }])
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data) + 2)
+
+    def test_transaction_with_database_error(self):
+        failing_patient = dict(self.patient_data, name=[{'given': ['Paolino'], 'family': 'Fail'}])
+        bundle = self._bundle('transaction', [self.patient_data, failing_patient])
+        with self._failing_bulk_create():
+            res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert500(res)
+        self.assertEqual(res.json['resourceType'], 'OperationOutcome')
+        self.assertEqual(res.json['issue'][0]['expression'], ['entry[1].resource'])
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data))
+
+    def test_bundle_too_large(self):
+        self.app.config['BUNDLE_MAX_ENTRIES'] = 2
+        bundle = self._bundle('batch', [self.patient_data] * 3)
+        res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(res.json['issue'][0]['code'], ISSUE_TYPE.TOO_COSTLY)
+        self.assertEqual(PatientModel.query.count(), len(self.patients_data))
@@ -0,0 +1,108 @@
+from datetime import datetime
+
+from fhirclient.models.address import Address
+from fhirclient.models.fhirdate import FHIRDate
+from fhirclient.models.humanname import HumanName
+from fhirclient.models.identifier import Identifier
+from fhirclient.models.meta import Meta
+from fhirclient.models.patient import Patient
+from flask_testing import TestCase
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel, PatientDAO, patient_to_json, GENDERS
+
+
+class TestPatientSerialization(TestCase):
+    """
+    Checks that the direct serialization of the patients rows is equivalent to the fhirclient one
+    """
+
+    def setUp(self):
+        db.create_all()
+        self.patients_data = [{
+            'given_name': 'Carla',
+            'family_name': 'Espinoza',
+            'gender': 'f',
+            'birthdate': datetime.fromisoformat('1965-12-11'),
+            'address': 'Sacred Heart Street'
+        }, {
+            'identifier': 'MRN-0001',
+            'given_name': 'John Arthur',
+            'family_name': 'Dorian',
+            'gender': 'm',
+        }, {
+            'given_name': 'Jordan',
+            'family_name': 'Sullivan',
+            'gender': 'u',
+            'birthdate': datetime.fromisoformat('1968-02-29T10:30:00'),
+        }, {
+            'given_name': 'Laverne',
+            'family_name': 'Roberts',
+            'gender': 'o',
+            'address': 'Sacred Heart Street'
+        }]
+        for patient in self.patients_data:
+            pm = PatientModel(**patient)
+            db.session.add(pm)
+            patient['id'] = pm.id
+            patient['last_updated'] = pm.last_updated
+        db.session.commit()
+
+    def tearDown(self):
+        PatientDAO.DIRECT_SERIALIZATION = True
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    @staticmethod
+    def _fhirclient_patient(data):
+        """
+        Builds the Patient through the fhirclient API, as reference
+        """
+        patient = Patient()
+        patient.id = data['id']
+        meta = Meta()
+        meta.versionId = '1'
+        meta.lastUpdated = FHIRDate('{}Z'.format(data['last_updated'].isoformat(timespec='milliseconds')))
+        patient.meta = meta
+        name = HumanName()
+        name.given = data['given_name'].split(' ')
+        name.family = data['family_name']
+        patient.name = [name]
+        patient.gender = GENDERS[data['gender']]
+        if data.get('identifier') is not None:
+            identifier = Identifier()
+            identifier.value = data['identifier']
+            patient.identifier = [identifier]
+        if data.get('birthdate') is not None:
+            patient.birthDate = FHIRDate(data['birthdate'].date().isoformat())
+        if data.get('address') is not None:
+            address = Address()
+            address.text = data['address']
+            patient.address = [address]
+        return patient
+
+    def test_model_serialization(self):
+        for data in self.patients_data:
+            patient = PatientModel.query.get(data['id'])
+            self.assertEqual(patient_to_json(patient), self._fhirclient_patient(data).as_json())
+            self.assertEqual(patient.to_json(), patient.to_fhir_res().as_json())
+
+    def test_row_serialization(self):
+        rows = db.session.query(*PatientModel.__table__.columns).all()
+        self.assertEqual(len(rows), len(self.patients_data))
+        for row in rows:
+            data = [data for data in self.patients_data if data['id'] == row.id][0]
+            self.assertEqual(patient_to_json(row), self._fhirclient_patient(data).as_json())
+
+    def test_dao_serialization(self):
+        for direct_serialization in (True, False):
+            PatientDAO.DIRECT_SERIALIZATION = direct_serialization
+            for data in self.patients_data:
+                self.assertEqual(PatientDAO.get(data['id']), self._fhirclient_patient(data).as_json())
+
+            page = PatientDAO.search({}, len(self.patients_data))
+            expected = sorted(self.patients_data, key=lambda p: p['id'])
+            self.assertEqual(list(page), [self._fhirclient_patient(data).as_json() for data in expected])
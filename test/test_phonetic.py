@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+from flask_testing import TestCase as FlaskTestCase
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel
+from fhirserver.phonetic import soundex, first_name_soundex
+from fhirserver.search import backfill_shadow_columns
+
+
+class TestSoundex(TestCase):
+
+    def test_soundex(self):
+        for name, key in (('Robert', 'R163'), ('Rupert', 'R163'), ('Ashcraft', 'A261'), ('Tymczak', 'T522'),
+                          ('Pfister', 'P236'), ('Lee', 'L000'), ('Smith', 'S530'), ('smyth', 'S530'),
+                          ('Smïth', 'S530'), ("O'Brien", 'O165')):
+            self.assertEqual(soundex(name), key, name)
+        self.assertIsNone(soundex('123'))
+        self.assertEqual(first_name_soundex('John Michael'), 'J500')
+        self.assertIsNone(first_name_soundex(' '))
+
+
+class TestPhoneticSearch(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        db.session.add_all([
+            PatientModel(given_name='Jon Michael', family_name='Smith', gender='m'),
+            PatientModel(given_name='Elliot', family_name='Reed', gender='f'),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _families(self, query_string):
+        res = self.client.get('/Patient?{}'.format(query_string), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return sorted(entry['resource']['name'][0]['family'] for entry in res.json.get('entry', []))
+
+    def test_phonetic(self):
+        self.assertEqual(self._families('phonetic=smyth'), ['Smith'])
+        self.assertEqual(self._families('phonetic=John'), ['Smith'])
+        self.assertEqual(self._families('phonetic=Elyot'), ['Reed'])
+        # only the first given name is encoded
+        self.assertEqual(self._families('phonetic=Michael'), [])
+        self.assertEqual(self._families('phonetic=42'), [])
+        self.assert400(self.client.get('/Patient?phonetic:exact=Smith', headers={'Accept': 'application/fhir+json'}))
+
+    def test_backfill(self):
+        db.session.execute(PatientModel.__table__.update().values(family_name_phonetic=None,
+                                                                  family_name_normalized=None))
+        db.session.commit()
+        self.assertEqual(self._families('phonetic=smyth'), [])
+        updated = backfill_shadow_columns(db.engine, db.metadata, batch_size=1)
+        self.assertEqual(updated['patients.family_name_phonetic'], 2)
+        self.assertEqual(updated['patients.given_name_phonetic'], 0)
+        self.assertEqual(self._families('phonetic=smyth'), ['Smith'])
+        self.assertEqual(self._families('family=ree'), ['Reed'])
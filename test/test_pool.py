@@ -0,0 +1,89 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from flask_testing import TestCase as FlaskTestCase
+from sqlalchemy import create_engine, exc
+
+from config import ProductionConfig
+from fhirserver import create_app, TESTING, PRODUCTION, db
+from fhirserver.pool import MeteredQueuePool, engine_options, pool_stats
+
+
+class TestPool(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.gettempdir(), 'fhir-test-pool.db')
+        self.engine = create_engine('sqlite:///{}'.format(self.path), poolclass=MeteredQueuePool, pool_size=1,
+                                    max_overflow=1, pool_timeout=0.1, connect_args={'check_same_thread': False})
+
+    def tearDown(self):
+        self.engine.dispose()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_metrics(self):
+        first = self.engine.connect()
+        self.assertEqual(pool_stats(self.engine)['overflows'], 0)
+        second = self.engine.connect()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow'], 1)
+        self.assertEqual(stats['overflows'], 1)
+
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertGreaterEqual(stats['max_checkout_time'], 0.1)
+
+        first.close()
+        second.close()
+        self.assertEqual(pool_stats(self.engine)['checked_out'], 0)
+
+    def test_engine_options(self):
+        config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'DB_POOL_SIZE': 3,
+            'DB_MAX_OVERFLOW': 2,
+            'DB_POOL_TIMEOUT': 10,
+            'DB_POOL_RECYCLE': 60,
+            'DB_POOL_PRE_PING': True
+        }
+        # an in-memory database has a single connection
+        self.assertEqual(engine_options(config), {})
+
+        config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://localhost/fhir'
+        options = engine_options(config)
+        self.assertEqual(options['poolclass'], MeteredQueuePool)
+        self.assertEqual((options['pool_size'], options['max_overflow'], options['pool_pre_ping']), (3, 2, True))
+        self.assertNotIn('connect_args', options)
+
+    def test_production_requires_database(self):
+        with mock.patch.object(ProductionConfig, 'SQLALCHEMY_DATABASE_URI', None):
+            with self.assertRaises(RuntimeError):
+                create_app(PRODUCTION)
+
+
+class TestAppPool(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def test_sqlite_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA foreign_keys').scalar(), 1)
+
+    def test_app_pool_metrics(self):
+        self.client.get('/Patient', headers={'Accept': 'application/fhir+json'})
+        stats = pool_stats(db.engine)
+        self.assertEqual(stats['size'], self.app.config['DB_POOL_SIZE'])
+        self.assertGreater(stats['checkouts'], 0)
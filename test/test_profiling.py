@@ -0,0 +1,110 @@
+import re
+from unittest import mock
+
+from flask_testing import TestCase
+from werkzeug.datastructures import MultiDict
+
+from config import TestConfig
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel, PatientDAO
+
+
+class TestProfiling(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        db.session.add(PatientModel(given_name='Elliot', family_name='Reed', gender='f'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _search(self, **headers):
+        headers['Accept'] = 'application/fhir+json'
+        return self.client.get('/Patient?family=Reed', headers=headers)
+
+    def test_not_profiled(self):
+        res = self._search()
+        self.assert200(res)
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_profile_header(self):
+        with self.assertLogs('fhirserver.profiling', 'INFO') as logs:
+            res = self._search(**{'X-Profile': 'true'})
+        self.assert200(res)
+        timing = res.headers['Server-Timing']
+        for phase in ('parse', 'query', 'fetch', 'serialize', 'render', 'total'):
+            self.assertTrue(re.search(r'\b{};dur=\d+\.\d+'.format(phase), timing), phase)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('search-type Patient?family 200', logs.output[0])
+
+    def test_streamed_profile(self):
+        self.app.config['STREAM_SEARCH_RESULTS'] = True
+        with self.assertLogs('fhirserver.profiling', 'INFO') as logs:
+            res = self._search(**{'X-Profile': '1'})
+            self.assert200(res)
+            self.assertEqual(res.json['total'], 1)
+            res.close()
+        # the entries are fetched after the headers are sent, so only the log has all the phases
+        self.assertNotIn('fetch', res.headers['Server-Timing'])
+        self.assertIn('fetch=', logs.output[0])
+
+    def test_sampled(self):
+        self.app.config['PROFILING_HEADER'] = ''
+        self.assertNotIn('Server-Timing', self._search(**{'X-Profile': 'true'}).headers)
+        self.app.config['PROFILING_SAMPLE_RATE'] = 1
+        self.assertIn('Server-Timing', self._search().headers)
+
+    def test_profiled_without_metrics(self):
+        with mock.patch.object(TestConfig, 'METRICS_ENABLED', False):
+            app = create_app(TESTING)
+        res = app.test_client().get('/Patient', headers={'Accept': 'application/fhir+json', 'X-Profile': 'true'})
+        self.assert200(res)
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+        self.assert404(app.test_client().get('/metrics'))
+
+    def test_slow_query_log(self):
+        query_args = self.app.extensions['search_parsers']['Patient'].parse(MultiDict([('family', 'Reed')]))
+        with self.assertLogs('fhirserver.slow_queries', 'WARNING') as logs:
+            self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 1e-6
+            self.assertEqual(len(list(PatientDAO.search(query_args, 10))), 1)
+            self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+            self.assertEqual(PatientDAO.count({}), 1)
+        # the total and the page of the search
+        self.assertEqual(len(logs.output), 2)
+        self.assertRegex(logs.output[0], r'Slow query \(\d+\.\d+ms, 1 rows\): SELECT count\(')
+        self.assertRegex(logs.output[1], r'(?s)Slow query \(\d+\.\d+ms, 1 rows\): SELECT .*FROM patients')
+        # the parameters are patient data, so they are redacted
+        self.assertNotIn('reed', logs.output[1])
+        self.assertIn('parameters: ', logs.output[1])
+        self.assertIn(' redacted', logs.output[1])
+
+        self.app.config['SLOW_QUERY_LOG_PARAMETERS'] = True
+        with self.assertLogs('fhirserver.slow_queries', 'WARNING') as logs:
+            self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 1e-6
+            self.assertEqual(len(list(PatientDAO.search(query_args, 10))), 1)
+            self.app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+        self.assertIn("'reed'", logs.output[-1])
+
+    def test_production_defaults(self):
+        from config import ProductionConfig
+
+        self.assertEqual(ProductionConfig.SLOW_QUERY_THRESHOLD_MS, 0)
+        self.assertFalse(ProductionConfig.SLOW_QUERY_LOG_PARAMETERS)
+
+    def test_env_flag(self):
+        from config import env_flag
+
+        for value in ('1', 'true', 'True', 'yes', 'on'):
+            with mock.patch.dict('os.environ', {'SLOW_QUERY_LOG_PARAMETERS': value}):
+                self.assertTrue(env_flag('SLOW_QUERY_LOG_PARAMETERS', False), value)
+        for value in ('0', 'false', 'False', 'no', 'off', ''):
+            with mock.patch.dict('os.environ', {'SLOW_QUERY_LOG_PARAMETERS': value}):
+                self.assertFalse(env_flag('SLOW_QUERY_LOG_PARAMETERS', True), value)
+        with mock.patch.dict('os.environ', clear=True):
+            self.assertTrue(env_flag('SLOW_QUERY_LOG_PARAMETERS', True))
+            self.assertFalse(env_flag('SLOW_QUERY_LOG_PARAMETERS', False))
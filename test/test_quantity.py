@@ -0,0 +1,133 @@
+import re
+from decimal import Decimal
+from unittest import TestCase
+
+from flask_testing import TestCase as FlaskTestCase
+from werkzeug.datastructures import MultiDict
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.generic import ResourceModel
+from fhirserver.resources.router import _get_resource
+from fhirserver.ucum import canonical_unit, unit_key, UCUM_SYSTEM
+
+
+class TestUcum(TestCase):
+
+    def test_canonical_unit(self):
+        self.assertEqual(canonical_unit('mg'), ('g', Decimal('0.001')))
+        self.assertEqual(canonical_unit('mg/dL'), ('g.m-3', Decimal(10)))
+        self.assertEqual(canonical_unit('mmol/L'), ('m-3.mol', Decimal(1)))
+        self.assertEqual(canonical_unit('10*3/uL'), ('m-3', Decimal('1e12')))
+        self.assertEqual(canonical_unit('{beats}/min')[0], 's-1')
+        self.assertEqual(canonical_unit('%'), ('1', Decimal('0.01')))
+        self.assertIsNone(canonical_unit('Cel'))
+
+    def test_unit_key(self):
+        self.assertEqual(unit_key(UCUM_SYSTEM, 'kg'), ('g', Decimal(1000)))
+        self.assertEqual(unit_key(None, 'kg'), ('g', Decimal(1000)))
+        self.assertEqual(unit_key(UCUM_SYSTEM, 'Cel'), ('{}|Cel'.format(UCUM_SYSTEM), Decimal(1)))
+        self.assertEqual(unit_key('http://snomed.info/sct', '258672001'),
+                         ('http://snomed.info/sct|258672001', Decimal(1)))
+        self.assertIsNone(unit_key(UCUM_SYSTEM, None))
+
+
+class TestNumberSearch(FlaskTestCase):
+
+    def setUp(self):
+        db.create_all()
+        observations = [
+            {'value': 5.4, 'system': UCUM_SYSTEM, 'code': 'mg'},
+            {'value': 0.01, 'system': UCUM_SYSTEM, 'code': 'g'},
+            {'value': 100, 'system': UCUM_SYSTEM, 'code': 'mg/dL'},
+            {'value': 37.5, 'system': UCUM_SYSTEM, 'code': 'Cel'},
+        ]
+        self.observations = [self._post({
+            'resourceType': 'Observation',
+            'status': 'final',
+            'code': {'text': 'test'},
+            'valueQuantity': quantity
+        }) for quantity in observations]
+        self.assessments = [self._post({
+            'resourceType': 'RiskAssessment',
+            'status': 'final',
+            'subject': {'reference': 'Patient/1'},
+            'prediction': [dict(prediction, outcome={'text': 'stroke'})]
+        }) for prediction in ({'probabilityDecimal': 0.02},
+                              {'probabilityDecimal': 0.8},
+                              {'probabilityRange': {'low': {'value': 0.1}, 'high': {'value': 0.3}}},
+                              {'probabilityRange': {'low': {'value': 0.5}}})]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _post(self, data):
+        res = self.client.post('/{}'.format(data['resourceType']), json=data,
+                               headers={'Accept': 'application/fhir+json'})
+        self.assertStatus(res, 201)
+        return res.json['id']
+
+    def _search(self, resource_type, query):
+        res = self.client.get('/{}?{}'.format(resource_type, query), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return sorted(entry['resource']['id'] for entry in res.json.get('entry', []))
+
+    def _observations(self, query):
+        return self._search('Observation', 'value-quantity={}'.format(query))
+
+    def _assessments(self, query):
+        return self._search('RiskAssessment', 'probability={}'.format(query))
+
+    def test_quantity_units(self):
+        mg, g, mg_dl, celsius = self.observations
+        # the quantities are compared in the canonical unit
+        self.assertEqual(self._observations('gt5|{}|mg'.format(UCUM_SYSTEM)), sorted([mg, g]))
+        self.assertEqual(self._observations('10|{}|mg'.format(UCUM_SYSTEM)), [g])
+        self.assertEqual(self._observations('lt0.006||g'), [mg])
+        self.assertEqual(self._observations('1|{}|g/L'.format(UCUM_SYSTEM)), [mg_dl])
+        # the units that can't be converted are compared as they are
+        self.assertEqual(self._observations('37.5|{}|Cel'.format(UCUM_SYSTEM)), [celsius])
+        self.assertEqual(self._observations('37.5|{}|K'.format(UCUM_SYSTEM)), [])
+        # without a unit, the values are compared in any unit
+        self.assertEqual(self._observations('ge37'), sorted([mg_dl, celsius]))
+
+    def test_quantity_precision(self):
+        mg = self.observations[0]
+        self.assertEqual(self._observations('5|{}|mg'.format(UCUM_SYSTEM)), [mg])
+        self.assertEqual(self._observations('5.0|{}|mg'.format(UCUM_SYSTEM)), [])
+        self.assertEqual(self._observations('5.4'), [mg])
+        self.assertEqual(self._observations('5.40'), [mg])
+        self.assertEqual(self._observations('ap5.0|{}|mg'.format(UCUM_SYSTEM)), [mg])
+
+    def test_number_ranges(self):
+        low, high, bounded, unbounded = self.assessments
+        self.assertEqual(self._assessments('0.02'), [low])
+        self.assertEqual(self._assessments('0.2'), [bounded])
+        self.assertEqual(self._assessments('0.9'), [unbounded])
+        self.assertEqual(self._assessments('gt0.4'), sorted([high, unbounded]))
+        self.assertEqual(self._assessments('lt0.2'), sorted([low, bounded]))
+        self.assertEqual(self._assessments('sa0.35'), sorted([high, unbounded]))
+        self.assertEqual(self._assessments('eb0.05'), [low])
+        self.assertEqual(self._assessments('ne0.2'), sorted([low, high, unbounded]))
+        self.assertEqual(self._search('RiskAssessment', 'probability:missing=false'), sorted(self.assessments))
+
+    def test_index_plans(self):
+        for resource_type, query_string in (('Observation', 'value-quantity=gt5|{}|mg'.format(UCUM_SYSTEM)),
+                                            ('Observation', 'value-quantity=5.4'),
+                                            ('RiskAssessment', 'probability=0.2'),
+                                            ('RiskAssessment', 'probability=gt0.4')):
+            parser = self.app.extensions['search_parsers'][resource_type]
+            dao = _get_resource('{}ListResource'.format(resource_type)).dao
+            query_args = parser.parse(MultiDict([query_string.split('=', 1)]))
+            sql = str(dao.search_query(query_args, ResourceModel.id).statement.compile(
+                db.engine, compile_kwargs={'literal_binds': True}))
+            plan = [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN {}'.format(sql))]
+            self.assertTrue(any('USING INDEX ix_search_' in step for step in plan), '{}: {}'.format(query_string, plan))
+            if query_string in ('value-quantity=5.4', 'probability=0.2'):
+                # the single numbers equal to the searched one are a range of an index bounded on both sides, of
+                # either bound because they are equal
+                self.assertTrue(any(re.search(r'(value|high)>\? AND \1<\?', step) for step in plan),
+                                '{}: {}'.format(query_string, plan))
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from flask_testing import TestCase
+
+from config import TestConfig
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel, PatientDAO
+from fhirserver.replicas import read_session, LAST_WRITE_COOKIE
+
+REPLICA_PATH = os.path.join(tempfile.gettempdir(), 'fhir-test-replica.db')
+
+
+class TestReplicas(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        # the replica is a different database, so that the reads routed to it are recognizable
+        self.replica = db.get_engine(self.app, 'replica-0')
+        db.metadata.create_all(self.replica)
+        self.replica.execute(PatientModel.__table__.insert(), id='replica', given_name='Bob', family_name='Kelso',
+                             gender='m', version_id=1, last_updated=PatientModel().last_updated)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.metadata.drop_all(self.replica)
+        self.replica.dispose()
+        os.remove(REPLICA_PATH)
+
+    def create_app(self):
+        with mock.patch.object(TestConfig, 'DB_REPLICA_URIS', ['sqlite:///{}'.format(REPLICA_PATH)]):
+            return create_app(TESTING)
+
+    def _search(self, client, query):
+        # every request has its own app context, as in a server, while the test keeps one for all the requests
+        with self.app.app_context():
+            res = client.get('/Patient?{}'.format(query), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return res.json['total']
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self._search(self.client, 'family=Kelso'), 1)
+        res = self.client.get('/Patient/replica', headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        # the replica can lag behind the primary, so the resource is not cached
+        self.assertEqual(self.app.extensions['resource_cache'].stats()['size'], 0)
+
+    def test_read_your_writes(self):
+        with self.app.app_context():
+            res = self.client.post('/Patient', json={
+                'resourceType': 'Patient',
+                'name': [{'given': ['Elliot'], 'family': 'Reed'}],
+                'gender': 'female'
+            }, headers={'Accept': 'application/fhir+json'})
+        self.assertEqual(res.status_code, 201)
+
+        # the client that wrote reads from the primary
+        self.assertEqual(self._search(self.client, 'family=Reed'), 1)
+        self.assertEqual(self._search(self.client, 'family=Kelso'), 0)
+
+        # the other clients read from the replica
+        self.assertEqual(self._search(self.app.test_client(), 'family=Reed'), 0)
+
+        # until the stickiness window expires
+        self.app.extensions['replicas'].stickiness = 0
+        self.assertEqual(self._search(self.client, 'family=Reed'), 0)
+
+    def test_read_your_writes_without_secret_key(self):
+        self.app.secret_key = None
+        self.test_read_your_writes()
+
+    def test_batch_pins_the_client(self):
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{
+                'resource': {'resourceType': 'Patient', 'name': [{'given': ['Elliot'], 'family': 'Reed'}],
+                             'gender': 'female'},
+                'request': {'method': 'POST', 'url': 'Patient'}
+            }]
+        }
+        with self.app.app_context():
+            res = self.client.post('/', json=bundle, headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        self.assertIn(LAST_WRITE_COOKIE, res.headers['Set-Cookie'])
+        self.assertEqual(self._search(self.client, 'family=Reed'), 1)
+
+    def test_forged_cookie(self):
+        client = self.app.test_client()
+        client.set_cookie('localhost', LAST_WRITE_COOKIE, str(time.time() + 3600))
+        self.assertEqual(self._search(client, 'family=Kelso'), 1)
+        client.set_cookie('localhost', LAST_WRITE_COOKIE, 'invalid')
+        self.assertEqual(self._search(client, 'family=Kelso'), 1)
+
+    def test_write_pins_the_request(self):
+        self.assertIsNot(read_session(), db.session)
+        self.assertEqual(PatientDAO.count({}), 1)
+        PatientDAO.create(PatientModel(given_name='Elliot', family_name='Reed', gender='f'))
+        self.assertIs(read_session(), db.session)
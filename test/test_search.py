@@ -0,0 +1,265 @@
+import os
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from flask_testing import TestCase
+from sqlalchemy.dialects import postgresql
+from werkzeug.datastructures import MultiDict
+
+from fhirserver import create_app, TESTING, db, resources
+from fhirserver.dao.patient import PatientDAO, PatientModel
+from fhirserver.db_drivers import sqlalchemy as db_driver
+from fhirserver.pagination import encode_cursor
+from fhirserver.search import create_missing_sort_indexes, normalize
+from fhirserver.resources.router import COMMON_SEARCH_PARAMETERS, _get_resource
+
+
+class TestSearchPlans(TestCase):
+    """
+    Check that the search parameters are resolved by predicates that use an index
+    """
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _query_plan(self, query_string):
+        parser = self.app.extensions['search_parsers']['Patient']
+        query_args = parser.parse(MultiDict([parameter.split('=', 1) for parameter in query_string.split('&')]))
+        statement = PatientDAO.search_query(query_args).statement
+        sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN {}'.format(sql))]
+
+    def _page_query_plan(self, query_string):
+        parser = self.app.extensions['search_parsers']['Patient']
+        query_args = parser.parse(MultiDict([parameter.split('=', 1) for parameter in query_string.split('&')]))
+        cursor = query_args.pop('cursor', None)
+        page = PatientDAO.search(query_args, 10, cursor, query_args.pop('sort', None))
+        statement = page.query.limit(page.count + 1).statement
+        sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN {}'.format(sql))]
+
+    def assertUsesIndex(self, query_string):
+        plan = self._query_plan(query_string)
+        self.assertTrue(any('USING INDEX' in step for step in plan), '{}: {}'.format(query_string, plan))
+        self.assertFalse(any(step.startswith('SCAN') for step in plan), '{}: {}'.format(query_string, plan))
+
+    def test_declared_parameters_are_registered(self):
+        # a declared parameter is either served by the registry or rejected, never ignored
+        for resource_type in resources.RESOURCES:
+            resource = _get_resource('{}ListResource'.format(resource_type))
+            if resource_type == 'Patient':
+                registry = PatientDAO.SEARCH_PARAMETERS
+            else:
+                registry = resource.dao.search_parameters
+            for argument in COMMON_SEARCH_PARAMETERS + resource.get_search_parameters():
+                if argument.name in ('_count', '_cursor', '_sort', '_summary', '_total', '_elements') or \
+                        (argument.dest or argument.name) in registry:
+                    continue
+                res = self.client.get('/{}?{}=2020'.format(resource_type, argument.name),
+                                      headers={'Accept': 'application/fhir+json'})
+                self.assert400(res, argument.name)
+                self.assertEqual(res.json['issue'][0]['expression'], [argument.name])
+
+        res = self.client.get('/Patient?address-city=Nowhere', headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+        self.assertEqual(res.json['resourceType'], 'OperationOutcome')
+        self.assertIn('address', PatientDAO.SEARCH_PARAMETERS)
+        self.assertNotIn('address-city', PatientDAO.SEARCH_PARAMETERS)
+
+    def test_index_plans(self):
+        for query_string in ('_id=123', 'family=Reed', 'family:exact=Reed', 'given=Elliot', 'name=Reed',
+                             'address=Sacred Heart Street', 'address:missing=true', 'gender=female',
+                             'gender:not=female', 'identifier=12345', 'active=true', 'family=Reed&gender=female',
+                             'phonetic=Smyth'):
+            self.assertUsesIndex(query_string)
+
+    def test_string_plans(self):
+        for query_string in ('family=Reed', 'given=Ell', 'address=Sacred Heart'):
+            plan = self._query_plan(query_string)
+            self.assertTrue(any('_normalized' in step and 'USING INDEX' in step for step in plan),
+                            '{}: {}'.format(query_string, plan))
+
+    def test_fulltext_plans(self):
+        for query_string in ('family:contains=Ree', 'address:contains=Heart', '_content=Elliot Reed'):
+            plan = self._query_plan(query_string)
+            self.assertTrue(any('patients_fts VIRTUAL TABLE INDEX' in step for step in plan),
+                            '{}: {}'.format(query_string, plan))
+            self.assertFalse(any(step.startswith('SCAN patients ') for step in plan),
+                             '{}: {}'.format(query_string, plan))
+
+    def test_date_plans(self):
+        for prefix in ('eq', 'ne', 'lt', 'gt', 'le', 'ge', 'sa', 'eb', 'ap'):
+            for date_str in ('1970', '1970-06', '1970-06-18', '1970-06-18T10:00', '1970-06-18T10:00:00.123+02:00'):
+                self.assertUsesIndex('birthdate={}{}'.format(prefix, date_str))
+                self.assertUsesIndex('_lastUpdated={}{}'.format(prefix, date_str))
+
+    def test_sort_plans(self):
+        for sort in PatientDAO.SORTS:
+            # the sorts are declared with the destination names of the parameters
+            sort = sort.replace('lastUpdated', '_lastUpdated')
+            cursor = encode_cursor([None] * len(sort.split(',')) + ['0'])
+            for query_string in ('_sort={}'.format(sort), '_sort={}&_cursor={}'.format(sort, cursor)):
+                plan = self._page_query_plan(query_string)
+                self.assertTrue(any('USING INDEX ix_patients_sort_' in step for step in plan),
+                                '{}: {}'.format(query_string, plan))
+                self.assertFalse(any('TEMP B-TREE' in step for step in plan), '{}: {}'.format(query_string, plan))
+
+    def test_create_missing_sort_indexes(self):
+        self.assertEqual(create_missing_sort_indexes(db.engine, db.metadata), [])
+        db.session.execute('DROP INDEX ix_patients_sort_given_name')
+        self.assertEqual(create_missing_sort_indexes(db.engine, db.metadata), ['ix_patients_sort_given_name'])
+
+        db.session.execute('DROP INDEX ix_patients_sort_given_name')
+        result = self.app.test_cli_runner().invoke(args=['create-sort-indexes'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, 'Created index ix_patients_sort_given_name\n')
+
+    @unittest.skipUnless(os.environ.get('TEST_POSTGRES_URL'), 'TEST_POSTGRES_URL is not configured')
+    def test_postgres_date_plans(self):
+        from sqlalchemy import create_engine
+
+        engine = create_engine(os.environ['TEST_POSTGRES_URL'])
+        PatientModel.__table__.create(engine, checkfirst=True)
+        parser = self.app.extensions['search_parsers']['Patient']
+        try:
+            with engine.connect() as connection:
+                # the table is empty, so the planner has to be forced to consider the indexes
+                connection.execute('SET enable_seqscan = off')
+                for query_string in ('birthdate=ge1970-01-01', 'birthdate=eq1970', '_lastUpdated=lt2020-01-01T10:00'):
+                    name, value = query_string.split('=')
+                    statement = PatientDAO.search_query(parser.parse(MultiDict([(name, value)]))).statement
+                    compiled = statement.compile(dialect=engine.dialect)
+                    rows = connection.execute('EXPLAIN {}'.format(compiled), compiled.params)
+                    plan = '\n'.join(row[0] for row in rows)
+                    self.assertIn('Index', plan, '{}: {}'.format(query_string, plan))
+        finally:
+            PatientModel.__table__.drop(engine)
+
+    def test_estimate_count_statement(self):
+        query = PatientModel.query.filter(PatientModel.gender == 'o', PatientModel.family_name.in_(['a', 'b']))
+        bind = mock.Mock(dialect=postgresql.dialect())
+        with mock.patch.object(query.session, 'get_bind', return_value=bind), \
+                mock.patch.object(query.session, 'execute') as execute:
+            execute.return_value.scalar.return_value = [{'Plan': {'Plan Rows': 42}}]
+            self.assertEqual(db_driver.estimate_count(query), 42)
+
+        # the values are bound parameters of the EXPLAIN, not literals
+        explain = execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertTrue(str(explain).startswith('EXPLAIN (FORMAT JSON) SELECT'))
+        self.assertIn('patients.gender = %(gender_1)s AND patients.family_name IN (%(family_name_1)s, '
+                      '%(family_name_2)s)', str(explain))
+        self.assertEqual(explain.params, {'gender_1': 'o', 'family_name_1': 'a', 'family_name_2': 'b'})
+
+    @unittest.skipUnless(os.environ.get('TEST_POSTGRES_URL'), 'TEST_POSTGRES_URL is not configured')
+    def test_postgres_estimate_count(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import Session
+
+        engine = create_engine(os.environ['TEST_POSTGRES_URL'])
+        PatientModel.__table__.create(engine, checkfirst=True)
+        session = Session(bind=engine)
+        try:
+            session.add_all([PatientModel(given_name='Patient', family_name=str(index), gender='o')
+                             for index in range(100)])
+            session.commit()
+            session.execute('ANALYZE patients')
+            estimate = db_driver.estimate_count(session.query(PatientModel).filter(PatientModel.gender == 'o'))
+            self.assertGreater(estimate, 0)
+        finally:
+            session.close()
+            PatientModel.__table__.drop(engine)
+
+
+class TestDateSearch(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        for minute in range(3):
+            db.session.add(PatientModel(given_name='Patient', family_name=str(minute), gender='o',
+                                        last_updated=datetime(2020, 3, 1, 10, minute, 30)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _count(self, query_string):
+        res = self.client.get('/Patient?{}'.format(query_string), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return res.json['total']
+
+    def test_last_updated(self):
+        for query_string, expected in (('_lastUpdated=eq2020-03-01T10:01', 1),
+                                       ('_lastUpdated=eq2020-03-01T10', 3),
+                                       ('_lastUpdated=eq2020-03-01T12:01%2B02:00', 1),
+                                       ('_lastUpdated=ne2020-03-01T10:01', 2),
+                                       ('_lastUpdated=gt2020-03-01T10:01', 1),
+                                       ('_lastUpdated=ge2020-03-01T10:01', 2),
+                                       ('_lastUpdated=lt2020-03-01T10:01', 1),
+                                       ('_lastUpdated=le2020-03-01T10:01', 2),
+                                       ('_lastUpdated=lt2020-03-01T10:00:30', 0),
+                                       ('_lastUpdated=le2020-03-01T10:00:30', 1)):
+            self.assertEqual(self._count(query_string), expected, query_string)
+
+
+class TestStringSearch(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        db.session.add_all([
+            PatientModel(given_name='Élliot', family_name='Réed', gender='f', address='Sacred  Heart Street'),
+            PatientModel(given_name='Percival', family_name='Cox', gender='m', address='Sacred Heart Hospital'),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def _families(self, query_string):
+        res = self.client.get('/Patient?{}'.format(query_string), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return sorted(entry['resource']['name'][0]['family'] for entry in res.json.get('entry', []))
+
+    def test_normalize(self):
+        self.assertEqual(normalize('  Élliot\tJÖHN  Réed '), 'elliot john reed')
+        self.assertIsNone(normalize(None))
+
+    def test_default_search(self):
+        # the values that start with the searched string, ignoring case, accents and spacing
+        for query_string, expected in (('family=reed', ['Réed']),
+                                       ('family=RÉE', ['Réed']),
+                                       ('given=ell', ['Réed']),
+                                       ('name=c', ['Cox']),
+                                       ('address=sacred heart', ['Cox', 'Réed']),
+                                       ('address=Sacred   Heart S', ['Réed']),
+                                       ('family=eed', []),
+                                       ('family:exact=Reed', []),
+                                       ('family:exact=Réed', ['Réed'])):
+            self.assertEqual(self._families(query_string), expected, query_string)
+
+    def test_normalized_on_update(self):
+        patient = PatientModel.query.filter_by(family_name='Cox').one()
+        patient.family_name = 'Kelso'
+        db.session.commit()
+        self.assertEqual(self._families('family=co'), [])
+        self.assertEqual(self._families('family=kel'), ['Kelso'])
+        # the inserts without the ORM get the normalized values too
+        db.session.execute(PatientModel.__table__.insert().values(
+            id='dorian', given_name='John', family_name='Dörian', gender='m', last_updated=datetime(2020, 1, 1)))
+        db.session.commit()
+        self.assertEqual(self._families('family=dor'), ['Dörian'])
@@ -0,0 +1,114 @@
+from flask_testing import TestCase
+
+from fhirserver import create_app, TESTING, db
+from fhirserver.dao.patient import PatientModel
+from fhirserver.dao.terminology import TerminologyDAO
+from fhirserver.exceptions import InvalidElementException
+
+GENDER_SYSTEM = 'http://hl7.org/fhir/administrative-gender'
+CATEGORY_SYSTEM = 'http://example.org/observation-category'
+
+CODE_SYSTEMS = [{
+    'resourceType': 'CodeSystem',
+    'url': CATEGORY_SYSTEM,
+    'concept': [{
+        'code': 'exam',
+        'concept': [{'code': 'vital-signs', 'concept': [{'code': 'blood-pressure'}]}, {'code': 'imaging'}]
+    }, {
+        'code': 'survey'
+    }]
+}]
+
+VALUE_SETS = [{
+    'resourceType': 'ValueSet',
+    'url': 'http://example.org/ValueSet/binary-gender',
+    'expansion': {'contains': [{'system': GENDER_SYSTEM, 'code': 'male'}, {'system': GENDER_SYSTEM, 'code': 'female'}]}
+}, {
+    'resourceType': 'ValueSet',
+    'url': 'http://example.org/ValueSet/exams',
+    'compose': {
+        'include': [{'system': CATEGORY_SYSTEM, 'filter': [{'property': 'concept', 'op': 'is-a', 'value': 'exam'}]}],
+        'exclude': [{'system': CATEGORY_SYSTEM, 'concept': [{'code': 'imaging'}]}]
+    }
+}]
+
+
+class TestTerminology(TestCase):
+
+    def setUp(self):
+        db.create_all()
+        TerminologyDAO.load(VALUE_SETS + CODE_SYSTEMS)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def create_app(self):
+        return create_app(TESTING)
+
+    def test_load(self):
+        self.assertEqual(sorted(code for _, code in TerminologyDAO.expand('http://example.org/ValueSet/exams|1.0')),
+                         ['blood-pressure', 'exam', 'vital-signs'])
+        self.assertEqual(sorted(code for _, code in TerminologyDAO.subsumed(CATEGORY_SYSTEM, 'vital-signs')),
+                         ['blood-pressure', 'vital-signs'])
+        self.assertEqual(sorted(code for _, code in TerminologyDAO.subsumed(None, 'vital-signs', below=False)),
+                         ['exam', 'vital-signs'])
+        # the codes not in a loaded CodeSystem subsume only themselves
+        self.assertEqual(TerminologyDAO.subsumed(GENDER_SYSTEM, 'male'), [(GENDER_SYSTEM, 'male')])
+
+        # a ValueSet is replaced when it's loaded again
+        TerminologyDAO.load([dict(VALUE_SETS[0], expansion={'contains': [{'system': GENDER_SYSTEM, 'code': 'male'}]})])
+        self.assertEqual(TerminologyDAO.expand(VALUE_SETS[0]['url']), [(GENDER_SYSTEM, 'male')])
+        self.assertRaises(InvalidElementException, TerminologyDAO.load, [{'resourceType': 'Patient', 'url': 'x'}])
+
+    def _search(self, resource_type, query_string):
+        res = self.client.get('/{}?{}'.format(resource_type, query_string), headers={'Accept': 'application/fhir+json'})
+        self.assert200(res)
+        return sorted(entry['resource']['id'] for entry in res.json.get('entry', []))
+
+    def test_patient_tokens(self):
+        patients = {gender: PatientModel(id=gender, given_name='Patient', family_name=gender, gender=gender)
+                    for gender in ('m', 'f', 'o')}
+        db.session.add_all(patients.values())
+        db.session.commit()
+        for query_string, expected in (('gender=male,female', ['f', 'm']),
+                                       ('gender={}|,unknown'.format(GENDER_SYSTEM), ['f', 'm', 'o']),
+                                       ('gender=|male', []),
+                                       ('gender:not=male,female', ['o']),
+                                       ('gender:in=http://example.org/ValueSet/binary-gender', ['f', 'm']),
+                                       ('gender:not-in=http://example.org/ValueSet/binary-gender', ['o']),
+                                       ('gender:below=other', ['o']),
+                                       ('_id=m,o', ['m', 'o'])):
+            self.assertEqual(self._search('Patient', query_string), expected, query_string)
+        res = self.client.get('/Patient?gender:in=http://example.org/ValueSet/unknown',
+                              headers={'Accept': 'application/fhir+json'})
+        self.assert400(res)
+        self.assertEqual(res.json['issue'][0]['expression'], ['gender'])
+
+    def test_generic_tokens(self):
+        ids = {}
+        for category in ('exam', 'vital-signs', 'blood-pressure', 'imaging', 'survey'):
+            res = self.client.post('/Observation', json={
+                'resourceType': 'Observation',
+                'meta': {'tag': [{'system': 'http://example.org/tags', 'code': 'batch-{}'.format(len(ids) % 2)}]},
+                'status': 'final',
+                'category': [{'coding': [{'system': CATEGORY_SYSTEM, 'code': category}]}],
+                'code': {'text': category}
+            }, headers={'Accept': 'application/fhir+json'})
+            ids[category] = res.json['id']
+
+        def expected(*categories):
+            return sorted(ids[category] for category in categories)
+
+        for query_string, categories in (('category=exam,survey', ('exam', 'survey')),
+                                         ('category={}|exam,other|survey'.format(CATEGORY_SYSTEM), ('exam',)),
+                                         ('category={}|'.format(CATEGORY_SYSTEM), tuple(ids)),
+                                         ('category:below=vital-signs', ('vital-signs', 'blood-pressure')),
+                                         ('category:above={}|blood-pressure'.format(CATEGORY_SYSTEM),
+                                          ('exam', 'vital-signs', 'blood-pressure')),
+                                         ('category:in=http://example.org/ValueSet/exams',
+                                          ('exam', 'vital-signs', 'blood-pressure')),
+                                         ('category:not-in=http://example.org/ValueSet/exams', ('imaging', 'survey')),
+                                         ('category:not=exam,imaging', ('vital-signs', 'blood-pressure', 'survey')),
+                                         ('_tag=http://example.org/tags|batch-1', ('vital-signs', 'imaging'))):
+            self.assertEqual(self._search('Observation', query_string), expected(*categories), query_string)